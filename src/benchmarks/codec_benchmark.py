@@ -0,0 +1,132 @@
+"""
+    Compare Zarr codecs on one real subcube: compression ratio, write throughput and the read latency of the
+    access patterns in utils/access_patterns.py.
+
+    The subcube is read into memory once, from a written Zarr group (--zarr_group) or from the source NetCDF
+    (-n, -t, --subcube), then written once per codec under --out. Run e.g.
+
+        python -m src.benchmarks.codec_benchmark -n sabl2048b -t 0 --subcube 0 --out /home/idies/workspace/turb/data01_01/codec_bench
+
+    Reads are served from the page cache unless it is dropped between codecs (needs root), so read latencies show
+    decompression cost more than disk savings; multiply out the ratio against disk bandwidth for the latter.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import xarray as xr
+import yaml
+import zarr
+
+from src.dataset import NCAR_Dataset
+from src.utils import access_patterns, codec_utils
+from src.utils.catalog_utils import get_directory_size
+
+
+def load_subcube(args, config):
+    """The subcube to benchmark, in memory"""
+    if args.zarr_group is not None:
+        return xr.open_zarr(args.zarr_group).load()
+
+    write_settings = config['write_settings']
+    dataset = NCAR_Dataset(args.name, config['datasets'][args.name]['location_paths'],
+                           write_settings['desired_zarr_chunk_length'], write_settings['desired_zarr_array_length'],
+                           'prod', args.timestep, args.timestep, catalog_path=os.path.join(args.out, 'catalog.sqlite'))
+    cubes, _ = dataset.transform_to_zarr(args.timestep)
+
+    return cubes[args.subcube].load()
+
+
+def time_reads(array, points, pattern):
+    """Per-query latencies (seconds) of one access pattern over a Zarr array"""
+    latencies = []
+    if pattern == 'random_8_interpolation':
+        for point in points:
+            start = time.perf_counter()
+            access_patterns.index_8_interpolation(array, point[np.newaxis])
+            latencies.append(time.perf_counter() - start)
+    elif pattern == 'sequential_8_interpolation':
+        high = array.shape[0] - 4
+        for low in range(4, min(high, 4 + len(points))):
+            start = time.perf_counter()
+            access_patterns.sequential_8_interpolation(array, array.shape, low=low, high=high, size=1)
+            latencies.append(time.perf_counter() - start)
+
+    return np.array(latencies)
+
+
+def benchmark_codec(cube, preset, chunks, out_dir, points, repeats):
+    """Write cube with one codec preset and read it back. Returns a dict of results"""
+    compressor, filters = codec_utils.resolve_codecs(preset)
+    encoding = codec_utils.build_encoding(chunks, {var: (compressor, filters) for var in chunks})
+    path = os.path.join(out_dir, f'{preset}.zarr')
+
+    write_seconds = []
+    for _ in range(repeats):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        start = time.perf_counter()
+        cube.to_zarr(path, mode='w', encoding=encoding)
+        write_seconds.append(time.perf_counter() - start)
+
+    result = dict(codec=preset, description=codec_utils.describe_codecs(compressor, filters),
+                  raw_bytes=int(cube.nbytes), stored_bytes=get_directory_size(path),
+                  write_MBps=cube.nbytes / 1024 ** 2 / min(write_seconds))
+    result['ratio'] = result['raw_bytes'] / result['stored_bytes']
+
+    array = zarr.open_group(path, mode='r')['velocity']
+    start = time.perf_counter()
+    array[:]
+    result['full_read_MBps'] = array.nbytes / 1024 ** 2 / (time.perf_counter() - start)
+
+    for pattern in ['random_8_interpolation', 'sequential_8_interpolation']:
+        latencies = time_reads(array, points, pattern) * 1000
+        result[f'{pattern}_ms'] = dict(mean=float(latencies.mean()), p50=float(np.percentile(latencies, 50)),
+                                       p95=float(np.percentile(latencies, 95)))
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zarr_group', type=str, required=False, help='Written Zarr group to use as the subcube')
+    parser.add_argument('-n', '--name', type=str, default='sabl2048b', help='Dataset in config.yaml')
+    parser.add_argument('-t', '--timestep', type=int, default=0, help='Timestep to take the subcube from')
+    parser.add_argument('--subcube', type=int, default=0, help='Index of the subcube within the timestep')
+    parser.add_argument('--out', type=str, required=True, help='Scratch folder for the written Zarr groups')
+    parser.add_argument('--codecs', type=str, nargs='+', default=list(codec_utils.CODEC_PRESETS),
+                        help='Presets to compare, see utils/codec_utils.py')
+    parser.add_argument('--points', type=int, default=200, help='Nr. of random 8^3 reads per codec')
+    parser.add_argument('--repeats', type=int, default=2, help='Writes per codec; the fastest counts')
+    parser.add_argument('--json', type=str, required=False, help='Also write the results to this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the written Zarr groups')
+    args = parser.parse_args()
+
+    with open('config.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+
+    os.makedirs(args.out, exist_ok=True)
+    cube = load_subcube(args, config)
+    chunk_length = config['write_settings']['desired_zarr_chunk_length']
+    chunks = {var: (chunk_length,) * 3 + (cube[var].shape[3],) for var in cube.data_vars}
+    side = cube['velocity'].shape[0]
+    points = np.random.default_rng(0).integers(4, side - 4, size=(args.points, 3))
+
+    results = [benchmark_codec(cube, preset, chunks, args.out, points, args.repeats) for preset in args.codecs]
+
+    print(f"{'codec':<24}{'ratio':>7}{'write MB/s':>12}{'read MB/s':>11}{'rand p50 ms':>13}{'rand p95 ms':>13}"
+          f"{'seq p50 ms':>12}")
+    for r in results:
+        print(f"{r['codec']:<24}{r['ratio']:>7.2f}{r['write_MBps']:>12.0f}{r['full_read_MBps']:>11.0f}"
+              f"{r['random_8_interpolation_ms']['p50']:>13.2f}{r['random_8_interpolation_ms']['p95']:>13.2f}"
+              f"{r['sequential_8_interpolation_ms']['p50']:>12.2f}")
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not args.keep:
+        for preset in args.codecs:
+            shutil.rmtree(os.path.join(args.out, f'{preset}.zarr'), ignore_errors=True)
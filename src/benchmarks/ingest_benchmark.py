@@ -0,0 +1,135 @@
+"""
+    Compare NetCDF ingest throughput of the dask path and the slab-streaming path (see utils/slab_utils.py).
+
+    Both convert one NCAR timestep into its 512^3 Zarr groups under --out, so FileDB is not touched. Run e.g.
+
+        python -m src.benchmarks.ingest_benchmark -n sabl2048b -t 0 --out /home/idies/workspace/turb/data01_01/ingest_bench
+
+    Every run starts with the source file evicted from the page cache (posix_fadvise(POSIX_FADV_DONTNEED), honoured
+    by local filesystems only), so neither path reads what the other left cached. The order of the two paths
+    alternates between --repeats, and the fastest run of each path is reported.
+"""
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+import yaml
+import zarr
+
+from src.dataset import NCAR_Dataset
+from src.utils import slab_utils, write_utils
+from src.utils.scheduler_utils import DiskScheduler
+
+
+def evict_from_page_cache(path: str):
+    """Drop a file from the page cache"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def run_dask(dataset, timestep, out_dir, num_threads):
+    """Write all groups of a timestep through transform_to_zarr() and to_zarr(). Returns the group paths"""
+    cubes, _ = dataset.transform_to_zarr(timestep)
+    paths = [os.path.join(out_dir, f'group{i}.zarr') for i in range(len(cubes))]
+
+    scheduler = DiskScheduler([out_dir], max_per_disk=num_threads)
+    for cube, path in zip(cubes, paths):
+        scheduler.submit(out_dir, (cube, path))
+    scheduler.close()
+    scheduler.run(num_threads, lambda job: write_utils.write_zarr_group(job[0], job[1], dataset.encoding))
+
+    return paths
+
+
+def run_slab(dataset, timestep, out_dir, num_threads, max_slab_bytes):
+    """Write all groups of a timestep with the slab ingest. Returns the group paths and bytes read"""
+    cubes, range_list = dataset.transform_to_zarr(timestep)
+    groups = []
+    for i, cube in enumerate(cubes):
+        path = os.path.join(out_dir, f'group{i}.zarr')
+        cube.to_zarr(path, mode='w', encoding=dataset.encoding, compute=False)
+        groups.append(dict(ranges={dim: tuple(r) for dim, r in zip(dataset.split_dims, range_list[i])},
+                           path=path, disk=out_dir))
+
+    sources = [(dataset._get_source_file(timestep), dataset.source_variables, cubes[0]['energy'].dims[:3], groups)]
+    stats = slab_utils.stream_slabs_to_groups(sources, dataset.desired_zarr_array_length,
+                                              dataset.desired_zarr_chunk_size, num_threads, max_slab_bytes,
+                                              max_writes_per_disk=num_threads)
+    if stats['errors']:
+        raise stats['errors'][0][1]
+
+    return [group['path'] for group in groups], stats['bytes_read']
+
+
+def groups_equal(paths_a, paths_b):
+    """Whether two lists of Zarr groups hold the same arrays"""
+    for a, b in zip(paths_a, paths_b):
+        group_a, group_b = zarr.open_group(a, mode='r'), zarr.open_group(b, mode='r')
+        if sorted(group_a.array_keys()) != sorted(group_b.array_keys()):
+            return False
+        for name in group_a.array_keys():
+            if not np.array_equal(group_a[name][:], group_b[name][:], equal_nan=True):
+                return False
+
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--name', type=str, default='sabl2048b', help='Dataset in config.yaml')
+    parser.add_argument('-t', '--timestep', type=int, default=0, help='Timestep to convert')
+    parser.add_argument('--out', type=str, required=True, help='Scratch folder for the written Zarr groups')
+    parser.add_argument('--threads', type=int, default=34, help='Nr. of writer threads')
+    parser.add_argument('--max_slab_gb', type=float, default=8, help='Slab memory budget in GB')
+    parser.add_argument('--cube_side', type=int, default=2048, help='Side length of the source cube')
+    parser.add_argument('--repeats', type=int, default=2,
+                        help='Runs of each path, alternating which goes first. The fastest run is reported')
+    parser.add_argument('--skip_verify', action='store_true', help='Do not compare the outputs of both paths')
+    parser.add_argument('--keep', action='store_true', help='Keep the written Zarr groups')
+    args = parser.parse_args()
+
+    with open('config.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+    write_settings = config['write_settings']
+
+    dataset = NCAR_Dataset(args.name, config['datasets'][args.name]['location_paths'],
+                           write_settings['desired_zarr_chunk_length'], write_settings['desired_zarr_array_length'],
+                           'prod', args.timestep, args.timestep, catalog_path=os.path.join(args.out, 'catalog.sqlite'))
+    dataset.original_array_length = args.cube_side
+
+    source_file = dataset._get_source_file(args.timestep)
+    results = {'dask': [], 'slab': []}
+    outputs = {}
+    for repeat in range(args.repeats):
+        for ingest in (['dask', 'slab'] if repeat % 2 == 0 else ['slab', 'dask']):
+            out_dir = os.path.join(args.out, ingest)
+            if os.path.exists(out_dir):
+                shutil.rmtree(out_dir)
+            os.makedirs(out_dir)
+            evict_from_page_cache(source_file)
+
+            start = time.time()
+            if ingest == 'dask':
+                outputs[ingest] = run_dask(dataset, args.timestep, out_dir, args.threads)
+            else:
+                outputs[ingest], bytes_read = run_slab(dataset, args.timestep, out_dir, args.threads,
+                                                       int(args.max_slab_gb * 1024 ** 3))
+            results[ingest].append(time.time() - start)
+
+    print(f"Source data: {bytes_read / 1024 ** 3:.2f} GB")
+    for ingest, runs in results.items():
+        seconds = min(runs)
+        print(f"{ingest:>5}: {seconds:8.1f} s  {bytes_read / 1024 ** 2 / seconds:8.1f} MB/s  "
+              f"(runs: {', '.join(f'{run:.1f}' for run in runs)} s)")
+    print(f"Speedup: {min(results['dask']) / min(results['slab']):.2f}x")
+
+    if not args.skip_verify:
+        print("Outputs identical:", groups_equal(outputs['dask'], outputs['slab']))
+    if not args.keep:
+        shutil.rmtree(os.path.join(args.out, 'dask'))
+        shutil.rmtree(os.path.join(args.out, 'slab'))
@@ -0,0 +1,91 @@
+"""
+    Points per second of the vectorized Lagrangian interpolation in utils/interpolation_utils.py, per order, and its
+    largest deviation from the loop-based reference.
+
+    Interpolates one variable of a written Zarr group (--zarr_group), or of a random in-memory array of --side^3
+    points if none is given, at uniformly random fractional positions. Run e.g.
+
+        python -m src.benchmarks.interpolation_benchmark --zarr_group /home/idies/workspace/turb/data01_01/zarr/sabl2048b_01_prod/sabl2048b01_000.zarr --points 1000000
+
+    Reported are the end-to-end rate (stencil gather and interpolation) and the rate of the interpolation of already
+    gathered stencils alone, which excludes Zarr reads and decompression.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import zarr
+
+from src.utils import interpolation_utils, stencil_utils
+
+
+def open_array(args):
+    """The array to interpolate"""
+    if args.zarr_group is not None:
+        return zarr.open_group(args.zarr_group, mode='r')[args.variable]
+
+    data = np.random.default_rng(args.seed).random((args.side,) * 3 + (3,), dtype=np.float32)
+    return zarr.array(data, chunks=(args.chunk_length,) * 3 + (3,))
+
+
+def benchmark_order(array, order: int, positions: np.ndarray, batch_size: int, reference_points: int) -> dict:
+    """Rates (points/s) of one order, and the largest absolute error against interpolate_reference()"""
+    start = time.perf_counter()
+    values = interpolation_utils.interpolate(array, positions, order, batch_size)
+    total_seconds = time.perf_counter() - start
+
+    batch = positions[:batch_size]
+    floors = np.floor(batch)
+    stencils = stencil_utils.gather_stencils(array, floors.astype(np.int64) + 1, side=order)
+    start = time.perf_counter()
+    interpolation_utils.interpolate_stencils(stencils, batch - floors, order)
+    kernel_seconds = time.perf_counter() - start
+
+    max_error = 0.0
+    if reference_points:
+        corner = np.floor(positions[:reference_points].min(axis=0)).astype(int) - order
+        corner = np.maximum(corner, 0)
+        end = np.minimum(np.ceil(positions[:reference_points].max(axis=0)).astype(int) + order, array.shape[:3])
+        block = array[tuple(slice(c, e) for c, e in zip(corner, end))]
+        for position, value in zip(positions[:reference_points], values):
+            expected = interpolation_utils.interpolate_reference(block, position - corner, order)
+            max_error = max(max_error, float(np.abs(value - expected).max()))
+
+    return dict(order=order, points=len(positions), points_per_s=len(positions) / total_seconds,
+                kernel_points_per_s=len(batch) / kernel_seconds, max_abs_error=max_error)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zarr_group', type=str, required=False, help='Written Zarr group to interpolate')
+    parser.add_argument('--variable', type=str, default='velocity', help='Variable of --zarr_group to interpolate')
+    parser.add_argument('--side', type=int, default=256, help='Side of the random array without --zarr_group')
+    parser.add_argument('--chunk_length', type=int, default=64, help='Chunk length of the random array')
+    parser.add_argument('--orders', type=int, nargs='+', choices=interpolation_utils.ORDERS,
+                        default=list(interpolation_utils.ORDERS))
+    parser.add_argument('--points', type=int, default=100_000, help='Nr. of random positions per order')
+    parser.add_argument('--batch_size', type=int, default=interpolation_utils.DEFAULT_BATCH_SIZE,
+                        help='Points per stencil gather')
+    parser.add_argument('--reference_points', type=int, default=20,
+                        help='Nr. of positions checked against the loop-based reference')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random positions')
+    parser.add_argument('--json', type=str, required=False, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    array = open_array(args)
+    rng = np.random.default_rng(args.seed)
+
+    results = []
+    for order in args.orders:
+        low, high = order // 2 - 1, np.array(array.shape[:3]) - order // 2
+        positions = rng.uniform(low, high - 1e-6, size=(args.points, 3))
+        results.append(benchmark_order(array, order, positions, args.batch_size, args.reference_points))
+
+    print(f"{'order':>6}{'points/s':>14}{'kernel points/s':>18}{'max abs error':>16}")
+    for r in results:
+        print(f"{r['order']:>6}{r['points_per_s']:>14.0f}{r['kernel_points_per_s']:>18.0f}{r['max_abs_error']:>16.2e}")
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,78 @@
+"""
+    Compare the two velocity merges of one NCAR timestep: write_utils.merge_velocities(), which stacks and rechunks
+    u, v and w with dask, and write_utils.merge_velocities_blockwise(), which builds every velocity chunk from its
+    components on --merge_threads dask threads shared by all writer threads.
+
+    Each merge converts the timestep into its 512^3 Zarr groups under --out in a process of its own, so the peak
+    resident memory reported is that of the merge alone. FileDB is not touched. Run e.g.
+
+        python -m src.benchmarks.merge_benchmark -n sabl2048b -t 0 --out /home/idies/workspace/turb/data01_01/merge
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import time
+
+import yaml
+
+from src.benchmarks.ingest_benchmark import groups_equal, run_dask
+from src.dataset import NCAR_Dataset
+from src.utils import write_utils
+
+
+def run_merge(config, args, velocity_merge, out_dir, results):
+    """Write all groups of the timestep with one velocity merge. Puts (merge, seconds, peak RSS) in results"""
+    write_settings = dict(config['write_settings'], velocity_merge=velocity_merge, merge_threads=args.merge_threads)
+    dataset = NCAR_Dataset(args.name, config['datasets'][args.name]['location_paths'],
+                           write_settings['desired_zarr_chunk_length'], write_settings['desired_zarr_array_length'],
+                           'prod', args.timestep, args.timestep, catalog_path=os.path.join(args.out, 'catalog.sqlite'),
+                           write_settings=write_settings)
+    dataset.original_array_length = args.cube_side
+
+    start = time.time()
+    with write_utils.shared_dask_pool(dataset.merge_threads):
+        run_dask(dataset, args.timestep, out_dir, args.threads)
+    results.put((velocity_merge, time.time() - start, write_utils.get_peak_rss()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--name', type=str, default='sabl2048b', help='Dataset in config.yaml')
+    parser.add_argument('-t', '--timestep', type=int, default=0, help='Timestep to convert')
+    parser.add_argument('--out', type=str, required=True, help='Scratch folder for the written Zarr groups')
+    parser.add_argument('--threads', type=int, default=34, help='Nr. of writer threads')
+    parser.add_argument('--merge_threads', type=int, default=8,
+                        help='Dask threads shared by the writer threads in the blockwise merge')
+    parser.add_argument('--cube_side', type=int, default=2048, help='Side length of the source cube')
+    parser.add_argument('--skip_verify', action='store_true', help='Do not compare the outputs of both merges')
+    parser.add_argument('--keep', action='store_true', help='Keep the written Zarr groups')
+    args = parser.parse_args()
+
+    with open('config.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+
+    results = multiprocessing.Queue()
+    outputs = {}
+    for velocity_merge in ['dask', 'blockwise']:
+        out_dir = os.path.join(args.out, velocity_merge)
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.makedirs(out_dir)
+
+        process = multiprocessing.Process(target=run_merge, args=(config, args, velocity_merge, out_dir, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"The {velocity_merge} merge failed with exit code {process.exitcode}")
+        outputs[velocity_merge] = sorted(os.path.join(out_dir, name) for name in os.listdir(out_dir))
+
+    while not results.empty():
+        velocity_merge, seconds, peak_rss = results.get()
+        print(f"{velocity_merge:>9}: {seconds:8.1f} s  peak resident memory {peak_rss / 1024 ** 3:6.2f} GB")
+
+    if not args.skip_verify:
+        print("Outputs identical:", groups_equal(outputs['dask'], outputs['blockwise']))
+    if not args.keep:
+        shutil.rmtree(os.path.join(args.out, 'dask'))
+        shutil.rmtree(os.path.join(args.out, 'blockwise'))
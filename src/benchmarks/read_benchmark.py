@@ -0,0 +1,302 @@
+"""
+    Time the read patterns of utils/access_patterns.py against written Zarr groups: throughput, p50/p95/p99 latency
+    and bytes read per query, for a number of reader threads and cold or warm page caches.
+
+    Queries go to the groups of one dataset timestep and layout (--write_mode prod or back, located through the
+    placement catalog), or to explicit --zarr_group paths. Run e.g.
+
+        python -m src.benchmarks.read_benchmark -n sabl2048b -t 0 --write_mode prod --subcubes 0 17 42 \\
+            --threads 1 8 --cache cold warm --json read_bench.json
+
+    A cold query first evicts the chunk files it is about to read, or their byte ranges of a sharded group's shard
+    files, from the page cache with posix_fadvise(POSIX_FADV_DONTNEED), which needs no root but is only honoured
+    by local filesystems. A warm query runs after an untimed pass over the same queries. Compare the JSON of two layouts or chunk sizes to catch
+    regressions before a dataset is published.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+import yaml
+import zarr
+
+from src.dataset import NCAR_Dataset
+from src.utils import access_patterns, cache_utils, codec_utils, raw_zarr_utils, shard_utils
+
+PATTERNS = ('random_8_interpolation', 'sequential_8_interpolation', 'velocity_from_joint', 'batched_8_interpolation')
+CACHE_STATES = ('cold', 'warm')
+STENCIL = 8  # Side of the neighborhood every query reads
+
+
+class CountingStore(MutableMapping):
+    """
+    Read-only wrapper of a Zarr store that counts the bytes each thread reads, so concurrent queries can be
+    measured separately
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._local = threading.local()
+
+    @property
+    def bytes_read(self) -> int:
+        """Bytes read by the calling thread so far"""
+        return getattr(self._local, 'bytes_read', 0)
+
+    def __getitem__(self, key):
+        value = self.store[key]
+        self._local.bytes_read = self.bytes_read + len(value)
+        return value
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __setitem__(self, key, value):
+        raise PermissionError("CountingStore is read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError("CountingStore is read-only")
+
+
+def _evict_file_range(path: str, offset: int = 0, nbytes: int = 0):
+    """Drop nbytes of a file from offset from the page cache. nbytes=0 drops the rest of the file"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, offset, nbytes, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def evict_from_page_cache(group_path: str, corner, side: int = STENCIL, store=None):
+    """
+    Drop the chunks of every array of a group that a side^3 neighborhood starting at corner touches from the page
+    cache: their chunk files, or for a sharded group their byte ranges of the shard files
+
+    Args:
+        group_path (str): Zarr group of either layout
+        corner: (z, y, x) of the neighborhood's first point
+        side (int): Side of the neighborhood
+        store (shard_utils.ShardedStore): Open store of a sharded group, to reuse its offset index. Opened from
+            group_path when omitted
+    """
+    if store is None and shard_utils.is_sharded_group(group_path):
+        store = shard_utils.ShardedStore(group_path)
+    sharded = isinstance(store, shard_utils.ShardedStore)
+
+    for name in os.listdir(group_path):
+        array_path = os.path.join(group_path, name)
+        if not os.path.exists(os.path.join(array_path, '.zarray')):
+            continue
+        metadata = raw_zarr_utils.read_array_metadata(array_path)
+        chunks = metadata['chunks']
+        separator = metadata.get('dimension_separator') or '.'
+        ranges = [range(c // chunk, (c + side - 1) // chunk + 1) for c, chunk in zip(corner, chunks[:3])]
+        for chunk_index in np.ndindex(*[len(r) for r in ranges]):
+            key = [r[i] for r, i in zip(ranges, chunk_index)] + [0] * (len(chunks) - 3)
+            chunk_key = raw_zarr_utils.get_chunk_key(key, separator)
+            if sharded:
+                try:
+                    _evict_file_range(*store.get_chunk_range(f'{name}/{chunk_key}'))
+                except KeyError:  # Fill-value chunk, not stored
+                    pass
+                continue
+            chunk_path = os.path.join(array_path, chunk_key)
+            if os.path.exists(chunk_path):
+                _evict_file_range(chunk_path)
+
+
+class OpenGroup:
+    """
+    A Zarr group opened for benchmarking, through a CountingStore, as a Zarr group and as an xarray Dataset.
+    With a chunk cache, the CountingStore only sees the chunk files read from disk
+    """
+
+    def __init__(self, path: str, variable: str, chunk_cache: cache_utils.ChunkCache = None, read_ahead: int = 0):
+        self.path = path
+        self.store = CountingStore(shard_utils.get_store(path))
+        store = self.store if chunk_cache is None else cache_utils.CachingStore(self.store, chunk_cache, read_ahead)
+        self.array = zarr.open_group(store, mode='r')[variable]
+        self.joint = xr.open_zarr(store).isel({'velocity component (xyz)': 0})
+        self.side = self.array.shape[0]
+
+
+def make_queries(pattern: str, groups: list, points: int, rng: np.random.Generator, batch_size: int = 1) -> list:
+    """
+    (group index, (z, y, x) center) of every query. Centers are at least STENCIL / 2 from the group's faces. For
+    batched_8_interpolation, each query is (group index, (batch_size, 3) centers) instead
+    """
+    half = STENCIL // 2
+    if pattern == 'sequential_8_interpolation':
+        diagonal = [(g, (i, i, i)) for g, group in enumerate(groups) for i in range(half, group.side - half)]
+        return diagonal[:points]
+    if pattern == 'batched_8_interpolation':
+        return [(g, rng.integers(half, groups[g].side - half, size=(batch_size, 3)))
+                for g in rng.integers(0, len(groups), size=max(1, points // batch_size)).tolist()]
+
+    group_indices = rng.integers(0, len(groups), size=points)
+    return [(int(g), tuple(int(c) for c in rng.integers(half, groups[g].side - half, size=3)))
+            for g in group_indices]
+
+
+def run_query(pattern: str, group: OpenGroup, center) -> np.ndarray:
+    """Read one query's neighborhood with the access_patterns function of the pattern"""
+    if pattern == 'random_8_interpolation':
+        return access_patterns.index_8_interpolation(group.array, np.array([center]))[0]
+    if pattern == 'sequential_8_interpolation':
+        index = center[0]
+        return access_patterns.sequential_8_interpolation(group.array, group.array.shape, low=index,
+                                                          high=index + 1, size=1)[0]
+    if pattern == 'velocity_from_joint':
+        subset = access_patterns.access_1_velocity_from_joint(group.joint, [center[::-1]])[0]
+        return subset.compute(scheduler='synchronous').values  # In this thread, so its bytes are counted
+    if pattern == 'batched_8_interpolation':
+        return access_patterns.batched_8_interpolation(group.array, center)
+
+    raise ValueError(f"Unknown pattern '{pattern}'. Use one of {PATTERNS}")
+
+
+def time_queries(pattern: str, groups: list, queries: list, cache: str, threads: int,
+                 chunk_cache: cache_utils.ChunkCache = None) -> dict:
+    """
+    Run queries with a pool of threads. A cold run starts from an empty chunk cache; the counters of the chunk
+    cache cover the timed run only
+
+    Returns:
+        dict: Per-query latencies (s) and bytes read, the wall time of the whole run, and the chunk cache's stats
+            (None without a chunk cache)
+    """
+    half = STENCIL // 2
+
+    def query(job):
+        g, center = job
+        group = groups[g]
+        if cache == 'cold':
+            for point in np.reshape(center, (-1, 3)):
+                evict_from_page_cache(group.path, [c - half for c in point], store=group.store.store)
+        bytes_before = group.store.bytes_read
+        start = time.perf_counter()
+        run_query(pattern, group, center)
+        latency = time.perf_counter() - start
+        return latency, group.store.bytes_read - bytes_before
+
+    if cache == 'warm':
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(query, queries))
+    if chunk_cache is not None:
+        if cache == 'cold':
+            chunk_cache.clear()  # Chunks cached by earlier runs would be read from memory
+        else:
+            chunk_cache.wait_for_prefetches()
+            chunk_cache.reset_counters()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(query, queries))
+    wall_seconds = time.perf_counter() - start
+
+    if chunk_cache is not None:
+        chunk_cache.wait_for_prefetches()
+    return dict(latencies=np.array([r[0] for r in results]), bytes=np.array([r[1] for r in results]),
+                wall_seconds=wall_seconds, chunk_cache=chunk_cache.stats() if chunk_cache is not None else None)
+
+
+def summarize(pattern, cache, threads, timing, layout) -> dict:
+    """One JSON result"""
+    latencies_ms = timing['latencies'] * 1000
+    queries = len(latencies_ms)
+    return dict(layout, pattern=pattern, cache=cache, threads=threads, queries=queries,
+                queries_per_s=queries / timing['wall_seconds'],
+                MBps=float(timing['bytes'].sum()) / 1024 ** 2 / timing['wall_seconds'],
+                latency_ms=dict(mean=float(latencies_ms.mean()), p50=float(np.percentile(latencies_ms, 50)),
+                                p95=float(np.percentile(latencies_ms, 95)), p99=float(np.percentile(latencies_ms, 99))),
+                bytes_per_query=dict(mean=float(timing['bytes'].mean()), max=int(timing['bytes'].max())),
+                chunk_cache=timing['chunk_cache'])
+
+
+def describe_layout(groups: list, args) -> dict:
+    """What was benchmarked: dataset, timestep, copy, groups, chunk shape and codecs"""
+    array = groups[0].array
+    return dict(dataset=args.name if not args.zarr_group else None,
+                timestep=args.timestep if not args.zarr_group else None,
+                write_mode=args.write_mode if not args.zarr_group else None,
+                groups=[group.path for group in groups], variable=args.variable, shape=list(array.shape),
+                chunks=list(array.chunks), codecs=codec_utils.describe_codecs(array.compressor, array.filters))
+
+
+def get_group_paths(args, config) -> list:
+    """Zarr groups to query: --zarr_group, or --subcubes of the dataset timestep from the placement catalog"""
+    if args.zarr_group:
+        return args.zarr_group
+
+    write_settings = config['write_settings']
+    dataset = NCAR_Dataset(args.name, config['datasets'][args.name]['location_paths'],
+                           write_settings['desired_zarr_chunk_length'], write_settings['desired_zarr_array_length'],
+                           args.write_mode, args.timestep, args.timestep, catalog_path=args.catalog_path)
+    paths = dataset.get_zarr_paths(args.timestep)
+
+    return [paths[i] for i in args.subcubes]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zarr_group', type=str, nargs='+', required=False,
+                        help='Written Zarr group(s) to query instead of a dataset timestep')
+    parser.add_argument('-n', '--name', type=str, default='sabl2048b', help='Dataset in config.yaml')
+    parser.add_argument('-t', '--timestep', type=int, default=0, help='Timestep to query')
+    parser.add_argument('--write_mode', type=str, choices=['prod', 'back'], default='prod', help='Copy to query')
+    parser.add_argument('--subcubes', type=int, nargs='+', default=[0],
+                        help='Indices of the timestep\'s Zarr groups to spread queries over')
+    parser.add_argument('--catalog_path', type=str, required=False, help='Placement catalog, see main.py')
+    parser.add_argument('--variable', type=str, default='velocity', help='Variable read by the 8^3 patterns')
+    parser.add_argument('--patterns', type=str, nargs='+', choices=PATTERNS, default=list(PATTERNS))
+    parser.add_argument('--points', type=int, default=1000, help='Nr. of points queried per pattern')
+    parser.add_argument('--batch_size', type=int, default=1000,
+                        help='Points per query of batched_8_interpolation, which reads every touched chunk once')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1], help='Reader thread counts to run')
+    parser.add_argument('--cache', type=str, nargs='+', choices=CACHE_STATES, default=list(CACHE_STATES))
+    parser.add_argument('--chunk_cache_mb', type=int, default=0,
+                        help='Serve chunk files through an in-memory LRU cache of this size, see utils/cache_utils.py')
+    parser.add_argument('--read_ahead', type=int, default=0, help='Chunks the cache reads ahead on a miss')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random query points')
+    parser.add_argument('--json', type=str, required=False, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    with open('config.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+
+    chunk_cache = cache_utils.ChunkCache(args.chunk_cache_mb * 1024 ** 2) if args.chunk_cache_mb else None
+    groups = [OpenGroup(path, args.variable, chunk_cache, args.read_ahead) for path in get_group_paths(args, config)]
+    layout = describe_layout(groups, args)
+    rng = np.random.default_rng(args.seed)
+
+    results = []
+    for pattern in args.patterns:
+        queries = make_queries(pattern, groups, args.points, rng, args.batch_size)
+        for cache in args.cache:
+            for threads in args.threads:
+                results.append(summarize(pattern, cache, threads,
+                                         time_queries(pattern, groups, queries, cache, threads, chunk_cache), layout))
+
+    print(f"{'pattern':<28}{'cache':<7}{'threads':>8}{'queries/s':>11}{'MB/s':>8}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'KB/query':>10}" + (f"{'hit rate':>10}" if chunk_cache is not None else ''))
+    for r in results:
+        print(f"{r['pattern']:<28}{r['cache']:<7}{r['threads']:>8}{r['queries_per_s']:>11.1f}{r['MBps']:>8.1f}"
+              f"{r['latency_ms']['p50']:>9.2f}{r['latency_ms']['p95']:>9.2f}{r['latency_ms']['p99']:>9.2f}"
+              f"{r['bytes_per_query']['mean'] / 1024:>10.0f}"
+              + (f"{r['chunk_cache']['hit_rate']:>10.1%}" if chunk_cache is not None else ''))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,96 @@
+"""
+    Read bandwidth of global box reads against the nr. of FileDB disks they touch, with utils/halo_utils.py's
+    per-disk concurrent reader and with the same reads one after another.
+
+    Every box is one group long per side, placed so that it overlaps 1, 2, 4 or 8 groups, which node coloring puts
+    on as many disks. Run e.g.
+
+        python -m src.benchmarks.region_benchmark -n sabl2048b -t 0 --write_mode prod --max_reads_per_disk 1 2
+
+    Boxes are read with a cold page cache: the chunk files of the groups touched are evicted with
+    posix_fadvise(POSIX_FADV_DONTNEED) before every read, which only local filesystems honour.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import yaml
+
+from src.dataset import NCAR_Dataset
+from src.utils.halo_utils import HaloReader
+
+# Offsets, in groups, of boxes overlapping 1, 2, 4 and 8 groups
+BOX_OFFSETS = {1: (0, 0, 0), 2: (0, 0, 0.5), 4: (0, 0.5, 0.5), 8: (0.5, 0.5, 0.5)}
+
+
+def evict_groups(reader: HaloReader, groups):
+    """Drop every file of the variable in some groups from the page cache"""
+    for group in groups:
+        array_path = os.path.join(reader.placements[group]['path'], reader.variable)
+        for name in os.listdir(array_path):
+            fd = os.open(os.path.join(array_path, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def benchmark_box(reader: HaloReader, nr_groups: int, repeats: int, serial: bool) -> dict:
+    """Best MB/s of reading a box overlapping nr_groups groups"""
+    length = reader.group_length
+    start = np.array([int(o * length) for o in BOX_OFFSETS[nr_groups]])
+    shape = (length,) * 3
+    groups = list(reader.get_touched_groups(start[np.newaxis], start[np.newaxis] + length))
+    disks = {reader.placements[group]['disk'] for group in groups}
+
+    out = None
+    seconds = []
+    for _ in range(repeats):
+        evict_groups(reader, groups)
+        begin = time.perf_counter()
+        out = reader.read_region(start, shape, out=out, num_threads=1 if serial else None)
+        seconds.append(time.perf_counter() - begin)
+
+    return dict(groups=len(groups), disks=len(disks), serial=serial, MB=out.nbytes / 1024 ** 2,
+                seconds=min(seconds), MBps=out.nbytes / 1024 ** 2 / min(seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--name', type=str, default='sabl2048b', help='Dataset in config.yaml')
+    parser.add_argument('-t', '--timestep', type=int, default=0, help='Timestep to read')
+    parser.add_argument('--write_mode', type=str, choices=['prod', 'back'], default='prod', help='Copy to read')
+    parser.add_argument('--catalog_path', type=str, required=False, help='Placement catalog, see main.py')
+    parser.add_argument('--variable', type=str, default='velocity', help='Variable to read')
+    parser.add_argument('--max_reads_per_disk', type=int, nargs='+', default=[1],
+                        help='Concurrent reads per disk to run')
+    parser.add_argument('--repeats', type=int, default=3, help='Reads per box; the fastest counts')
+    parser.add_argument('--json', type=str, required=False, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    with open('config.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+    write_settings = config['write_settings']
+    dataset = NCAR_Dataset(args.name, config['datasets'][args.name]['location_paths'],
+                           write_settings['desired_zarr_chunk_length'], write_settings['desired_zarr_array_length'],
+                           args.write_mode, args.timestep, args.timestep, catalog_path=args.catalog_path)
+
+    results = []
+    for max_reads_per_disk in args.max_reads_per_disk:
+        reader = dataset.get_halo_reader(args.timestep, args.variable, max_reads_per_disk=max_reads_per_disk)
+        for nr_groups in BOX_OFFSETS:
+            for serial in (True, False):
+                results.append(dict(benchmark_box(reader, nr_groups, args.repeats, serial),
+                                    max_reads_per_disk=max_reads_per_disk))
+
+    print(f"{'reads/disk':>10}{'groups':>8}{'disks':>7}{'mode':>12}{'seconds':>9}{'MB/s':>9}")
+    for r in results:
+        mode = 'serial' if r['serial'] else 'concurrent'
+        print(f"{r['max_reads_per_disk']:>10}{r['groups']:>8}{r['disks']:>7}{mode:>12}{r['seconds']:>9.2f}"
+              f"{r['MBps']:>9.0f}")
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
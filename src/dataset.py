@@ -3,9 +3,25 @@
 
 
 from abc import ABC, abstractmethod
+import multiprocessing
 import queue
 import threading
 from .utils import write_utils
+from .utils.catalog_utils import PlacementCatalog, get_default_catalog_path, get_directory_size, get_directory_checksum
+from .utils.journal_utils import WriteJournal
+from .utils.scheduler_utils import DiskScheduler
+from .utils import slab_utils
+from .utils import codec_utils
+from .utils import copy_utils
+from .utils import checksum_utils
+from .utils import verify_utils
+from .utils import shard_utils
+from .utils import coordinator_utils
+from .utils.coordinator_utils import WorkPool
+from .utils import halo_utils
+from .utils.halo_utils import HaloReader
+from .utils import timeseries_utils
+from .utils.timeseries_utils import TimeSeriesReader
 import xarray as xr
 import dask
 import glob
@@ -33,6 +49,25 @@ class Dataset(ABC):
         The chunk size to be used when writing to Zarr
     desired_zarr_array_length : int
         The desired side length of the 3D data cube represented by each Zarr Group
+    catalog_path : str
+        Location of the placement catalog (SQLite) recording where every subcube was written. Defaults to
+         placement_catalog.sqlite on the first FileDB folder, see catalog_utils.get_default_catalog_path()
+    journal_path : str
+        Write journal of committed Zarr groups, next to the placement catalog. Lets interrupted writes be resumed
+    encoding : dict
+        Zarr chunks, compressor and filters of each variable. Codecs come from the write_settings of config.yaml
+         (see codec_utils); without write_settings everything is written uncompressed
+    halo : int
+        Cells of the neighboring subcubes also stored on every side of each Zarr group (write_settings.halo), so any
+         8^3 stencil can be read from a single group. 0 stores disjoint groups
+    velocity_merge : str
+        How u, v and w become the (..., 3) velocity (write_settings.velocity_merge). 'dask' stacks and rechunks them
+         with write_utils.merge_velocities(). 'blockwise' builds every velocity chunk directly from its components,
+         see write_utils.merge_velocities_blockwise()
+    merge_threads : int
+        Blockwise merge only. Dask threads shared by all writer threads of a process (write_settings.merge_threads),
+         so at most this many velocity chunks are merged, or other dask tasks run, at once. None for dask's own pools,
+         cpu_count threads per writer thread
 
     ...
 
@@ -44,10 +79,26 @@ class Dataset(ABC):
         Transforms the dataset to Zarr format (must be implemented by subclasses)
     distribute_to_filedb(PROD_OR_BACKUP='prod', USE_DASK=False, NUM_THREADS=34):
         Distributes the dataset to FileDB using Ryan Hausen's node_assignment() node coloring alg.
+    distribute_coordinated(coordination_path, num_processes=1):
+        Same, with the (timestep, subcube) writes shared by several processes or jobs through a work pool
+    get_zarr_paths(timestep):
+        Paths of the written Zarr groups of a timestep, from the placement catalog if possible
+    locate_point(timestep, z, y, x):
+        The placement (disk, path, bounds, ...) of the subcube holding a point, from the placement catalog
+    get_halo_reader(timestep, variable='velocity'):
+        Reader of a timestep in global coordinates, for stencils and regions straddling subcube boundaries
+    convert_layout(layout):
+        Convert the written groups of start_timestep..end_timestep between the directory and sharded layouts
+    get_timeseries_reader(variable='velocity'):
+        Reader of regions and points over many timesteps, e.g. the history of a point
+    write_time_chunked(variables=('velocity',)):
+        Write the time-chunked companion layout of every subcube over start_timestep..end_timestep
+    verify_against_source(NUM_THREADS=34, sample_fraction=1.0):
+        Compare the written groups with the source, reading each source file once (or a sample of chunks)
     """
 
     def __init__(self, name, location_paths, desired_zarr_chunk_size, desired_zarr_array_length, write_mode,
-                 start_timestep, end_timestep):
+                 start_timestep, end_timestep, catalog_path=None, write_settings=None):
         self.name = name
         self.location_paths = location_paths  # List of paths
         self.desired_zarr_chunk_size = desired_zarr_chunk_size
@@ -58,16 +109,28 @@ class Dataset(ABC):
         self.end_timestep = end_timestep
         # TODO add something that reads end_timestep from folder instead of having to be specified
 
+        if catalog_path is None:
+            catalog_path = get_default_catalog_path()
+        self.catalog_path = catalog_path
+        # Committed groups of distribute_to_filedb(), used by resume=True
+        self.journal_path = os.path.join(os.path.dirname(catalog_path), f'{name}_{write_mode}_journal.jsonl')
+
         # TODO Generalize this. It's hard-coded for NCAR
-        self.encoding = {
-            "velocity": dict(chunks=(desired_zarr_chunk_size, desired_zarr_chunk_size, desired_zarr_chunk_size, 3),
-                             compressor=None),
-            "pressure": dict(chunks=(desired_zarr_chunk_size, desired_zarr_chunk_size, desired_zarr_chunk_size, 1),
-                             compressor=None),
-            "temperature": dict(chunks=(desired_zarr_chunk_size, desired_zarr_chunk_size, desired_zarr_chunk_size, 1),
-                                compressor=None),
-            "energy": dict(chunks=(desired_zarr_chunk_size, desired_zarr_chunk_size, desired_zarr_chunk_size, 1),
-                           compressor=None)}
+        chunks = {
+            "velocity": (desired_zarr_chunk_size, desired_zarr_chunk_size, desired_zarr_chunk_size, 3),
+            "pressure": (desired_zarr_chunk_size, desired_zarr_chunk_size, desired_zarr_chunk_size, 1),
+            "temperature": (desired_zarr_chunk_size, desired_zarr_chunk_size, desired_zarr_chunk_size, 1),
+            "energy": (desired_zarr_chunk_size, desired_zarr_chunk_size, desired_zarr_chunk_size, 1)}
+        # Compressor and filters of each variable from config.yaml's write_settings. Uncompressed if not given
+        codecs = codec_utils.get_variable_codecs(write_settings, chunks) if write_settings is not None else None
+        self.encoding = codec_utils.build_encoding(chunks, codecs)
+        # Halo cells of the neighboring subcubes stored on every side of each group, see write_utils.split_zarr_group()
+        self.halo = int((write_settings or {}).get('halo') or 0)
+        self.velocity_merge = (write_settings or {}).get('velocity_merge') or 'dask'
+        if self.velocity_merge not in ('dask', 'blockwise'):
+            raise ValueError(f"Unknown velocity_merge '{self.velocity_merge}'. Use 'dask' or 'blockwise'")
+        merge_threads = (write_settings or {}).get('merge_threads')
+        self.merge_threads = int(merge_threads) if merge_threads and self.velocity_merge == 'blockwise' else None
 
     def _get_data_cube_side(self, data_xarray):
         raise NotImplementedError('TODO Implement reading the length of the 3D cube side from path')
@@ -84,6 +147,158 @@ class Dataset(ABC):
         """
         raise NotImplementedError("Subclasses must implement this method")
 
+    def get_range_list(self):
+        """
+        Where each Zarr subarray starts and ends, computed from the array sizes alone without opening the data.
+        Same order as the range_list returned by transform_to_zarr()
+        """
+        return write_utils.get_range_list([self.original_array_length] * 3, self.desired_zarr_array_length)
+
+    def get_subcube_placements(self, timestep: int, range_list: list):
+        """
+        Placement catalog rows (without size and checksum) for every Zarr subarray of a timestep
+
+        Args:
+            timestep (int): timestep of the dataset
+            range_list (list): Where zarr subarrays start and end
+
+        Returns:
+            list[dict]: One row per subarray, in range_list order
+        """
+        dests, chunk_morton_mapping = self.get_zarr_array_destinations(timestep, range_list)
+        subcube_by_morton = {morton: i + 1 for i, morton in enumerate(chunk_morton_mapping.values())}
+        min_codes, max_codes = write_utils.get_range_morton_codes(range_list, self.original_array_length)
+
+        placements = []
+        for i, (dest, ranges) in enumerate(zip(dests, range_list)):
+            morton = (int(min_codes[i]), int(max_codes[i]))
+            placements.append(dict(
+                dataset=self.name, write_mode=self.write_mode, timestep=timestep,
+                subcube=subcube_by_morton[morton], array_cube_side=self.original_array_length,
+                morton_start=morton[0], morton_end=morton[1],
+                z_start=ranges[0][0], z_end=ranges[0][1],
+                y_start=ranges[1][0], y_end=ranges[1][1],
+                x_start=ranges[2][0], x_end=ranges[2][1],
+                disk=write_utils.get_filedb_folder(dest) or os.path.dirname(dest), path=dest))
+
+        return placements
+
+    def get_catalog(self):
+        """Open the placement catalog. Remember to close() it"""
+        return PlacementCatalog(self.catalog_path)
+
+    def get_zarr_paths(self, timestep: int):
+        """
+        Paths of the Zarr groups of a timestep. Read from the placement catalog if the timestep was recorded there,
+        otherwise derived from the node assignment. Never opens the source data
+
+        Args:
+            timestep (int): timestep of the dataset
+
+        Returns:
+            list[str]: Zarr group paths
+        """
+        if os.path.exists(self.catalog_path):
+            with self.get_catalog() as catalog:
+                placements = catalog.get_placements(self.name, self.write_mode, timestep)
+            if placements:
+                return [placement['path'] for placement in placements]
+
+        dests, _ = self.get_zarr_array_destinations(timestep, self.get_range_list())
+        return dests
+
+    def locate_point(self, timestep: int, z: int, y: int, x: int):
+        """
+        Find which Zarr group holds a point, using the placement catalog
+
+        Args:
+            timestep (int): timestep of the dataset
+            z, y, x (int): Global coordinates of the point (nnz, nny, nnx)
+
+        Returns:
+            dict: Placement row with 'disk', 'path', bounds, etc. None if the point was not recorded
+        """
+        with self.get_catalog() as catalog:
+            return catalog.locate_point(self.name, self.write_mode, timestep, z, y, x)
+
+    def get_placements(self, timestep: int) -> list:
+        """
+        Placement rows of the Zarr groups of a timestep, from the placement catalog if the timestep was recorded
+        there, otherwise from the node assignment
+        """
+        placements = []
+        if os.path.exists(self.catalog_path):
+            with self.get_catalog() as catalog:
+                placements = catalog.get_placements(self.name, self.write_mode, timestep)
+        if not placements:
+            placements = self.get_subcube_placements(timestep, self.get_range_list())
+
+        return placements
+
+    def get_halo_reader(self, timestep: int, variable: str = 'velocity', **kwargs) -> HaloReader:
+        """
+        Read a timestep in global coordinates across its Zarr groups, e.g. 8^3 stencils within 4 points of a
+        subcube face. Groups are located with the placement catalog if the timestep was recorded there, otherwise
+        with the node assignment
+
+        Args:
+            timestep (int): timestep of the dataset
+            variable (str): Variable to read
+            kwargs: max_reads_per_disk, cache and read_ahead, see halo_utils.HaloReader
+
+        Returns:
+            HaloReader: See utils/halo_utils.py
+        """
+        return HaloReader(self.get_placements(timestep), variable, **kwargs)
+
+    def get_time_chunked_path(self, placement: dict, start_timestep: int, end_timestep: int) -> str:
+        """
+        Path of a subcube's time-chunked companion group of start_timestep..end_timestep: next to its timestep
+        groups, so on the same disk. Every range written gets its own
+        """
+        return os.path.join(os.path.dirname(placement['path'].rstrip('/')),
+                            f"{self.name}{str(placement['subcube']).zfill(2)}_time_"
+                            f"{str(start_timestep).zfill(3)}-{str(end_timestep).zfill(3)}.zarr")
+
+    def get_time_chunked_placements(self) -> list:
+        """
+        Placement rows of the time-chunked companion groups, see write_time_chunked(). One list of rows per
+        timestep range written, counting only ranges for which every subcube has a companion. Subcubes are in the
+        same folders at every timestep, so the folders of start_timestep's groups are searched
+        """
+        placements = self.get_placements(self.start_timestep)
+        ranges = None
+        for placement in placements:
+            folder = os.path.dirname(placement['path'].rstrip('/'))
+            pattern = re.escape(f"{self.name}{str(placement['subcube']).zfill(2)}_time_") + r'(\d+)-(\d+)\.zarr'
+            matches = [re.fullmatch(pattern, name) for name in (os.listdir(folder) if os.path.isdir(folder) else [])]
+            found = {(int(match.group(1)), int(match.group(2))) for match in matches if match}
+            ranges = found if ranges is None else ranges & found
+
+        return [[dict(placement, path=self.get_time_chunked_path(placement, start, end)) for placement in placements]
+                for start, end in sorted(ranges or [])]
+
+    def get_timeseries_reader(self, variable: str = 'velocity', use_time_chunked: bool = True,
+                              **kwargs) -> TimeSeriesReader:
+        """
+        Read regions and points over many timesteps at once, e.g. reader.read_region(start, shape, timesteps)
+        returns a (T, z, y, x, 3) velocity block. Keeps the groups it opens for later queries
+
+        Args:
+            variable (str): Variable to read
+            use_time_chunked (bool): Serve queries from the time-chunked companion groups of a timestep range if
+                there are any holding all the timesteps asked for
+            kwargs: max_reads_per_disk, cache, read_ahead and max_open_timesteps, see
+                timeseries_utils.TimeSeriesReader
+
+        Returns:
+            TimeSeriesReader: See utils/timeseries_utils.py
+        """
+        time_chunked_placements = self.get_time_chunked_placements() if use_time_chunked else None
+
+        return TimeSeriesReader(self.get_placements, variable, time_chunked_placements=time_chunked_placements,
+                                **kwargs)
+
     @abstractmethod
     def transform_to_zarr(self, file_path):
         """
@@ -92,53 +307,524 @@ class Dataset(ABC):
         """
         raise NotImplementedError("Subclasses must implement this method")
 
-    def distribute_to_filedb(self, NUM_THREADS=34):
+    def distribute_to_filedb(self, NUM_THREADS=34, record_checksums=False, pipelined=False, lookahead=1,
+                             max_staged_bytes=None, max_writes_per_disk=1, resume=False, ingest='dask',
+                             max_slab_bytes=8 * 1024 ** 3, writer='xarray', sync_policy='none', chunk_checksums=False,
+                             layout='directory'):
         '''
         Write the production copy of the dataset to FileDB using Ryan
-        Hausen's node_assignment() node coloring alg.
+        Hausen's node_assignment() node coloring alg. Writes are queued per
+        destination disk, see scheduler_utils.DiskScheduler.
+
+        Every group is written under a staging name and renamed into place
+        when complete. It is then recorded in the write journal and the
+        placement catalog
 
         Args:
             NUM_THREADS (int): Number of threads to use when writing to disk. Currently 34 to match nr. of disks on
                 FileDB
+            record_checksums (bool): Also store a CRC32 of each written group in the catalog. Reads every group
+                back once, so off by default
+            pipelined (bool): Stream writes across the whole start_timestep..end_timestep range instead of
+                finishing each timestep before opening the next. See _distribute_pipelined()
+            lookahead (int): Pipelined mode only. How many timesteps may be staged ahead of the oldest unfinished one
+            max_staged_bytes (int): Pipelined mode only. If set, subcubes are read into memory ahead of the writers,
+                holding at most this many bytes. If None, look-ahead subcubes stay lazy
+            max_writes_per_disk (int or dict): How many subcubes may be written to the same FileDB disk at once.
+                A {disk folder: limit} dict sets it per disk, e.g. higher for SSDs than for spinning disks
+            resume (bool): Skip subcubes that the write journal lists as committed and that still match it on disk.
+                Timesteps with nothing left to write are not even opened
+            ingest (str): 'dask' reads the source through dask chunks. 'slab' streams it in large contiguous slabs
+                across all timesteps, see _distribute_slabs(). pipelined, lookahead and max_staged_bytes do not
+                apply to 'slab', and it cannot write halos
+            max_slab_bytes (int): Slab ingest only. Memory budget for slabs read but not yet written
+            writer (str): 'xarray' writes chunks with to_zarr(). 'raw' writes the chunk files of uncompressed
+                groups directly, byte-identical, see raw_zarr_utils
+            sync_policy (str): 'none' leaves written data to the page cache. 'fsync' fsyncs every group before
+                committing it. 'direct' also writes raw chunks with O_DIRECT
+            chunk_checksums (bool): Store a checksum of every chunk file in each group before committing it, so
+                prod and back copies can be verified without the source, see checksum_utils
+            layout (str): 'directory' writes one file per chunk. 'sharded' packs each group's chunks into one
+                shard file per variable before committing it, see shard_utils
         '''
-        # Note that this multithreading works over multiple timesteps. 2nd
-        #   timestep will start before 1st is finished
-        for timestep in range(self.start_timestep, self.end_timestep + 1):
-            lazy_zarr_cubes, range_list = self.transform_to_zarr(timestep)
+        write_options = dict(writer=writer, sync_policy=sync_policy, checksums=chunk_checksums, layout=layout)
+        catalog = self.get_catalog()
+        journal = WriteJournal(self.journal_path)
+        committed = journal.load() if resume else {}
+
+        if self.halo:
+            print(halo_utils.format_halo_report(halo_utils.estimate_halo_tradeoff(
+                self.original_array_length, self.desired_zarr_array_length, self.halo)))
+        if ingest == 'slab':
+            if self.halo:
+                raise ValueError("The slab ingest writes chunk-aligned pieces and cannot store halos. "
+                                 "Use ingest='dask'")
+            self._distribute_slabs(NUM_THREADS, catalog, journal, committed, record_checksums, max_slab_bytes,
+                                   max_writes_per_disk, write_options)
+            catalog.close()
+            return
+        elif ingest != 'dask':
+            raise ValueError(f"Unknown ingest '{ingest}'. Use 'dask' or 'slab'")
+
+        with write_utils.shared_dask_pool(self.merge_threads):
+            if pipelined:
+                self._distribute_pipelined(NUM_THREADS, catalog, journal, committed, record_checksums, lookahead,
+                                           max_staged_bytes, max_writes_per_disk, write_options)
+                self._report_memory(f"timesteps {self.start_timestep}-{self.end_timestep}")
+                catalog.close()
+                return
+
+            for timestep in range(self.start_timestep, self.end_timestep + 1):
+                pending = self._get_pending_subcubes(timestep, committed)
+                if not pending:
+                    print(f"All subcubes of timestep {timestep} are already committed, skipping")
+                    continue
+
+                lazy_zarr_cubes, _ = self.transform_to_zarr(timestep)
+
+                scheduler = DiskScheduler(write_utils.list_fileDB_folders(), max_writes_per_disk)
+
+                def write_subcube(job):
+                    cube, placement = job
+                    write_utils.write_zarr_group(cube, placement['path'], self.encoding, staged=True, **write_options)
+                    self._record_written_group(catalog, journal, placement, record_checksums)
+
+                # Populate the per-disk queues with Write to FileDB tasks
+                for i, placement in pending:
+                    scheduler.submit(placement['disk'], (lazy_zarr_cubes[i], placement))
+                scheduler.close()
+
+                scheduler.run(NUM_THREADS, write_subcube)
+                self._report_failed_writes(scheduler)
+                self._report_memory(f"timestep {timestep}")
+
+        catalog.close()
+
+    def distribute_coordinated(self, coordination_path, num_processes=1, threads_per_process=4,
+                               record_checksums=False, resume=False,
+                               lease_seconds=coordinator_utils.DEFAULT_LEASE_SECONDS,
+                               max_attempts=coordinator_utils.DEFAULT_MAX_ATTEMPTS, **write_options):
+        '''
+        Write the production copy like distribute_to_filedb(), with the (timestep, subcube) writes of
+        start_timestep..end_timestep shared through a work pool in coordination_path, see coordinator_utils.
+        Any number of jobs can run this with the same arguments, on any host that reaches coordination_path:
+        each worker claims one subcube at a time, and subcubes of a worker that died are written again once its
+        lease expires. Failed subcubes go back to the pool up to max_attempts times. See _write_leased_subcube() for
+        how a worker that only lost its lease is kept from committing.
 
-            q = queue.Queue()
+        Every worker process journals its groups in its own file in the pool. The job that finds the pool finished
+        records them all in the write journal and placement catalog, so those are never written from several hosts.
 
-            # stores = [KVStore(zarr.DirectoryStore(path)) for path in dest_groupname]
+        Args:
+            coordination_path (str): Folder shared by all workers, e.g. on a FileDB disk
+            num_processes (int): Worker processes this call starts, so dask and serialization run outside a single
+                GIL. 1 works in this process
+            threads_per_process (int): Workers (subcube writes) per process
+            record_checksums (bool): See distribute_to_filedb()
+            resume (bool): Only put subcubes into a new pool that the write journal does not list as committed
+            lease_seconds (float): See coordinator_utils.WorkPool
+            max_attempts (int): See coordinator_utils.WorkPool
+            write_options: writer, sync_policy, checksums and layout, see write_utils.write_zarr_group()
 
-            dests, _ = self.get_zarr_array_destinations(timestep, range_list)
+        Returns:
+            dict: The pool's status after this call's workers ran out of items, see WorkPool.status()
+        '''
+        pool = WorkPool(coordination_path, lease_seconds, max_attempts)
+        committed = WriteJournal(self.journal_path).load() if resume else {}
+        items = [dict(id=f"{timestep:04d}_{placement['subcube']:03d}", timestep=timestep, index=i,
+                      placement=placement)
+                 for timestep in range(self.start_timestep, self.end_timestep + 1)
+                 for i, placement in self._get_pending_subcubes(timestep, committed)]
+        pool.initialize(items)
+
+        # Leases can expire after every worker stopped claiming, e.g. those of a job that was killed. Their subcubes
+        # are pending again, and claimed by another round of workers
+        while True:
+            if num_processes > 1:
+                processes = [multiprocessing.Process(target=self._work_from_pool,
+                                                     args=(pool, threads_per_process, record_checksums, write_options))
+                             for _ in range(num_processes)]
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+            else:
+                self._work_from_pool(pool, threads_per_process, record_checksums, write_options)
+
+            pending = pool.status()['pending']
+            if not pending:
+                break
+            print(f"{pending} subcubes became pending again, e.g. after their leases expired. Claiming them")
+
+        self._merge_worker_journals(pool)
+        pool.print_status()
+        return pool.status()
+
+    def _work_from_pool(self, pool, num_threads, record_checksums, write_options):
+        """
+        Write subcubes claimed from a WorkPool with num_threads workers. The lazy subcubes of the timesteps this
+        process works on are kept, and workers prefer subcubes of those timesteps. Committed groups go to this
+        process's own journal in the pool, see _merge_worker_journals()
+        """
+        journal = WriteJournal(pool.get_journal_path(coordinator_utils.get_worker_id()))
+        cubes = {}  # timestep -> lazy subcubes of transform_to_zarr()
+        lock = threading.Lock()
+        open_lock = threading.Lock()  # HDF5 fails on NetCDF files opened by several threads at once
+
+        def get_cube(timestep, index):
+            with lock:
+                if timestep in cubes:
+                    return cubes[timestep][index]
+            # Opening a timestep is slow, so workers writing subcubes of open timesteps do not wait for it
+            with open_lock:
+                with lock:
+                    if timestep in cubes:  # Opened by another worker meanwhile
+                        return cubes[timestep][index]
+                timestep_cubes, _ = self.transform_to_zarr(timestep)
+            with lock:
+                if timestep not in cubes and len(cubes) >= num_threads:  # Every worker needs at most one timestep
+                    cubes.pop(next(iter(cubes)))
+                return cubes.setdefault(timestep, timestep_cubes)[index]
+
+        def is_open(item):
+            with lock:
+                return item['timestep'] in cubes
+
+        def get_handler(worker_id):
+            return lambda item: self._write_leased_subcube(pool, worker_id, item,
+                                                           get_cube(item['timestep'], item['index']), journal,
+                                                           record_checksums, write_options)
+
+        worker_ids = [coordinator_utils.get_worker_id(i) for i in range(num_threads)]
+        threads = [threading.Thread(target=coordinator_utils.run_worker,
+                                    args=(pool, worker_id, get_handler(worker_id), is_open))
+                   for worker_id in worker_ids]
+        with write_utils.shared_dask_pool(self.merge_threads):  # Started here, so in the process that uses it
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self._report_memory(coordinator_utils.get_worker_id())
 
-            # Populate the queue with Write to FileDB tasks
-            for i in range(len(dests)):
-                q.put((lazy_zarr_cubes[i], dests[i], self.encoding))
+    def _write_leased_subcube(self, pool, worker_id, item, cube, journal, record_checksums, write_options):
+        """
+        Write the subcube of a work pool item. After its lease was broken, the worker that lost it may still be
+        writing the same group, so each worker stages it under a path of its own. The group is only committed and
+        journaled if the worker still holds the lease right before; renewing it leaves lease_seconds for the rename
 
-            threads = []  # Create threads and start them
-            for _ in range(NUM_THREADS):
-                t = threading.Thread(target=write_utils.write_to_disk, args=(q,))
-                t.start()
-                threads.append(t)
+        Raises:
+            coordinator_utils.LeaseLost: The lease was broken. The staged group is deleted
+        """
+        placement = item['placement']
+        try:
+            committed = write_utils.write_zarr_group(
+                cube, placement['path'], self.encoding, staged=True,
+                staging_path=write_utils.get_staging_path(placement['path'], worker_id),
+                before_commit=lambda: pool.renew(item['id'], worker_id), **write_options)
+        except Exception:
+            if not pool.renew(item['id'], worker_id):  # E.g. the staged group was cleaned up as abandoned
+                raise coordinator_utils.LeaseLost(item['id'])
+            raise
+        if not committed:
+            raise coordinator_utils.LeaseLost(item['id'])
+
+        self._record_written_group(None, journal, placement, record_checksums)
+
+    def _merge_worker_journals(self, pool):
+        """
+        Record the groups committed by all workers of a finished pool in the write journal and the placement
+        catalog. Only one job does this, under the pool's merge lock, so the journal and catalog files have a single
+        writer even when the workers ran on several hosts. Any job can redo it; already journaled groups are skipped
+        and catalog rows are replaced. Groups staged but never committed by workers that died are deleted
+        """
+        if not pool.is_finished():
+            print("Subcubes are still being written by other jobs. The last job to finish records all subcubes in the "
+                  "write journal and placement catalog")
+            return
+
+        with pool.lock('merge', coordinator_utils.get_worker_id(), wait=False) as locked:
+            if not locked:
+                print("Another job is recording the written subcubes in the write journal and placement catalog")
+                return
+
+            placements = {item['placement']['path']: item['placement'] for item in pool.get_items()}
+            entries = [entry for path in pool.list_journal_paths() for entry in WriteJournal(path).load().values()]
+            latest = {}  # Subcubes written twice, after a lease was broken, keep their last write
+            for entry in sorted(entries, key=lambda e: e['committed_at']):
+                if entry['path'] in placements:
+                    latest[entry['path']] = entry
+
+            journal = WriteJournal(self.journal_path)
+            committed = journal.load()
+            for path, entry in latest.items():
+                if committed.get(path, {}).get('byte_size') != entry['byte_size']:
+                    journal.record(entry['timestep'], entry['subcube'], path, entry['byte_size'], entry.get('checksum'))
+            with self.get_catalog() as catalog:
+                catalog.record([dict(placements[path], byte_size=entry['byte_size'], checksum=entry.get('checksum'))
+                                for path, entry in latest.items()])
+            print(f"Recorded {len(latest)} written subcubes in {self.journal_path} and {self.catalog_path}")
+
+            # Groups staged by workers that died, or whose leases were broken, were never committed
+            for path in placements:
+                for staging in glob.glob(glob.escape(path.rstrip('/')) + '.*.partial'):
+                    shutil.rmtree(staging, ignore_errors=True)
+
+    def _distribute_pipelined(self, num_threads, catalog, journal, committed, record_checksums, lookahead,
+                              max_staged_bytes, max_writes_per_disk, write_options):
+        '''
+        Pipelined version of distribute_to_filedb(). One staging thread opens
+        timesteps and queues their subcubes while the writer threads are
+        still busy with earlier ones, so the disks never wait for a timestep
+        to be set up or for the slowest subcube of the previous one.
+
+        At most `lookahead` timesteps are staged ahead of the oldest
+        timestep that has not finished writing. With max_staged_bytes, the
+        staging thread also reads subcubes into memory, overlapping source
+        reads with FileDB writes, and stops staging while queued plus
+        in-flight subcubes would exceed the ceiling.
+        '''
+        scheduler = DiskScheduler(write_utils.list_fileDB_folders(), max_writes_per_disk)
+        budget = write_utils.MemoryBudget(max_staged_bytes)
+        timestep_slots = threading.Semaphore(lookahead + 1)
+        lock = threading.Lock()
+        remaining = {}  # timestep -> nr. of subcubes not yet written
+        staging_errors = []
+
+        def write_subcube(job):
+            cube, placement, nbytes = job
+            try:
+                write_utils.write_zarr_group(cube, placement['path'], self.encoding, staged=True, **write_options)
+                self._record_written_group(catalog, journal, placement, record_checksums)
+            finally:
+                budget.release(nbytes)
+
+                timestep = placement['timestep']
+                with lock:
+                    remaining[timestep] -= 1
+                    timestep_finished = remaining[timestep] == 0
+                if timestep_finished:
+                    depths = {disk: depth for disk, depth in scheduler.queue_depths().items() if depth}
+                    print(f"Finished timestep {timestep}. Queued subcubes per disk: {depths}")
+                    timestep_slots.release()
+
+        def stage():
+            try:
+                for timestep in range(self.start_timestep, self.end_timestep + 1):
+                    pending = self._get_pending_subcubes(timestep, committed)
+                    if not pending:
+                        print(f"All subcubes of timestep {timestep} are already committed, skipping")
+                        continue
+
+                    timestep_slots.acquire()
+                    print(f"Staging timestep {timestep}")
+                    lazy_zarr_cubes, _ = self.transform_to_zarr(timestep)
+                    with lock:
+                        remaining[timestep] = len(pending)
+
+                    for i, placement in pending:
+                        cube = lazy_zarr_cubes[i]
+                        nbytes = cube.nbytes if max_staged_bytes is not None else 0
+                        budget.acquire(nbytes)
+                        if max_staged_bytes is not None:
+                            cube = cube.load()  # Read the source now, while earlier subcubes are being written
+                        scheduler.submit(placement['disk'], (cube, placement, nbytes))
+            except Exception as e:
+                staging_errors.append(e)
+                print(f"Error staging data: {e}")
+            finally:
+                scheduler.close()  # Writers exit once everything staged so far is written
+
+        stager = threading.Thread(target=stage)
+        stager.start()
+        scheduler.run(num_threads, write_subcube)
+        stager.join()
+
+        self._report_failed_writes(scheduler)
+        if staging_errors:
+            raise staging_errors[0]
+
+    def _distribute_slabs(self, num_threads, catalog, journal, committed, record_checksums, max_slab_bytes,
+                          max_writes_per_disk, write_options):
+        '''
+        Slab-streaming version of distribute_to_filedb(). The Zarr
+        metadata of every pending group is written first, from the same
+        lazy subcubes the dask path writes. A reader thread then streams
+        each source file in slabs (see slab_utils) while the writers fill
+        in the chunks of every group a slab covers. Groups are committed
+        once their last piece is written.
+        '''
+        def sources():
+            for timestep in range(self.start_timestep, self.end_timestep + 1):
+                pending = self._get_pending_subcubes(timestep, committed)
+                if not pending:
+                    print(f"All subcubes of timestep {timestep} are already committed, skipping")
+                    continue
+
+                lazy_zarr_cubes, range_list = self.transform_to_zarr(timestep)
+                groups = []
+                for i, placement in pending:
+                    staging = write_utils.get_staging_path(placement['path'])
+                    if os.path.exists(staging):
+                        shutil.rmtree(staging)
+                    lazy_zarr_cubes[i].to_zarr(staging, mode='w', encoding=self.encoding, compute=False)
+
+                    ranges = {dim: tuple(r) for dim, r in zip(self.split_dims, range_list[i])}
+                    groups.append(dict(ranges=ranges, path=staging, disk=placement['disk'], placement=placement))
+
+                out_dims = lazy_zarr_cubes[0]['energy'].dims[:3]
+                yield self._get_source_file(timestep), self.source_variables, out_dims, groups
+
+        failed = []
+
+        def commit_group(group, error):
+            placement = group['placement']
+            if error is not None:
+                failed.append((placement['path'], error))
+                return
+            try:
+                if write_options['checksums']:
+                    checksum_utils.write_manifest(group['path'])
+                shard_utils.convert_in_place(group['path'], write_options['layout'])
+                write_utils.commit_staged_group(group['path'], placement['path'],
+                                                sync=write_options['sync_policy'] != 'none')
+                self._record_written_group(catalog, journal, placement, record_checksums)
+            except Exception as e:
+                failed.append((placement['path'], e))
+
+        stats = slab_utils.stream_slabs_to_groups(sources(), self.desired_zarr_array_length,
+                                                  self.desired_zarr_chunk_size, num_threads, max_slab_bytes,
+                                                  max_writes_per_disk, on_group_done=commit_group,
+                                                  writer=write_options['writer'],
+                                                  sync_policy=write_options['sync_policy'])
+        print(f"Read {stats['bytes_read'] / 1024 ** 3:.2f} GB of source data")
+
+        if failed:
+            print(f"{len(failed)} subcubes failed to write:")
+            for path, error in failed:
+                print(path, error)
+
+    def verify_against_source(self, NUM_THREADS=34, sample_fraction=1.0, max_slab_bytes=8 * 1024 ** 3,
+                              max_reads_per_disk=1, seed=0):
+        '''
+        Compare the written Zarr groups of start_timestep..end_timestep
+        (of this Dataset's write_mode) with the source files. Each source
+        file is streamed once while the groups are read in parallel per
+        FileDB disk, see verify_utils.verify_against_source()
 
-            q.join()  # Wait for all tasks to be processed
+        Args:
+            NUM_THREADS (int): Nr. of comparison threads
+            sample_fraction (float): 1 compares every chunk. Below 1, only this fraction of each group's chunks
+                is read and compared, for quick spot checks
+            max_slab_bytes (int): Memory budget for source data read but not yet compared
+            max_reads_per_disk (int or dict): How many groups may be read from the same FileDB disk at once
+            seed (int): Seed of the chunk sample
 
-            for t in threads:  # Wait for all threads to finish
-                t.join()
+        Returns:
+            verify_utils.VerificationReport: Chunks compared, and every mismatch with its chunk coordinates
+        '''
+        def sources():
+            for timestep in range(self.start_timestep, self.end_timestep + 1):
+                lazy_zarr_cubes, range_list = self.transform_to_zarr(timestep)
+                # Where the groups were actually written, if recorded. Same preference as get_zarr_paths()
+                recorded = {}
+                if os.path.exists(self.catalog_path):
+                    with self.get_catalog() as catalog:
+                        recorded = {placement['subcube']: placement
+                                    for placement in catalog.get_placements(self.name, self.write_mode, timestep)}
+
+                groups = []
+                for i, placement in enumerate(self.get_subcube_placements(timestep, range_list)):
+                    placement = recorded.get(placement['subcube'], placement)
+                    # Halos are read from each group, so groups are compared whatever halo they were written with
+                    stored_ranges = verify_utils.get_stored_ranges(placement['path'], range_list[i])
+                    ranges = {dim: tuple(r) for dim, r in zip(self.split_dims, stored_ranges)}
+                    groups.append(dict(ranges=ranges, path=placement['path'], disk=placement['disk'],
+                                       timestep=timestep))
+
+                out_dims = lazy_zarr_cubes[0]['energy'].dims[:3]
+                yield self._get_source_file(timestep), self.source_variables, out_dims, groups
+
+        report = verify_utils.verify_against_source(sources(), self.desired_zarr_array_length,
+                                                    self.desired_zarr_chunk_size, NUM_THREADS, max_slab_bytes,
+                                                    max_reads_per_disk, sample_fraction, seed)
+        report.print_report()
+
+        return report
+
+    def _get_source_file(self, timestep: int) -> str:
+        """Path of the source file of a timestep. Needed by the slab ingest"""
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _get_pending_subcubes(self, timestep, committed):
+        """
+        Subcubes of a timestep that still need writing. Computed without opening the source data
+
+        Args:
+            timestep (int): timestep of the dataset
+            committed (dict): Write journal entries by path, see WriteJournal.load(). Empty to write everything
+
+        Returns:
+            list[tuple[int, dict]]: (index into transform_to_zarr() cubes, placement) of every subcube to write
+        """
+        placements = self.get_subcube_placements(timestep, self.get_range_list())
+
+        return [(i, placement) for i, placement in enumerate(placements)
+                if not WriteJournal.is_committed(committed.get(placement['path']), placement['path'])]
+
+    def _report_memory(self, label: str):
+        """Print the peak resident memory of this process so far"""
+        print(f"Peak resident memory after {label}: {write_utils.get_peak_rss() / 1024 ** 3:.2f} GB")
 
+    @staticmethod
+    def _report_failed_writes(scheduler):
+        if scheduler.errors:
+            print(f"{len(scheduler.errors)} subcubes failed to write:")
+            for job, error in scheduler.errors:
+                print(job[1]['path'], error)
 
-    def create_backup_copy(self, NUM_THREADS=34):
+    def _record_written_group(self, catalog, journal, placement, record_checksums=False):
+        """
+        Record a freshly committed Zarr group in the write journal and the placement catalog. Without a catalog
+        (coordinated workers) the journal keeps the checksum for _merge_worker_journals()
+        """
+        dest = placement['path']
+        placement = dict(placement, byte_size=get_directory_size(dest))
+        if record_checksums:
+            placement['checksum'] = get_directory_checksum(dest)
+        journal.record(placement['timestep'], placement['subcube'], dest, placement['byte_size'],
+                       placement.get('checksum'))
+
+        if catalog is not None:
+            catalog.record(placement)
+
+    def create_backup_copy(self, NUM_THREADS=34, max_copies_per_disk=1, incremental=False, compare_hashes=False,
+                           dry_run=False):
         '''
         Write the backup copy of the dataset to FileDB, and shift
         the nodes by one, so prod and backup copies live on different
         disks. Make sure `prod` data is correct by running the tests/
         before running this function! Modified from ChatGPT
 
+        Groups are copied file by file, scheduled per (source disk,
+        destination disk) pair, with reflinks or in-kernel copies where
+        the filesystems allow, see copy_utils.copy_trees(). A backup group
+        is only replaced once its new copy is complete
+
         Args:
             NUM_THREADS (int): Number of threads to use when writing to
             disk. Currently 34 to match nr. of disks on FileDB
+            max_copies_per_disk (int or dict): Concurrent file copies per
+                FileDB disk, counted on both the source and the destination
+            incremental (bool): Update existing backup folders in place,
+                copying only files that are missing or differ in size or
+                mtime and deleting orphans, see copy_utils.sync_trees()
+            compare_hashes (bool): Incremental only. Also compare files
+                whose size and mtime match by checksum
+            dry_run (bool): Incremental only. Print how many files and
+                bytes would be copied and deleted, and change nothing
         '''
+        if (compare_hashes or dry_run) and not incremental:
+            raise ValueError("compare_hashes and dry_run need incremental=True")
 
         warnings.warn("Make sure the production dataset is "
                       "correct! This function simply copies the production "
@@ -146,25 +832,10 @@ class Dataset(ABC):
                       "propagated. Make sure to run all tests before creating "
                       "this backup copy!", Warning)
 
-        def worker(q):
-            """Thread worker function to copy directories and overwrite existing ones."""
-            while True:
-                try:
-                    src_path, dest_path = q.get_nowait()
-                    print(f"Copying {src_path} to {dest_path}")
-                    # Check if the destination path exists and remove it if it does
-                    if os.path.exists(dest_path):
-                        shutil.rmtree(dest_path)
-                    shutil.copytree(src_path, dest_path, dirs_exist_ok=True)
-                    q.task_done()
-                except queue.Empty:
-                    break
-                except Exception as e:
-                    print(f"Error copying {src_path} to {dest_path}: {e}")
-                    q.task_done()
+        copied = []  # (src_path, dest_path, dest FileDB folder) of every successful copy
 
         filedb_folders = write_utils.list_fileDB_folders()
-        q = queue.Queue()
+        trees = []
 
         for i in range(len(filedb_folders)):
             current_dir = filedb_folders[i]
@@ -177,21 +848,123 @@ class Dataset(ABC):
                     # Replace '_prod' with '_back' in folder name
                     dest_folder = folder.replace('_prod', '_back')
                     dest_path = os.path.join(next_dir, dest_folder)
-                    q.put((src_path, dest_path))
-
-        threads = []
-        for _ in range(NUM_THREADS):
-            t = threading.Thread(target=worker, args=(q,))
-            t.start()
-            threads.append(t)
+                    if incremental:
+                        trees.append((src_path, dest_path, current_dir, next_dir))
+                        continue
 
-        q.join()  # Block until all tasks are done
+                    print(f"Copying {src_path} to {dest_path}")
+                    os.makedirs(dest_path, exist_ok=True)
+
+                    # Groups still being written (or replaced) in prod are not copied
+                    entries = [entry for entry in os.listdir(src_path)
+                               if not entry.endswith(copy_utils.SKIPPED_SUFFIXES)]
+                    # The backup folder mirrors the prod folder, so drop what prod no longer has
+                    for stale in set(os.listdir(dest_path)) - set(entries):
+                        stale_path = os.path.join(dest_path, stale)
+                        shutil.rmtree(stale_path) if os.path.isdir(stale_path) else os.remove(stale_path)
+
+                    for entry in entries:
+                        if os.path.isdir(os.path.join(src_path, entry)):
+                            trees.append((os.path.join(src_path, entry), os.path.join(dest_path, entry),
+                                          current_dir, next_dir))
+                        else:
+                            copy_utils.copy_file(os.path.join(src_path, entry), os.path.join(dest_path, entry))
+
+        on_copied = lambda src, dest, disk: copied.append((src, dest, disk))
+        if incremental:
+            _, stats = copy_utils.sync_trees(trees, NUM_THREADS, max_copies_per_disk, compare_hashes=compare_hashes,
+                                             dry_run=dry_run, on_tree_synced=on_copied)
+            if dry_run:
+                return
+        else:
+            stats = copy_utils.copy_trees(trees, NUM_THREADS, max_copies_per_disk, on_tree_copied=on_copied)
+        stats.print_report()
+        if stats.errors:
+            print(f"{len(stats.errors)} files failed to copy:")
+            for src, error in stats.errors:
+                print(src, error)
 
-        for t in threads:
-            t.join()  # Make sure all threads have finished
+        self._record_backup_placements(copied)
 
         print("Backup creation completed.")
 
+    def _record_backup_placements(self, copied):
+        """
+        Add the backup copies to the placement catalog, derived from the catalog rows of the `prod` groups they were
+        copied from
+
+        Args:
+            copied (list): (src_path, dest_path, dest FileDB folder) of every copied `_prod` folder or group
+        """
+        if not os.path.exists(self.catalog_path):
+            return
+
+        with self.get_catalog() as catalog:
+            prod_placements = catalog.get_placements(self.name, 'prod')
+            backup_placements = []
+            for src_path, dest_path, dest_dir in copied:
+                src_path = src_path.rstrip('/')
+                for placement in prod_placements:
+                    path = placement['path'].rstrip('/')
+                    if path == src_path or path.startswith(src_path + '/'):
+                        backup_placements.append(dict(
+                            placement, write_mode='back', disk=dest_dir,
+                            path=dest_path.rstrip('/') + path[len(src_path):]))
+
+            catalog.record(backup_placements)
+
+
+    def write_time_chunked(self, variables=('velocity',), chunk_length=timeseries_utils.DEFAULT_TIME_CHUNK_LENGTH,
+                           NUM_THREADS=34, max_writes_per_disk=1):
+        """
+        Write the time-chunked companion layout of start_timestep..end_timestep: per subcube one group next to its
+        timestep groups, whose arrays have the timesteps as 4th axis. For datasets where temporal queries dominate;
+        it doubles the space the timesteps take. Jobs writing other timestep ranges write companions of their own,
+        see get_time_chunked_path(). See timeseries_utils.write_time_chunked_group()
+
+        Args:
+            variables (tuple[str]): Variables to write
+            chunk_length (int): Spatial chunk length. Chunks span all timesteps
+            NUM_THREADS (int): Number of subcubes written at once
+            max_writes_per_disk (int or dict): See scheduler_utils.DiskScheduler
+        """
+        timesteps = list(range(self.start_timestep, self.end_timestep + 1))
+        paths = {}  # subcube -> path of every timestep
+        for timestep in timesteps:
+            for placement in self.get_placements(timestep):
+                paths.setdefault(placement['subcube'], []).append(placement['path'])
+
+        scheduler = DiskScheduler(write_utils.list_fileDB_folders(), max_writes_per_disk)
+        for placement in self.get_placements(self.start_timestep):
+            companion = dict(placement, path=self.get_time_chunked_path(placement, self.start_timestep,
+                                                                         self.end_timestep))
+            scheduler.submit(placement['disk'], (paths[placement['subcube']], companion))
+        scheduler.close()
+
+        scheduler.run(NUM_THREADS, lambda job: timeseries_utils.write_time_chunked_group(
+            job[0], timesteps, job[1]['path'], variables, chunk_length))
+        self._report_failed_writes(scheduler)
+
+    def convert_layout(self, layout, NUM_THREADS=34, max_writes_per_disk=1):
+        """
+        Convert the written Zarr groups of start_timestep..end_timestep to a layout, e.g. 'sharded' to pack the
+        2,048 chunk files of a group into one shard file per variable. Each group is converted next to itself and
+        replaces the original once complete. Groups that already have the layout are left alone
+
+        Args:
+            layout (str): 'directory' or 'sharded', see shard_utils
+            NUM_THREADS (int): Number of groups converted at once
+            max_writes_per_disk (int or dict): See scheduler_utils.DiskScheduler
+        """
+        scheduler = DiskScheduler(write_utils.list_fileDB_folders(), max_writes_per_disk)
+        for timestep in range(self.start_timestep, self.end_timestep + 1):
+            for placement in self.get_placements(timestep):
+                if os.path.exists(placement['path']):
+                    scheduler.submit(placement['disk'], (layout, placement))
+        scheduler.close()
+
+        scheduler.run(NUM_THREADS, lambda job: shard_utils.convert_in_place(job[1]['path'], job[0]))
+        self._report_failed_writes(scheduler)
 
     def delete_backup_directories(self, NUM_THREADS=34):
         """
@@ -269,15 +1042,17 @@ class NCAR_Dataset(Dataset):
     """
 
     def __init__(self, name, location_paths, desired_zarr_chunk_size, desired_zarr_array_length, write_mode,
-                 start_timestep, end_timestep):
+                 start_timestep, end_timestep, catalog_path=None, write_settings=None):
         super().__init__(name, location_paths, desired_zarr_chunk_size, desired_zarr_array_length, write_mode,
-                         start_timestep, end_timestep)
+                         start_timestep, end_timestep, catalog_path, write_settings)
 
         self.file_extension = '.nc'
         self.NCAR_files = []
         for path in self.location_paths:
             self.NCAR_files += glob.glob(os.path.join(path, f'*{self.file_extension}'))
         self.original_array_length = 2048
+        # Output variable -> NetCDF variables it is made of, read by the slab ingest
+        self.source_variables = {'velocity': ['u', 'v', 'w'], 'energy': ['e'], 'temperature': ['t'], 'pressure': ['p']}
 
     def transform_to_zarr(self, timestep: int) -> tuple[list, list]:
         """
@@ -294,28 +1069,15 @@ class NCAR_Dataset(Dataset):
             - Merging velocity components
             - Splitting into smaller chunks (64^3 or desired_zarr_chunk_size^3)
             - Unabbreviating variable names
-            - Splitting 2048^3 arrays into 512^3 chunks (original_array_length -> desired_zarr_array_length)
+            - Splitting 2048^3 arrays into 512^3 chunks (original_array_length -> desired_zarr_array_length), each
+              with self.halo cells of its neighbors on every side
 
         This function deals with the intricaties of the NCAR dataset. It is not meant to be used for other datasets.
         """
         # TODO The variable names are hard-coded
 
-        def select_file(file_list, timestep):
-            for full_path in file_list:
-                # Extract the filename from the full path
-                filename = os.path.basename(full_path)
-
-                # Extract the number from the filename using a more specific regular expression
-                match = re.search(r'jhd\.(\d+)\.nc', filename)
-                if match:
-                    file_timestep = int(match.group(1))
-                    if file_timestep == timestep:
-                        return full_path
-            # If no file is found, raise an exception
-            raise FileNotFoundError(f"No file found for timestep {timestep}")
-        
         # Open the dataset using xarray
-        data_xr = xr.open_dataset(select_file(self.NCAR_files,timestep),
+        data_xr = xr.open_dataset(self._get_source_file(timestep),
                                   chunks={'nnz': self.desired_zarr_chunk_size, 'nny': self.desired_zarr_chunk_size,
                                           'nnx': self.desired_zarr_chunk_size})
 
@@ -331,19 +1093,38 @@ class NCAR_Dataset(Dataset):
 
         # Group 3 velocity components together
         # Never use dask with remote network location on this!!
-        merged_velocity = write_utils.merge_velocities(transposed_ds, chunk_size_base=self.desired_zarr_chunk_size)
+        if self.velocity_merge == 'blockwise':
+            merged_velocity = write_utils.merge_velocities_blockwise(transposed_ds, self.desired_zarr_chunk_size)
+        else:
+            merged_velocity = write_utils.merge_velocities(transposed_ds, chunk_size_base=self.desired_zarr_chunk_size)
 
         # TODO this is also hard-coded
         merged_velocity = merged_velocity.rename({'e': 'energy', 't': 'temperature', 'p': 'pressure'})
 
         dims = [dim for dim in data_xr.dims]
         dims.reverse()  # use (nnz, nny, nnx) instead of (nnx, nny, nnz)
+        self.split_dims = dims  # Dimension order of range_list
 
         # Split 2048^3 into smaller 512^3 arrays
-        smaller_groups, range_list = write_utils.split_zarr_group(merged_velocity, self.desired_zarr_array_length, dims)
+        smaller_groups, range_list = write_utils.split_zarr_group(merged_velocity, self.desired_zarr_array_length, dims,
+                                                                  self.halo, self.desired_zarr_chunk_size)
 
         return smaller_groups, range_list
 
+    def _get_source_file(self, timestep: int) -> str:
+        for full_path in self.NCAR_files:
+            # Extract the filename from the full path
+            filename = os.path.basename(full_path)
+
+            # Extract the number from the filename using a more specific regular expression
+            match = re.search(r'jhd\.(\d+)\.nc', filename)
+            if match:
+                file_timestep = int(match.group(1))
+                if file_timestep == timestep:
+                    return full_path
+        # If no file is found, raise an exception
+        raise FileNotFoundError(f"No file found for timestep {timestep}")
+
     def _get_data_cube_side(self, data_xarray: xr.Dataset) -> int:
         """
         Gets the side length of one 3D cube for the NCAR dataset (private method)
@@ -384,20 +1165,19 @@ class NCAR_Dataset(Dataset):
 
         chunk_morton_mapping = write_utils.get_chunk_morton_mapping(range_list, self.name)
         # print("chunk_morton_mapping name: ", chunk_morton_mapping)
-        flattened_node_assgn = write_utils.flatten_3d_list(write_utils.node_assignment(4))
+        # Cached, so this is only computed once per (cube side, nr. of disks)
+        num_subcubes_per_side = self.original_array_length // self.desired_zarr_array_length
+        flattened_node_assgn = write_utils.flatten_3d_list(
+            write_utils.node_assignment(num_subcubes_per_side, num_disks=len(folders)))
+
+        # Morton ranges are unique per subarray, so invert the mapping once instead of searching it for every subarray
+        chunk_names_by_morton = {morton: chunk_name for chunk_name, morton in chunk_morton_mapping.items()}
+        min_codes, max_codes = write_utils.get_range_morton_codes(range_list, self.original_array_length)
 
         dests = []
 
         for i in range(len(range_list)):
-            min_coord = [a[0] for a in range_list[i]]
-            max_coord = [a[1] - 1 for a in range_list[i]]
-
-            morton = (write_utils.morton_pack(self.original_array_length, min_coord[0], min_coord[1], min_coord[2]),
-                      write_utils.morton_pack(self.original_array_length, max_coord[0], max_coord[1], max_coord[2]))
-
-            chunk_name = write_utils.search_dict_by_value(chunk_morton_mapping, morton)
-            # print("Chunk name: ", chunk_name)
-            # raise Exception
+            chunk_name = chunk_names_by_morton[(int(min_codes[i]), int(max_codes[i]))]
 
             idx = int(chunk_name[-2:].lstrip('0'))
 
@@ -28,9 +28,96 @@ if __name__ == "__main__":
                              'timesteps can be processed at once. Only required for prod write_mode.')
     parser.add_argument('-et', '--end_timestep', type=int, required=False,
                         help='Timestep to end processing at (inclusive). See -st for more info. Only required for prod write_mode.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Pipelined prod writes: stage the next timestep while the current one is still being '
+                             'written, streaming writes across the whole -st..-et range')
+    parser.add_argument('--lookahead', type=int, default=1,
+                        help='With --pipeline, how many timesteps may be staged ahead of the one being written')
+    parser.add_argument('--max_staged_gb', type=float, required=False,
+                        help='With --pipeline, read subcubes into memory ahead of the writers, holding at most this '
+                             'many GB. Without it, look-ahead subcubes stay lazy')
+    parser.add_argument('--max_writes_per_disk', type=int, required=False,
+                        help='How many subcubes (prod) or files (back) may be written to the same FileDB disk at '
+                             'once. Defaults to write_settings.max_writes_per_disk in config.yaml')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted prod write: skip subcubes the write journal lists as committed '
+                             'and that still match it on disk')
+    parser.add_argument('--ingest', type=str, choices=['dask', 'slab'], default='dask',
+                        help='How prod writes read the NetCDF files. "slab" streams each file in large contiguous '
+                             'slabs instead of many small dask chunk reads, and streams across the whole -st..-et '
+                             'range (--pipeline is not needed)')
+    parser.add_argument('--max_slab_gb', type=float, default=8,
+                        help='With --ingest slab, memory budget in GB for slabs read but not yet written')
+    parser.add_argument('--writer', type=str, choices=['xarray', 'raw'], required=False,
+                        help='How prod writes create Zarr chunks. "raw" writes the chunk files of uncompressed '
+                             'groups directly instead of through to_zarr(), byte-identical. Defaults to '
+                             'write_settings.writer in config.yaml')
+    parser.add_argument('--sync_policy', type=str, choices=['none', 'fsync', 'direct'], required=False,
+                        help='Durability of prod writes: "none" leaves data to the page cache, "fsync" fsyncs every '
+                             'subcube before committing it, "direct" also writes raw chunks with O_DIRECT. '
+                             'Defaults to write_settings.sync_policy in config.yaml')
+    parser.add_argument('--chunk_checksums', action=argparse.BooleanOptionalAction, default=None,
+                        help='Store a checksum of every chunk in each prod group, so prod and back copies can be '
+                             'verified without the source (tests/test_zarr_checksums.py). Re-reads every chunk. '
+                             '--no-chunk_checksums turns them off. Defaults to write_settings.chunk_checksums in '
+                             'config.yaml')
+    parser.add_argument('--codec', type=str, required=False,
+                        help='Codec preset for all variables, e.g. blosc-lz4 or blosc-zstd-bitshuffle (see '
+                             'utils/codec_utils.py). Overrides write_settings.desired_zarr_compressor and '
+                             'variable_codecs in config.yaml')
+    parser.add_argument('--halo', type=int, required=False,
+                        help='Also store this many cells of the neighboring subcubes on every side of each prod group, '
+                             'so 8^3 stencils never need a second group (4 for 8^3). Dask ingest only. Defaults to '
+                             'write_settings.halo in config.yaml')
+    parser.add_argument('--velocity_merge', type=str, choices=['dask', 'blockwise'], required=False,
+                        help='How u, v and w are merged into velocity. "blockwise" builds every velocity chunk '
+                             'straight from its components, without rechunked intermediates. Defaults to '
+                             'write_settings.velocity_merge in config.yaml')
+    parser.add_argument('--merge_threads', type=int, required=False,
+                        help='With blockwise velocity merge, dask threads shared by all writer threads of a process, '
+                             'so at most this many velocity chunks are merged at once. Defaults to '
+                             'write_settings.merge_threads in config.yaml')
+    parser.add_argument('--layout', type=str, choices=['directory', 'sharded'], required=False,
+                        help='On-disk layout of prod groups. "sharded" packs the chunk files of each variable into '
+                             'one shard file with an offset index, about 15 files per group instead of 2,048 (see '
+                             'utils/shard_utils.py). Defaults to write_settings.layout in config.yaml')
+    parser.add_argument('--convert_layout', action='store_true',
+                        help='With prod write_mode, convert the already written groups of -st..-et to --layout '
+                             'instead of writing them')
+    parser.add_argument('--coordinator', type=str, required=False,
+                        help='Folder on shared storage through which prod writes are shared: every job started with '
+                             'the same -st..-et and --coordinator claims subcubes from one work pool, so a dataset '
+                             'can be spread over several jobs and hosts (see utils/coordinator_utils.py)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='With --coordinator, worker processes this job starts')
+    parser.add_argument('--threads_per_process', type=int, default=4,
+                        help='With --coordinator, subcubes each worker process writes at once')
+    parser.add_argument('--lease_seconds', type=float, default=600,
+                        help='With --coordinator, after how long without a heartbeat a claimed subcube is given to '
+                             'another worker')
+    parser.add_argument('--time_chunked', action='store_true',
+                        help='After a prod write, also write the time-chunked companion layout of the -st..-et range: '
+                             'per subcube one group holding its timesteps, for datasets where temporal queries '
+                             'dominate. Every -st..-et range gets its own. Not with --coordinator or '
+                             '--convert_layout. See utils/timeseries_utils.py')
+    parser.add_argument('--incremental', action='store_true',
+                        help='With back write_mode, only copy files that are missing from the backup or differ in '
+                             'size or mtime, and delete files prod no longer has')
+    parser.add_argument('--compare_hashes', action='store_true',
+                        help='With --incremental, also compare files with the same size and mtime by checksum')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='With --incremental, only report how many files and bytes would be copied and deleted')
+    parser.add_argument('--catalog_path', type=str, required=False,
+                        help='Placement catalog (SQLite) recording where each subcube is written, with the write '
+                             'journal for --resume next to it. Defaults to placement_catalog.sqlite on the first '
+                             'FileDB folder. Keep it on persistent storage that every job reaches. Jobs writing at '
+                             'the same time must share a --coordinator, so only one of them writes the catalog')
 
     # TODO Do some checking
     args = parser.parse_args()
+    if args.time_chunked and (args.write_mode != 'prod' or args.coordinator is not None or args.convert_layout):
+        parser.error('--time_chunked is only written after a prod write without --coordinator or --convert_layout. '
+                     'Once all subcubes of -st..-et are written, run them again with --resume --time_chunked')
     DATASET_NAME = args.name
     # LOCATION_PATHS = args.paths
     ZARR_CHUNK_SIDE = args.zarr_chunk_size
@@ -48,17 +135,57 @@ if __name__ == "__main__":
     #         raise ValueError("DATASET_NAME not found in config.yaml")
     LOCATION_PATHS = config['datasets'][DATASET_NAME]['location_paths']
 
+    write_settings = dict(config['write_settings'])
+    if args.codec is not None:
+        write_settings.update(desired_zarr_compressor=args.codec, desired_zarr_filters=None, variable_codecs=None)
+    if args.halo is not None:
+        write_settings.update(halo=args.halo)
+    if args.velocity_merge is not None:
+        write_settings.update(velocity_merge=args.velocity_merge)
+    if args.merge_threads is not None:
+        write_settings.update(merge_threads=args.merge_threads)
+
     ncar_dataset = NCAR_Dataset(name=DATASET_NAME,
                                 location_paths=LOCATION_PATHS,
                                 desired_zarr_chunk_size=ZARR_CHUNK_SIDE,
                                 desired_zarr_array_length=desired_cube_side,
                                 write_mode=WRITE_MODE,
                                 start_timestep=start_timestep,
-                                end_timestep=end_timestep)
+                                end_timestep=end_timestep,
+                                catalog_path=args.catalog_path,
+                                write_settings=write_settings)
+
+    max_writes_per_disk = args.max_writes_per_disk
+    if max_writes_per_disk is None:
+        max_writes_per_disk = config['write_settings'].get('max_writes_per_disk', 1)
 
     if WRITE_MODE == 'prod':
-        ncar_dataset.distribute_to_filedb()
+        max_staged_bytes = int(args.max_staged_gb * 1024 ** 3) if args.max_staged_gb is not None else None
+        writer = args.writer or config['write_settings'].get('writer', 'xarray')
+        sync_policy = args.sync_policy or config['write_settings'].get('sync_policy', 'none')
+        chunk_checksums = args.chunk_checksums
+        if chunk_checksums is None:
+            chunk_checksums = config['write_settings'].get('chunk_checksums', False)
+        layout = args.layout or config['write_settings'].get('layout', 'directory')
+        if args.convert_layout:
+            ncar_dataset.convert_layout(layout, max_writes_per_disk=max_writes_per_disk)
+        elif args.coordinator is not None:
+            ncar_dataset.distribute_coordinated(args.coordinator, num_processes=args.processes,
+                                                threads_per_process=args.threads_per_process, resume=args.resume,
+                                                lease_seconds=args.lease_seconds, writer=writer,
+                                                sync_policy=sync_policy, checksums=chunk_checksums, layout=layout)
+        else:
+            ncar_dataset.distribute_to_filedb(pipelined=args.pipeline, lookahead=args.lookahead,
+                                              max_staged_bytes=max_staged_bytes,
+                                              max_writes_per_disk=max_writes_per_disk,
+                                              resume=args.resume, ingest=args.ingest,
+                                              max_slab_bytes=int(args.max_slab_gb * 1024 ** 3), writer=writer,
+                                              sync_policy=sync_policy, chunk_checksums=chunk_checksums, layout=layout)
+            if args.time_chunked:
+                ncar_dataset.write_time_chunked(variables=('velocity', 'energy', 'temperature', 'pressure'),
+                                                max_writes_per_disk=max_writes_per_disk)
     elif WRITE_MODE == 'back':
-        ncar_dataset.create_backup_copy()
+        ncar_dataset.create_backup_copy(max_copies_per_disk=max_writes_per_disk, incremental=args.incremental,
+                                        compare_hashes=args.compare_hashes, dry_run=args.dry_run)
     elif WRITE_MODE == 'delete_back':
         ncar_dataset.delete_backup_directories()
@@ -1,5 +1,7 @@
 import numpy as np
 
+from . import interpolation_utils, stencil_utils
+
 
 def sequential_8_interpolation(array, cube_shape, low=4, high=60, size=50):
     """
@@ -13,10 +15,14 @@ def sequential_8_interpolation(array, cube_shape, low=4, high=60, size=50):
         bottom-right chunk of array. Needs to be <= len(array)
             - 4 for 8-interpolation
     :param size: number of points to pick and around which to interpolate
+    :return: list of the 8x8x8 neighborhoods read, one per point
     """
 
+    neighborhoods = []
     for index in range(low, min(high, low + size)):
-        _ = array[index - 4:index + 4, index - 4:index + 4, index - 4:index + 4]
+        neighborhoods.append(array[index - 4:index + 4, index - 4:index + 4, index - 4:index + 4])
+
+    return neighborhoods
 
 
 def create_random_indices(cube_shape, low=4, high=60, size=50):
@@ -41,16 +47,44 @@ def index_8_interpolation(array, rand_indices):
     Random Lagrangian 8-interpolation of array. Points picked uniformly at random between [low, high]
     :param array: array to be interpolated, forming an 8x8x8 cube
     :param rand_indices: list or array of indices to interpolate around in the given array
+    :return: list of the 8x8x8 neighborhoods read, one per point
     """
 
     # Can't generate random indices this here bcs. it penalizes
     #   Single-variable experiments (ran 3 times vs. once for joint)
 
+    neighborhoods = []
     for index in range(len(rand_indices)):
         x = rand_indices[index][0]
         y = rand_indices[index][1]
         z = rand_indices[index][2]
-        _ = array[x - 4:x + 4, y - 4:y + 4, z - 4:z + 4]
+        neighborhoods.append(array[x - 4:x + 4, y - 4:y + 4, z - 4:z + 4])
+
+    return neighborhoods
+
+
+def batched_8_interpolation(array, rand_indices):
+    """
+    Same neighborhoods as index_8_interpolation(), gathered in one batch that
+        reads every touched chunk once, see stencil_utils.gather_stencils()
+    :param array: Zarr array to be interpolated
+    :param rand_indices: (N, 3) array of indices to interpolate around in the given array
+    :return: (N, 8, 8, 8, ...) array of the neighborhoods
+    """
+
+    return stencil_utils.gather_stencils(array, rand_indices, side=8)
+
+
+def lagrangian_8_interpolation(array, positions):
+    """
+    Lagrangian 8-interpolation of array at fractional positions, see
+        interpolation_utils.interpolate() for orders 4 and 6
+    :param array: Zarr array to be interpolated
+    :param positions: (N, 3) fractional grid positions to interpolate at
+    :return: (N, ...) array of the interpolated values
+    """
+
+    return interpolation_utils.interpolate(array, positions, order=8)
 
 
 def access_1_velocity_from_joint(xarray_arr, rand_indices):
@@ -59,7 +93,9 @@ def access_1_velocity_from_joint(xarray_arr, rand_indices):
         store = xarray.open_zarr(path), then use
         slice_3d = store.isel({'velocity component (xyz)': 0})
     :param rand_indices: list or array of indices to interpolate around in the given array
+    :return: list of the 8x8x8 subsets, one per point. Lazy if xarray_arr is
     """
+    subsets = []
     for row in rand_indices:
         # Define the slice
         slice_nnx = slice(row[0] - 4, row[0] + 4)
@@ -69,4 +105,6 @@ def access_1_velocity_from_joint(xarray_arr, rand_indices):
         # Access a 3D subset of the array
         subset_3d = xarray_arr.isel(nnx=slice_nnx, nny=slice_nny, nnz=slice_nnz)
 
-        _ = subset_3d.to_array().squeeze()
+        subsets.append(subset_3d.to_array().squeeze())
+
+    return subsets
@@ -0,0 +1,335 @@
+"""
+    Process-wide LRU cache of Zarr chunk files, plugged in as a store wrapper over the FileDB directory stores.
+
+    Interpolation and visualization jobs keep coming back to the same regions, and every zarr.open_group() reads the
+    same chunk files from the spinning disks again. CachingStore serves chunk files from a ChunkCache shared by every
+    store of the process: a byte-budgeted in-memory LRU tier, and optionally a spill tier of files on a local SSD
+    that chunks evicted from memory move to. With read_ahead, a miss also fetches the next chunks of the same array
+    in Morton order in the background, which are the chunks a spatially coherent query reads next.
+
+    The cache holds the encoded chunk files, as a store sees them, so cached chunks are still decompressed on every
+    read; what is saved is the disk read.
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+
+from . import morton_utils
+
+# Defaults of the shared cache. Can be overridden with the CHUNK_CACHE_BYTES and CHUNK_CACHE_SPILL_PATH env vars
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+DEFAULT_SPILL_BYTES = 50 * 1024 ** 3
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+class ChunkCache:
+    """
+    Two-tier LRU cache of chunk files, keyed by (store, chunk key). Safe to share between threads
+
+    Attributes
+    ----------
+    max_bytes : int
+        Budget of the in-memory tier
+    spill_path : str
+        Folder of the spill tier, None for no spill tier
+    counters : dict
+        hits (memory), spill_hits, misses, evictions (from memory), spill_evictions, prefetches (chunks read ahead)
+
+    Args:
+        max_bytes (int): Budget of the in-memory tier
+        spill_path (str): Folder on a local SSD for chunks evicted from memory. None keeps only the memory tier
+        spill_bytes (int): Budget of the spill tier
+        prefetch_threads (int): Threads reading ahead, shared by all stores of the cache
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, spill_path: str = None,
+                 spill_bytes: int = DEFAULT_SPILL_BYTES, prefetch_threads: int = 4):
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.spill_bytes = spill_bytes
+        self.counters = dict(hits=0, spill_hits=0, misses=0, evictions=0, spill_evictions=0, prefetches=0)
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # cache key -> bytes, least recently used first
+        self._memory_bytes = 0
+        self._spilled = OrderedDict()  # cache key -> size of its spill file
+        self._spilled_bytes = 0
+        self._prefetching = set()
+        self._prefetch_threads = prefetch_threads
+        self._executor = None
+
+        if spill_path is not None:
+            os.makedirs(spill_path, exist_ok=True)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held in memory"""
+        return self._memory_bytes
+
+    def _spill_file(self, key) -> str:
+        return os.path.join(self.spill_path, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def get(self, key):
+        """Cached chunk file, or None. A chunk found in the spill tier moves back into memory"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.counters['hits'] += 1
+                return self._memory[key]
+            spilled = key in self._spilled
+
+        if spilled:
+            try:
+                with open(self._spill_file(key), 'rb') as f:
+                    value = f.read()
+            except FileNotFoundError:  # Evicted from the spill tier in the meantime
+                value = None
+            if value is not None:
+                with self._lock:
+                    self.counters['spill_hits'] += 1
+                self.put(key, value)
+                return value
+
+        with self._lock:
+            self.counters['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        """Cache a chunk file, evicting the least recently used ones from memory into the spill tier"""
+        value = bytes(value)
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            self._memory[key] = value
+            self._memory_bytes += len(value)
+
+            evicted = []
+            while self._memory_bytes > self.max_bytes:
+                old_key, old_value = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old_value)
+                self.counters['evictions'] += 1
+                if self.spill_path is not None and old_key not in self._spilled:
+                    evicted.append((old_key, old_value))
+
+        # Spill files are written outside the lock, so readers are not blocked on the SSD
+        for old_key, old_value in evicted:
+            self._spill(old_key, old_value)
+
+    def _spill(self, key, value):
+        if len(value) > self.spill_bytes:
+            return
+        with open(self._spill_file(key), 'wb') as f:
+            f.write(value)
+
+        with self._lock:
+            self._spilled[key] = len(value)
+            self._spilled_bytes += len(value)
+            dropped = []
+            while self._spilled_bytes > self.spill_bytes:
+                old_key, size = self._spilled.popitem(last=False)
+                self._spilled_bytes -= size
+                self.counters['spill_evictions'] += 1
+                dropped.append(old_key)
+
+        for old_key in dropped:
+            try:
+                os.remove(self._spill_file(old_key))
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, key):
+        """Forget a chunk, e.g. because it was overwritten"""
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            size = self._spilled.pop(key, None)
+            if size is not None:
+                self._spilled_bytes -= size
+        if size is not None:
+            try:
+                os.remove(self._spill_file(key))
+            except FileNotFoundError:
+                pass
+
+    def prefetch(self, key, load):
+        """Cache load()'s result under key in the background, unless key is cached or already being fetched"""
+        with self._lock:
+            if key in self._memory or key in self._prefetching:
+                return
+            self._prefetching.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._prefetch_threads, thread_name_prefix='chunk-prefetch')
+            executor = self._executor
+
+        def fetch():
+            try:
+                value = load()
+                if value is not None:
+                    self.put(key, value)
+                    with self._lock:
+                        self.counters['prefetches'] += 1
+            finally:
+                with self._lock:
+                    self._prefetching.discard(key)
+
+        executor.submit(fetch)
+
+    def wait_for_prefetches(self):
+        """Block until every read-ahead submitted so far is done"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def clear(self):
+        """Empty both tiers and reset the counters"""
+        self.wait_for_prefetches()
+        with self._lock:
+            spilled = list(self._spilled)
+            self._memory.clear()
+            self._spilled.clear()
+            self._memory_bytes = self._spilled_bytes = 0
+            self.counters = dict.fromkeys(self.counters, 0)
+        for key in spilled:
+            try:
+                os.remove(self._spill_file(key))
+            except FileNotFoundError:
+                pass
+
+    def reset_counters(self):
+        """Zero the counters, keeping the cached chunks"""
+        with self._lock:
+            self.counters = dict.fromkeys(self.counters, 0)
+
+    def stats(self) -> dict:
+        """Counters, hit rate and bytes held per tier"""
+        with self._lock:
+            counters = dict(self.counters)
+            lookups = counters['hits'] + counters['spill_hits'] + counters['misses']
+            return dict(counters, hit_rate=(counters['hits'] + counters['spill_hits']) / lookups if lookups else 0.0,
+                        memory_bytes=self._memory_bytes, memory_chunks=len(self._memory),
+                        spill_bytes=self._spilled_bytes, spill_chunks=len(self._spilled))
+
+    def print_report(self):
+        stats = self.stats()
+        print(f"Chunk cache: {stats['hit_rate']:.1%} hit rate ({stats['hits']} memory hits, {stats['spill_hits']} "
+              f"spill hits, {stats['misses']} misses), {stats['prefetches']} read ahead, {stats['evictions']} "
+              f"evictions, {stats['memory_bytes'] / 1024 ** 2:.0f} MB in memory, "
+              f"{stats['spill_bytes'] / 1024 ** 2:.0f} MB spilled")
+
+
+def get_shared_cache() -> ChunkCache:
+    """The process-wide ChunkCache, created on first use from the CHUNK_CACHE_* env vars"""
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = ChunkCache(int(os.environ.get('CHUNK_CACHE_BYTES', DEFAULT_MAX_BYTES)),
+                                       os.environ.get('CHUNK_CACHE_SPILL_PATH'))
+        return _shared_cache
+
+
+class CachingStore(MutableMapping):
+    """
+    Zarr store wrapper that serves chunk files through a ChunkCache. Writes go to the wrapped store and invalidate
+    the cached copy
+
+    Args:
+        store: Store to wrap, e.g. zarr.DirectoryStore(group_path)
+        cache (ChunkCache): Cache to use. Defaults to the process-wide get_shared_cache()
+        read_ahead (int): On a miss, also fetch this many following chunks of the array in Morton order
+    """
+
+    def __init__(self, store, cache: ChunkCache = None, read_ahead: int = 0):
+        self.store = store
+        self.cache = cache if cache is not None else get_shared_cache()
+        self.read_ahead = read_ahead
+        # Identifies the store within the shared cache, so stores of different groups never mix
+        self._name = os.path.abspath(store.path) if hasattr(store, 'path') else f'store-{id(store)}'
+        self._arrays = {}  # array prefix -> (chunk grid, separator), for read-ahead
+
+    def __getitem__(self, key):
+        if key.rsplit('/', 1)[-1].startswith('.'):  # Metadata is small and read once per open
+            return self.store[key]
+
+        value = self.cache.get((self._name, key))
+        if value is None:
+            value = self.store[key]
+            self.cache.put((self._name, key), value)
+            if self.read_ahead:
+                self._read_ahead(key)
+
+        return value
+
+    def _get_array_layout(self, prefix: str):
+        """Chunk grid and dimension separator of the array holding a chunk key, or None if it is no array"""
+        if prefix not in self._arrays:
+            try:
+                metadata = json.loads(self.store[(prefix + '/' if prefix else '') + '.zarray'])
+            except KeyError:
+                metadata = None
+            self._arrays[prefix] = None if metadata is None else (
+                [-(-n // c) for n, c in zip(metadata['shape'], metadata['chunks'])],
+                metadata.get('dimension_separator') or '.')
+
+        return self._arrays[prefix]
+
+    def _read_ahead(self, key):
+        """Prefetch the read_ahead chunks that follow key's chunk in Morton order of its first 3 axes"""
+        parts = key.split('/')
+        nested = len(parts)
+        while nested > 0 and parts[nested - 1].isdigit():  # 'velocity/0/0/0/0' with the '/' separator
+            nested -= 1
+        if nested < len(parts):
+            prefix, indices = '/'.join(parts[:nested]), parts[nested:]
+        else:
+            prefix, indices = '/'.join(parts[:-1]), parts[-1].split('.')
+        layout = self._get_array_layout(prefix)
+        if layout is None:
+            return
+        grid, separator = layout
+        try:
+            chunk = [int(i) for i in indices]
+        except ValueError:
+            return
+        if len(chunk) != len(grid) or len(grid) < 3:
+            return
+
+        bits = max(1, math.ceil(math.log2(max(grid[:3]))))
+        code = int(morton_utils.encode(chunk[2], chunk[1], chunk[0], bits))
+        fetched = 0
+        while fetched < self.read_ahead and code + 1 < 1 << 3 * bits:
+            code += 1
+            x, y, z = (int(c) for c in morton_utils.decode(code, bits))
+            if z >= grid[0] or y >= grid[1] or x >= grid[2]:
+                continue
+            next_key = separator.join(str(i) for i in [z, y, x] + chunk[3:])
+            next_key = (prefix + '/' if prefix else '') + next_key
+            self.cache.prefetch((self._name, next_key), lambda k=next_key: self.store.get(k))
+            fetched += 1
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __setitem__(self, key, value):
+        self.store[key] = value
+        self.cache.invalidate((self._name, key))
+
+    def __delitem__(self, key):
+        del self.store[key]
+        self.cache.invalidate((self._name, key))
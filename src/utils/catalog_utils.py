@@ -0,0 +1,224 @@
+"""
+    Placement catalog: a small SQLite index of where every written subcube lives.
+
+    One row per (dataset, write_mode, timestep, subcube) maps the subcube's Morton range and global bounds to its
+    FileDB disk, Zarr group path, size on disk and (optionally) checksum. It lets readers, tests and backup tooling
+    find the group holding a point without re-deriving the node assignment or opening the source data.
+"""
+import os
+import sqlite3
+import threading
+import zlib
+
+import numpy as np
+
+from . import write_utils
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS placements (
+    dataset TEXT NOT NULL,
+    write_mode TEXT NOT NULL,
+    timestep INTEGER NOT NULL,
+    subcube INTEGER NOT NULL,
+    array_cube_side INTEGER NOT NULL,
+    morton_start INTEGER NOT NULL,
+    morton_end INTEGER NOT NULL,
+    z_start INTEGER NOT NULL,
+    z_end INTEGER NOT NULL,
+    y_start INTEGER NOT NULL,
+    y_end INTEGER NOT NULL,
+    x_start INTEGER NOT NULL,
+    x_end INTEGER NOT NULL,
+    disk TEXT NOT NULL,
+    path TEXT NOT NULL,
+    byte_size INTEGER,
+    checksum TEXT,
+    PRIMARY KEY (dataset, write_mode, timestep, subcube)
+);
+CREATE INDEX IF NOT EXISTS placements_by_morton ON placements (dataset, write_mode, timestep, morton_start);
+"""
+
+COLUMNS = ('dataset', 'write_mode', 'timestep', 'subcube', 'array_cube_side', 'morton_start', 'morton_end',
+           'z_start', 'z_end', 'y_start', 'y_end', 'x_start', 'x_end', 'disk', 'path', 'byte_size', 'checksum')
+
+DEFAULT_CATALOG_NAME = 'placement_catalog.sqlite'
+
+
+def get_default_catalog_path() -> str:
+    """
+    Where the placement catalog, and the write journal next to it, live unless given: the first FileDB folder. It
+    outlives the job and every host reaches it, so readers and later --resume runs find both. SQLite and journal
+    appends need a single writer on this network file system, i.e. one writing job at a time, or jobs sharing a work
+    pool, whose merge step is the only writer (see Dataset.distribute_coordinated())
+    """
+    return os.path.join(write_utils.list_fileDB_folders()[0], DEFAULT_CATALOG_NAME)
+
+
+def get_directory_size(path: str) -> int:
+    """Total size in bytes of all files under path"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            total += os.path.getsize(os.path.join(root, filename))
+
+    return total
+
+
+def get_directory_checksum(path: str, buffer_size: int = 16 * 1024 * 1024) -> str:
+    """
+    CRC32 over the relative names and contents of all files under path, visited in sorted order
+
+    Returns:
+        str: checksum formatted as 'crc32:xxxxxxxx'
+    """
+    crc = 0
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            full_path = os.path.join(root, filename)
+            crc = zlib.crc32(os.path.relpath(full_path, path).encode(), crc)
+            with open(full_path, 'rb') as f:
+                while block := f.read(buffer_size):
+                    crc = zlib.crc32(block, crc)
+
+    return f"crc32:{crc:08x}"
+
+
+def get_file_checksum(path: str, buffer_size: int = 16 * 1024 * 1024) -> str:
+    """
+    CRC32 of one file's contents
+
+    Returns:
+        str: checksum formatted as 'crc32:xxxxxxxx'
+    """
+    crc = 0
+    with open(path, 'rb') as f:
+        while block := f.read(buffer_size):
+            crc = zlib.crc32(block, crc)
+
+    return f"crc32:{crc:08x}"
+
+
+class PlacementCatalog:
+    """
+    SQLite-backed index of subcube placements. Safe to share between the writer threads of one process; writes are
+    serialized with a lock.
+
+    Attributes
+    ----------
+    path : str
+        Location of the SQLite file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, placements):
+        """
+        Insert or replace placement rows
+
+        Args:
+            placements (dict or list[dict]): Rows keyed by COLUMNS. byte_size and checksum may be left out
+        """
+        if isinstance(placements, dict):
+            placements = [placements]
+
+        rows = [tuple(placement.get(column) for column in COLUMNS) for placement in placements]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO placements ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows)
+
+    def get_placements(self, dataset: str, write_mode: str, timestep: int = None) -> list:
+        """
+        All placements of a dataset copy, optionally restricted to one timestep, ordered by timestep and Morton code
+
+        Returns:
+            list[dict]: placement rows
+        """
+        query = "SELECT * FROM placements WHERE dataset = ? AND write_mode = ?"
+        params = [dataset, write_mode]
+        if timestep is not None:
+            query += " AND timestep = ?"
+            params.append(timestep)
+
+        with self._lock:
+            rows = self._connection.execute(query + " ORDER BY timestep, morton_start", params).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def locate_point(self, dataset: str, write_mode: str, timestep: int, z: int, y: int, x: int):
+        """
+        Find the subcube holding one point, with an index lookup on its Morton code
+
+        Args:
+            z, y, x (int): Global coordinates of the point, in (nnz, nny, nnx) order like range_list
+
+        Returns:
+            dict: placement row, or None if the point is not in the catalog
+        """
+        with self._lock:
+            side = self._connection.execute(
+                "SELECT array_cube_side FROM placements WHERE dataset = ? AND write_mode = ? AND timestep = ? LIMIT 1",
+                (dataset, write_mode, timestep)).fetchone()
+            if side is None or not all(0 <= c < side[0] for c in (z, y, x)):
+                return None
+
+            code = write_utils.morton_pack(side[0], z, y, x)
+            # Aligned power-of-two subcubes cover one contiguous Morton range, so the last range starting at or
+            # before `code` is the only candidate
+            row = self._connection.execute(
+                "SELECT * FROM placements WHERE dataset = ? AND write_mode = ? AND timestep = ? AND morton_start <= ? "
+                "ORDER BY morton_start DESC LIMIT 1", (dataset, write_mode, timestep, code)).fetchone()
+
+        if row is None or row['morton_end'] < code:
+            return None
+
+        return dict(row)
+
+    def locate_points(self, dataset: str, write_mode: str, timestep: int, points) -> list:
+        """
+        Vectorized locate_point() for many points of the same timestep
+
+        Args:
+            points (array-like): (N, 3) global coordinates in (nnz, nny, nnx) order
+
+        Returns:
+            tuple[list[dict], np.ndarray]: placements of the timestep sorted by Morton code, and for each point the
+                index of its placement in that list (-1 if not found)
+        """
+        placements = self.get_placements(dataset, write_mode, timestep)
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 3)
+        found = np.full(len(points), -1, dtype=np.int64)
+        if not placements or not len(points):
+            return placements, found
+
+        side = placements[0]['array_cube_side']
+        in_domain = np.all((points >= 0) & (points < side), axis=1)
+        codes = write_utils.morton_pack(side, points[in_domain, 0], points[in_domain, 1], points[in_domain, 2])
+
+        starts = np.array([p['morton_start'] for p in placements], dtype=np.uint64)
+        ends = np.array([p['morton_end'] for p in placements], dtype=np.uint64)
+        idx = np.searchsorted(starts, codes, side='right') - 1
+        valid = (idx >= 0) & (ends[np.maximum(idx, 0)] >= codes)
+        found[np.flatnonzero(in_domain)[valid]] = idx[valid]
+
+        return placements, found
@@ -0,0 +1,154 @@
+"""
+    Per-chunk checksum manifests of written Zarr groups, and a verifier that only reads the written copies.
+
+    Once a group's chunk files are written, and before the group is committed, write_manifest() checksums every
+    chunk file and stores the result in MANIFEST_NAME inside the group. The files are still in the page cache at that
+    point, so this costs no disk reads. The manifest travels with the group into the back copy, so
+    verify_groups() can check prod and back copies against it, in parallel per disk, without opening the 2048^3
+    source.
+
+    Checksums are xxh64 when the optional xxhash package is installed, CRC32 (zlib) otherwise. The manifest
+    records which one it used.
+"""
+import json
+import os
+import threading
+import zlib
+
+from . import shard_utils
+from .scheduler_utils import DiskScheduler
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Inside the group folder. Zarr ignores it
+MANIFEST_NAME = '.chunk_checksums.json'
+# Zarr metadata files, which are not chunks
+METADATA_NAMES = ('.zgroup', '.zattrs', '.zarray', '.zmetadata')
+ALGORITHMS = ('xxh64', 'crc32')
+DEFAULT_ALGORITHM = 'xxh64' if xxhash is not None else 'crc32'
+
+
+def checksum_bytes(data, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """Hex checksum of a bytes-like object"""
+    if algorithm == 'xxh64':
+        if xxhash is None:
+            raise ImportError("The xxh64 algorithm needs the xxhash package: pip install xxhash")
+        return xxhash.xxh64(data).hexdigest()
+    if algorithm == 'crc32':
+        return f"{zlib.crc32(data):08x}"
+
+    raise ValueError(f"Unknown checksum algorithm '{algorithm}'. Use one of {ALGORITHMS}")
+
+
+def checksum_file(path: str, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """Hex checksum of one (chunk-sized) file, read in one go"""
+    with open(path, 'rb') as f:
+        return checksum_bytes(f.read(), algorithm)
+
+
+def list_chunk_files(group_path: str) -> list:
+    """Paths of all chunk files of a Zarr group, relative to it and sorted, e.g. 'velocity/0.0.0.0'"""
+    chunk_files = []
+    for root, dirs, files in os.walk(group_path):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename in METADATA_NAMES or filename == MANIFEST_NAME:
+                continue
+            chunk_files.append(os.path.relpath(os.path.join(root, filename), group_path).replace(os.sep, '/'))
+
+    return chunk_files
+
+
+def compute_checksums(group_path: str, algorithm: str = DEFAULT_ALGORITHM) -> dict:
+    """
+    Chunk file (relative path) -> checksum, for every chunk file of a Zarr group. Chunks of sharded groups are
+    keyed like the chunk files they were packed from, so a manifest stays valid across shard_utils conversions
+    """
+    if shard_utils.is_sharded_group(group_path):
+        store = shard_utils.ShardedStore(group_path)
+        try:
+            return {key: checksum_bytes(store[key], algorithm) for key in sorted(store.chunks)}
+        finally:
+            store.close()
+
+    return {key: checksum_file(os.path.join(group_path, key), algorithm) for key in list_chunk_files(group_path)}
+
+
+def write_manifest(group_path: str, algorithm: str = DEFAULT_ALGORITHM) -> dict:
+    """
+    Checksum every chunk file of a written Zarr group and store the result in the group's MANIFEST_NAME
+
+    Args:
+        group_path (str): Zarr group whose chunks are all written, e.g. the staging path before commit
+        algorithm (str): One of ALGORITHMS
+
+    Returns:
+        dict: The manifest, dict(algorithm=..., chunks={chunk file: checksum})
+    """
+    manifest = dict(algorithm=algorithm, chunks=compute_checksums(group_path, algorithm))
+    with open(os.path.join(group_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=0)
+
+    return manifest
+
+
+def read_manifest(group_path: str) -> dict:
+    """
+    The checksum manifest of a Zarr group
+
+    Raises:
+        FileNotFoundError: If the group was written without checksums
+    """
+    with open(os.path.join(group_path, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def verify_group(group_path: str) -> list:
+    """
+    Re-checksum the chunk files of a Zarr group and compare them with its manifest
+
+    Returns:
+        list[tuple]: (chunk file, expected checksum, actual checksum) of every mismatch. expected is None for
+            chunk files missing from the manifest, actual is None for chunk files missing from disk
+    """
+    manifest = read_manifest(group_path)
+    expected = manifest['chunks']
+    actual = compute_checksums(group_path, manifest['algorithm'])
+
+    return [(key, expected.get(key), actual.get(key)) for key in sorted(expected.keys() | actual.keys())
+            if expected.get(key) != actual.get(key)]
+
+
+def verify_groups(groups, threads_per_disk: int = 1):
+    """
+    Verify many Zarr groups against their manifests, in parallel per disk
+
+    Args:
+        groups (list): (group path, disk) of every group, e.g. disk from write_utils.get_filedb_folder()
+        threads_per_disk (int): Concurrent verifiers per disk
+
+    Returns:
+        tuple: (dict group path -> list of mismatches, see verify_group(), list of (group path, exception) for
+            groups that could not be verified, e.g. because they have no manifest)
+    """
+    scheduler = DiskScheduler([], threads_per_disk)
+    results = {}
+    lock = threading.Lock()
+
+    for path, disk in groups:
+        scheduler.submit(disk, path)
+    scheduler.close()
+
+    def verify_job(path):
+        mismatches = verify_group(path)
+        with lock:
+            results[path] = mismatches
+        if mismatches:
+            print(f"{len(mismatches)} chunk checksum mismatches in {path}, e.g. {mismatches[0][0]}")
+
+    scheduler.run(max(len(scheduler.queues), 1) * threads_per_disk, verify_job)
+
+    return results, list(scheduler.errors)
@@ -0,0 +1,140 @@
+"""
+    Zarr compressors and filters from config.yaml.
+
+    write_settings.desired_zarr_compressor and write_settings.desired_zarr_filters set the codecs of every variable;
+    write_settings.variable_codecs overrides them per variable. Each setting is either None, the name of one of
+    CODEC_PRESETS, or a numcodecs config dict such as {id: blosc, cname: lz4, clevel: 5, shuffle: 1}. Shuffling
+    float32 bytes (or bits) before compressing groups the slowly-changing exponent bytes, which is what makes
+    turbulence fields compress at all.
+"""
+import numcodecs
+from numcodecs import Blosc
+
+# name -> (compressor config, list of filter configs)
+CODEC_PRESETS = {
+    'none': (None, None),
+    'blosc-lz4': (dict(id='blosc', cname='lz4', clevel=5, shuffle=Blosc.SHUFFLE), None),
+    'blosc-lz4-bitshuffle': (dict(id='blosc', cname='lz4', clevel=5, shuffle=Blosc.BITSHUFFLE), None),
+    'blosc-zstd-bitshuffle': (dict(id='blosc', cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE), None),
+    'shuffle-lz4': (dict(id='lz4', acceleration=1), [dict(id='shuffle', elementsize=4)]),
+    'shuffle-zstd': (dict(id='zstd', level=3), [dict(id='shuffle', elementsize=4)]),
+}
+
+
+def get_codec(spec):
+    """
+    numcodecs compressor from a config value
+
+    Args:
+        spec: None, 'None', a name in CODEC_PRESETS (its compressor is used) or a numcodecs config dict
+
+    Returns:
+        numcodecs.abc.Codec: Compressor, or None for no compression
+    """
+    if spec is None or (isinstance(spec, str) and spec.lower() == 'none'):
+        return None
+    if isinstance(spec, str):
+        if spec not in CODEC_PRESETS:
+            raise ValueError(f"Unknown codec preset '{spec}'. Use one of {list(CODEC_PRESETS)} or a numcodecs config")
+        spec = CODEC_PRESETS[spec][0]
+        if spec is None:
+            return None
+
+    return numcodecs.get_codec(dict(spec))
+
+
+def get_filters(spec):
+    """
+    numcodecs filters from a config value
+
+    Args:
+        spec: None, 'None', or a list of numcodecs config dicts
+
+    Returns:
+        list[numcodecs.abc.Codec]: Filters, or None for no filters
+    """
+    if spec is None or (isinstance(spec, str) and spec.lower() == 'none') or len(spec) == 0:
+        return None
+
+    return [numcodecs.get_codec(dict(filter_spec)) for filter_spec in spec]
+
+
+def resolve_codecs(spec):
+    """
+    (compressor, filters) from one codec setting: a preset name, which sets both, or a dict with optional
+    'compressor' and 'filters' keys
+    """
+    if isinstance(spec, str) and spec in CODEC_PRESETS:
+        compressor, filters = CODEC_PRESETS[spec]
+        return get_codec(compressor), get_filters(filters)
+    if isinstance(spec, dict) and 'id' not in spec:
+        return get_codec(spec.get('compressor')), get_filters(spec.get('filters'))
+
+    return get_codec(spec), None
+
+
+def get_variable_codecs(write_settings: dict, variables) -> dict:
+    """
+    Compressor and filters of every variable, as configured in config.yaml
+
+    Args:
+        write_settings (dict): config['write_settings']
+        variables (list[str]): Variables to resolve, e.g. ['velocity', 'pressure', 'temperature', 'energy']
+
+    Returns:
+        dict: variable -> (compressor, filters)
+    """
+    overrides = write_settings.get('variable_codecs') or {}
+    default_compressor = write_settings.get('desired_zarr_compressor')
+    default_filters = write_settings.get('desired_zarr_filters')
+
+    codecs = {}
+    for var in variables:
+        if var in overrides:
+            codecs[var] = resolve_codecs(overrides[var])
+        elif isinstance(default_compressor, str) and default_compressor in CODEC_PRESETS:
+            compressor, filters = resolve_codecs(default_compressor)
+            codecs[var] = (compressor, get_filters(default_filters) or filters)
+        else:
+            codecs[var] = (get_codec(default_compressor), get_filters(default_filters))
+
+    return codecs
+
+
+def build_encoding(chunks: dict, codecs=None) -> dict:
+    """
+    xarray to_zarr() encoding
+
+    Args:
+        chunks (dict): variable -> Zarr chunk shape
+        codecs (dict): variable -> (compressor, filters), see get_variable_codecs(). Variables missing from it,
+            or all variables if None, are written uncompressed
+
+    Returns:
+        dict: variable -> dict(chunks=..., compressor=..., [filters=...])
+    """
+    codecs = codecs or {}
+    encoding = {}
+    for var, var_chunks in chunks.items():
+        compressor, filters = codecs.get(var, (None, None))
+        encoding[var] = dict(chunks=var_chunks, compressor=compressor)
+        if filters:
+            encoding[var]['filters'] = filters
+
+    return encoding
+
+
+def describe_codecs(compressor, filters) -> str:
+    """Short human-readable form, e.g. 'shuffle(4) + lz4' or 'blosc(zstd, bitshuffle)'"""
+    def describe(codec):
+        config = codec.get_config()
+        if config['id'] == 'blosc':
+            shuffle = {Blosc.NOSHUFFLE: 'noshuffle', Blosc.SHUFFLE: 'shuffle', Blosc.BITSHUFFLE: 'bitshuffle'}
+            return f"blosc({config['cname']}, {shuffle.get(config['shuffle'], config['shuffle'])})"
+        if config['id'] == 'shuffle':
+            return f"shuffle({config['elementsize']})"
+        return config['id']
+
+    parts = [describe(f) for f in filters or []] + ([describe(compressor)] if compressor is not None else [])
+
+    return ' + '.join(parts) or 'none'
@@ -0,0 +1,384 @@
+"""
+    Work pool on shared storage, so several processes, or several independent SciServer jobs, can split the
+    (timestep, subcube) writes of one dataset without splitting -st/-et ranges by hand.
+
+    All coordination goes through files in one folder that every worker can reach (a FileDB folder, or any local
+    folder for workers on one host):
+
+        items.json          The work items, written once by the first worker to arrive
+        leases/<item>       Who is working on an item. Created with O_CREAT | O_EXCL, so exactly one worker claims it
+        leases/<item>.lock  Held, also O_EXCL, while a lease is broken, renewed or released, so none of these
+                            replaces or removes a lease another worker has just taken
+        done/<item>         Items finished
+        failed/<item>.json  Failed attempts of an item. It goes back to the pool until max_attempts is reached
+        progress/<worker>   Items done and failed and the current item of every worker, for status()
+        journals/<worker>   Write journal of one worker process. Workers on different hosts must not append to one
+                            file or share one SQLite database, so these are merged once the pool is finished
+        <name>.lock         Other locks, see WorkPool.lock()
+
+    A worker renews the leases of its items every heartbeat_seconds while it works on them. The lease of a worker
+    that died is older than lease_seconds and is broken by the next worker that wants the item, so the item is
+    written again. lease_seconds should therefore be much longer than heartbeat_seconds, and than the worst pause of
+    the shared filesystem. A worker that was only slow may still be working on an item whose lease was broken, so
+    handlers check that they still hold the lease before making their work visible, and raise LeaseLost if not.
+"""
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+LEASES, DONE, FAILED, PROGRESS, JOURNALS = 'leases', 'done', 'failed', 'progress', 'journals'
+ITEMS_NAME = 'items.json'
+
+DEFAULT_LEASE_SECONDS = 600
+DEFAULT_HEARTBEAT_SECONDS = 30
+DEFAULT_MAX_ATTEMPTS = 3
+
+# How often and how long renew() and release wait for the lock of a lease. Locks are held for one read and write
+LOCK_ATTEMPTS = 100
+LOCK_WAIT_SECONDS = 0.01
+
+
+class LeaseLost(Exception):
+    """Raised by a handler whose lease on its item was broken, so another worker finishes the item. See run_worker()"""
+
+
+def get_worker_id(suffix=None) -> str:
+    """Identifies a worker across hosts: host name, process id and an optional suffix, e.g. a thread nr."""
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    return worker_id if suffix is None else f'{worker_id}-{suffix}'
+
+
+def _write_json(path: str, data):
+    """Replace a JSON file atomically: readers see the old or the new content, never a partial one"""
+    temporary = f'{path}.{get_worker_id(threading.get_ident())}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def _read_json(path: str):
+    """Content of a JSON file, None if it does not exist (any more)"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class WorkPool:
+    """
+    Work items shared through a folder, claimed with lease files. Safe to use from many threads, processes and hosts
+
+    Attributes
+    ----------
+    path : str
+        Coordination folder
+    lease_seconds : float
+        Age after which a lease that was not renewed is considered abandoned
+    max_attempts : int
+        Failed attempts after which an item is no longer handed out
+
+    Args:
+        path (str): Coordination folder on storage all workers share. Created if missing
+        lease_seconds (float): See Attributes
+        max_attempts (int): See Attributes
+    """
+
+    def __init__(self, path: str, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for folder in (LEASES, DONE, FAILED, PROGRESS, JOURNALS):
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+        self._items = None
+
+    def _get_path(self, folder: str, name: str) -> str:
+        return os.path.join(self.path, folder, name)
+
+    def initialize(self, items: list) -> list:
+        """
+        Publish the work items, unless an earlier worker already did. Every worker may call this; the first one
+        wins and the others get its items
+
+        Args:
+            items (list[dict]): JSON-serializable items, each with a unique 'id' made of characters valid in file
+                names
+
+        Returns:
+            list[dict]: The items of the pool
+        """
+        items_path = os.path.join(self.path, ITEMS_NAME)
+        if not os.path.exists(items_path):
+            temporary = f'{items_path}.{get_worker_id()}.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(items, f)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.link(temporary, items_path)  # Fails if another worker published first
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temporary)
+
+        return self.get_items()
+
+    def get_items(self) -> list:
+        """The work items of the pool"""
+        if self._items is None:
+            with open(os.path.join(self.path, ITEMS_NAME)) as f:
+                self._items = json.load(f)
+        return self._items
+
+    def is_done(self, item_id: str) -> bool:
+        return os.path.exists(self._get_path(DONE, item_id))
+
+    def get_attempts(self, item_id: str) -> list:
+        """Errors of the failed attempts of an item"""
+        return _read_json(self._get_path(FAILED, f'{item_id}.json')) or []
+
+    @contextlib.contextmanager
+    def lock(self, name: str, worker_id: str, wait: bool = True):
+        """
+        Hold the lock <name>.lock in the coordination folder, taken with O_CREAT | O_EXCL. Yields whether it was
+        taken; without wait only one attempt is made. A lock older than lease_seconds was left by a worker that died
+        and is removed
+
+        Args:
+            name (str): Lock name, relative to the coordination folder
+            worker_id (str): Who locks, see get_worker_id()
+            wait (bool): Retry for up to LOCK_ATTEMPTS * LOCK_WAIT_SECONDS while another worker holds it
+        """
+        lock_path = os.path.join(self.path, f'{name}.lock')
+        fd = None
+        for _ in range(LOCK_ATTEMPTS if wait else 1):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > self.lease_seconds:
+                        os.remove(lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if wait:
+                    time.sleep(LOCK_WAIT_SECONDS)
+
+        if fd is None:
+            yield False
+            return
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(worker=worker_id, locked_at=time.time()), f)
+        try:
+            yield True
+        finally:
+            os.remove(lock_path)
+
+    def _lock_lease(self, item_id: str, worker_id: str, wait: bool = True):
+        """The lock serializing breaking, renewing and releasing the lease of an item"""
+        return self.lock(os.path.join(LEASES, item_id), worker_id, wait)
+
+    def _try_lease(self, item_id: str, worker_id: str) -> bool:
+        lease_path = self._get_path(LEASES, item_id)
+        lease = dict(worker=worker_id, claimed_at=time.time(), renewed_at=time.time())
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            old = _read_json(lease_path)
+            if old is None or time.time() - old['renewed_at'] < self.lease_seconds:
+                return False
+            # Abandoned. Remove it under its lock, and only if it is still the lease read above: another worker may
+            # have broken it and claimed the item since. Creating the new lease with O_EXCL then decides who claims
+            with self._lock_lease(item_id, worker_id, wait=False) as locked:
+                if not locked or _read_json(lease_path) != old:
+                    return False
+                os.remove(lease_path)
+            print(f"Broke the lease of {old['worker']} on {item_id}, last renewed "
+                  f"{time.time() - old['renewed_at']:.0f} s ago")
+            return self._try_lease(item_id, worker_id)
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(lease, f)
+        if self.is_done(item_id):  # Finished by another worker since we looked
+            self._release(item_id, worker_id)
+            return False
+        return True
+
+    def claim(self, worker_id: str, prefer=None):
+        """
+        Lease the next item nobody works on that is neither done nor failed max_attempts times
+
+        Args:
+            worker_id (str): Who claims, see get_worker_id()
+            prefer (callable): Optional item -> bool. Items it accepts are tried first, e.g. items of a timestep
+                the worker already opened
+
+        Returns:
+            dict: The item, or None if there is nothing left to claim
+        """
+        items = self.get_items()
+        if prefer is not None:
+            items = [item for item in items if prefer(item)] + [item for item in items if not prefer(item)]
+
+        for item in items:
+            item_id = item['id']
+            if self.is_done(item_id) or len(self.get_attempts(item_id)) >= self.max_attempts:
+                continue
+            if self._try_lease(item_id, worker_id):
+                return item
+
+        return None
+
+    def renew(self, item_id: str, worker_id: str) -> bool:
+        """Renew a lease. False if the worker lost it, i.e. it was broken as abandoned"""
+        lease_path = self._get_path(LEASES, item_id)
+        with self._lock_lease(item_id, worker_id) as locked:
+            lease = _read_json(lease_path)
+            if lease is None or lease['worker'] != worker_id:
+                return False
+            if locked:  # Otherwise it is still ours but renewed on the next heartbeat
+                _write_json(lease_path, dict(lease, renewed_at=time.time()))
+            return True
+
+    def _release(self, item_id: str, worker_id: str):
+        """Remove a worker's lease. A lease that is no longer the worker's, or that stays locked, is left alone"""
+        lease_path = self._get_path(LEASES, item_id)
+        with self._lock_lease(item_id, worker_id) as locked:
+            lease = _read_json(lease_path)
+            if locked and lease is not None and lease['worker'] == worker_id:
+                os.remove(lease_path)
+
+    def complete(self, item_id: str, worker_id: str):
+        """Mark an item done and release its lease"""
+        _write_json(self._get_path(DONE, item_id), dict(worker=worker_id, done_at=time.time()))
+        self._release(item_id, worker_id)
+
+    def fail(self, item_id: str, worker_id: str, error) -> bool:
+        """
+        Record a failed attempt and return the item to the pool
+
+        Returns:
+            bool: Whether the item will be handed out again, i.e. has failed fewer than max_attempts times
+        """
+        attempts = self.get_attempts(item_id) + [dict(worker=worker_id, error=repr(error), failed_at=time.time())]
+        _write_json(self._get_path(FAILED, f'{item_id}.json'), attempts)
+        self._release(item_id, worker_id)
+
+        return len(attempts) < self.max_attempts
+
+    def report_progress(self, worker_id: str, **progress):
+        """Publish a worker's progress, e.g. items done and the current item. Shown by status()"""
+        _write_json(self._get_path(PROGRESS, worker_id), dict(progress, worker=worker_id, updated_at=time.time()))
+
+    def status(self) -> dict:
+        """
+        Counts of the items by state and the last progress report of every worker
+
+        Returns:
+            dict: total, done, running (leased, lease not expired), failed (max_attempts reached), pending,
+                workers (list of reports)
+        """
+        ids = [item['id'] for item in self.get_items()]
+        done = set(os.listdir(os.path.join(self.path, DONE)))
+        leased = set()  # Expired leases are left out: the next claim() breaks them, so their items are pending
+        for name in os.listdir(os.path.join(self.path, LEASES)):
+            if '.' in name:  # Locks
+                continue
+            lease = _read_json(self._get_path(LEASES, name))
+            if lease is None or time.time() - lease['renewed_at'] < self.lease_seconds:
+                leased.add(name)  # None: being written or replaced right now
+        failed = {item_id for item_id in ids if item_id not in done
+                  and len(self.get_attempts(item_id)) >= self.max_attempts}
+        workers = [_read_json(os.path.join(self.path, PROGRESS, name))
+                   for name in sorted(os.listdir(os.path.join(self.path, PROGRESS))) if not name.endswith('.tmp')]
+
+        return dict(total=len(ids), done=len(done & set(ids)), running=len(leased - done), failed=len(failed),
+                    pending=len(set(ids) - done - leased - failed), workers=[w for w in workers if w is not None])
+
+    def is_finished(self) -> bool:
+        """Whether no item is pending or being worked on any more"""
+        status = self.status()
+        return status['pending'] == 0 and status['running'] == 0
+
+    def get_journal_path(self, worker_id: str) -> str:
+        """Write journal of one worker process, see journal_utils.WriteJournal"""
+        return self._get_path(JOURNALS, f'{worker_id}.jsonl')
+
+    def list_journal_paths(self) -> list:
+        """Write journals of all worker processes"""
+        return [self._get_path(JOURNALS, name) for name in sorted(os.listdir(os.path.join(self.path, JOURNALS)))
+                if name.endswith('.jsonl')]
+
+    def print_status(self):
+        status = self.status()
+        print(f"{status['done']}/{status['total']} items done, {status['running']} running, {status['pending']} "
+              f"pending, {status['failed']} failed for good, {len(status['workers'])} workers reported")
+
+
+def run_worker(pool: WorkPool, worker_id: str, handler, prefer=None,
+               heartbeat_seconds: float = DEFAULT_HEARTBEAT_SECONDS) -> dict:
+    """
+    Claim and process items until the pool has none left. The lease of the current item is renewed in the
+    background; a failed item goes back to the pool. An item whose lease this worker lost is neither completed nor
+    failed: the worker that broke the lease finishes it
+
+    Args:
+        pool (WorkPool): Pool to work from
+        worker_id (str): See get_worker_id()
+        handler (callable): Processes one item. Raises LeaseLost if it found its lease broken, other exceptions fail
+            the item
+        prefer (callable): See WorkPool.claim()
+        heartbeat_seconds (float): Interval of lease renewals and progress reports
+
+    Returns:
+        dict: done and failed, the nr. of items this worker finished and failed
+    """
+    counts = dict(done=0, failed=0)
+    while True:
+        item = pool.claim(worker_id, prefer)
+        if item is None:
+            break
+        pool.report_progress(worker_id, current=item['id'], **counts)
+
+        finished, lost = threading.Event(), threading.Event()
+
+        def heartbeat(item_id=item['id']):
+            while not finished.wait(heartbeat_seconds):
+                if not pool.renew(item_id, worker_id):
+                    print(f"{worker_id} lost its lease on {item_id}; another worker may write it too")
+                    lost.set()
+                    return
+                pool.report_progress(worker_id, current=item_id, **counts)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        error = None
+        try:
+            handler(item)
+        except LeaseLost:
+            lost.set()
+        except Exception as e:
+            error = e
+        finished.set()
+        heartbeat_thread.join()
+
+        if lost.is_set():  # Found by the handler or by the heartbeat. Neither complete nor fail another's item
+            print(f"{worker_id} left {item['id']} to the worker that broke its lease")
+        elif error is not None:
+            retried = pool.fail(item['id'], worker_id, error)
+            counts['failed'] += 1
+            print(f"{worker_id} failed on {item['id']}: {error}. "
+                  f"{'Returned to the pool' if retried else 'Giving up'}")
+        else:
+            pool.complete(item['id'], worker_id)
+            counts['done'] += 1
+
+    pool.report_progress(worker_id, current=None, **counts)
+    return counts
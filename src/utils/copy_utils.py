@@ -0,0 +1,438 @@
+"""
+    File-level parallel copy engine for backup copies.
+
+    Directory trees are copied file by file. Every file is one job on the per-disk scheduler, queued on its
+    (source disk, destination disk) pair, so each disk has bounded concurrency no matter how many files a tree has.
+    A file is copied with the cheapest method the two filesystems support: a reflink (FICLONE, shares the blocks,
+    no data is copied), os.copy_file_range (in-kernel copy, server-side on NFS 4.2), os.sendfile, and plain buffered
+    copies as the last resort. The first method that works is remembered per device pair.
+
+    Trees are written under a staging name and renamed into place once every file arrived (see
+    write_utils.commit_staged_group()), so an existing copy is only replaced by a complete one. sync_trees() instead
+    updates an existing copy incrementally: it compares per-file manifests (size, mtime, optionally a checksum) and
+    only copies what differs, replacing files one at a time.
+"""
+import fcntl
+import os
+import shutil
+import threading
+import time
+
+from .catalog_utils import get_file_checksum
+from .scheduler_utils import DiskScheduler
+from .write_utils import commit_staged_group, get_staging_path
+
+FICLONE = 0x40049409  # From linux/fs.h: _IOW(0x94, 9, int)
+COPY_METHODS = ('reflink', 'copy_file_range', 'sendfile', 'buffered')
+SKIPPED_SUFFIXES = ('.partial', '.old')  # Uncommitted or half-replaced Zarr groups, see write_utils
+
+_methods = {}  # (source device, destination device) -> first method that worked
+_methods_lock = threading.Lock()
+
+
+def _reflink(src_fd, dst_fd, size):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if n == 0:
+            break
+        copied += n
+
+
+def _sendfile(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+
+
+def _buffered(src_fd, dst_fd, size):
+    while True:
+        data = os.read(src_fd, 16 * 1024 ** 2)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+
+_COPY_FUNCTIONS = {'reflink': _reflink, 'copy_file_range': _copy_file_range, 'sendfile': _sendfile,
+                   'buffered': _buffered}
+
+
+def copy_file(src: str, dst: str, method='auto') -> str:
+    """
+    Copy one file, keeping its permissions and modification time like shutil.copy2()
+
+    Args:
+        src (str): Source file
+        dst (str): Destination file. Overwritten if it exists
+        method (str): One of COPY_METHODS, or 'auto' to use the cheapest one that works between the two devices
+
+    Returns:
+        str: Method used
+    """
+    src_stat = os.stat(src)
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            devices = (src_stat.st_dev, os.fstat(dst_fd).st_dev)
+            if method == 'auto':
+                with _methods_lock:
+                    candidates = COPY_METHODS[COPY_METHODS.index(_methods.get(devices, COPY_METHODS[0])):]
+            else:
+                candidates = (method,)
+
+            for i, candidate in enumerate(candidates):
+                try:
+                    _COPY_FUNCTIONS[candidate](src_fd, dst_fd, src_stat.st_size)
+                    break
+                except OSError:
+                    if method != 'auto' or i == len(candidates) - 1:
+                        raise
+                    # Unsupported here (EXDEV, EOPNOTSUPP, EINVAL, ...). Start over with the next method
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dst_fd, 0)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+            if method == 'auto':
+                with _methods_lock:
+                    _methods[devices] = candidate
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    os.chmod(dst, src_stat.st_mode & 0o7777)
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+    return candidate
+
+
+def list_tree(src_dir: str, skipped_suffixes=()):
+    """
+    Subdirectories and files of a directory tree, relative to it
+
+    Args:
+        src_dir (str): Directory tree
+        skipped_suffixes (tuple[str]): Directories ending in one of these are left out, with everything under them
+
+    Returns:
+        tuple: (list of relative directory paths, list of (relative file path, size in bytes))
+    """
+    dirs, files = [], []
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        if skipped_suffixes:
+            dirnames[:] = [name for name in dirnames if not name.endswith(skipped_suffixes)]
+        relative = os.path.relpath(dirpath, src_dir)
+        for name in dirnames:
+            dirs.append(os.path.normpath(os.path.join(relative, name)))
+        for name in filenames:
+            files.append((os.path.normpath(os.path.join(relative, name)), os.path.getsize(os.path.join(dirpath, name))))
+
+    return dirs, files
+
+
+class CopyStats:
+    """
+    Bytes moved per disk and the time between a disk's first and last copy, to report per-disk throughput
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.disks = {}  # disk -> dict(read_bytes, written_bytes, files, first, last)
+        self.methods = {method: 0 for method in COPY_METHODS}
+
+    def add(self, src_disk, dst_disk, nbytes, method, start, end):
+        with self._lock:
+            self.methods[method] += 1
+            for disk, key in [(src_disk, 'read_bytes'), (dst_disk, 'written_bytes')]:
+                entry = self.disks.setdefault(disk, dict(read_bytes=0, written_bytes=0, files=0, first=start,
+                                                         last=end))
+                entry[key] += nbytes
+                entry['files'] += key == 'written_bytes'
+                entry['first'] = min(entry['first'], start)
+                entry['last'] = max(entry['last'], end)
+
+    def throughput(self) -> dict:
+        """disk -> dict(read_MBps, write_MBps, read_bytes, written_bytes, files)"""
+        with self._lock:
+            result = {}
+            for disk, entry in self.disks.items():
+                seconds = max(entry['last'] - entry['first'], 1e-9)
+                result[disk] = dict(read_MBps=entry['read_bytes'] / 1024 ** 2 / seconds,
+                                    write_MBps=entry['written_bytes'] / 1024 ** 2 / seconds,
+                                    read_bytes=entry['read_bytes'], written_bytes=entry['written_bytes'],
+                                    files=entry['files'])
+            return result
+
+    def print_report(self):
+        print(f"{'disk':<50}{'read MB/s':>11}{'write MB/s':>12}{'GB written':>12}{'files':>8}")
+        for disk, entry in sorted(self.throughput().items()):
+            print(f"{disk:<50}{entry['read_MBps']:>11.0f}{entry['write_MBps']:>12.0f}"
+                  f"{entry['written_bytes'] / 1024 ** 3:>12.2f}{entry['files']:>8}")
+        print("Files per copy method:", {method: n for method, n in self.methods.items() if n})
+
+
+def copy_trees(trees, num_threads=34, max_per_disk=1, method='auto', on_tree_copied=None) -> CopyStats:
+    """
+    Copy directory trees file by file in parallel. Each tree is copied to get_staging_path(destination) and
+    renamed to its destination once complete, replacing what was there
+
+    Args:
+        trees (list): (source dir, destination dir, source disk, destination disk) of every tree
+        num_threads (int): Nr. of copy threads
+        max_per_disk (int or dict): Concurrent copies per disk, see scheduler_utils.DiskScheduler. A copy counts
+            against both its source and its destination disk
+        method (str): See copy_file()
+        on_tree_copied (callable): Called with (source dir, destination dir, destination disk) of every tree
+            that was copied and committed completely
+
+    Returns:
+        CopyStats: Per-disk throughput. Failed files are in its 'errors' attribute as (source file, exception)
+    """
+    scheduler = DiskScheduler([], max_per_disk)
+    stats = CopyStats()
+    stats.errors = []
+    lock = threading.Lock()
+    files_left = {}  # tree index -> nr. of files not yet copied
+    failed_trees = set()
+
+    def commit(tree_index):
+        src_dir, dst_dir, _, dst_disk = trees[tree_index]
+        if tree_index in failed_trees:
+            print(f"Not committing {dst_dir}, some files failed to copy")
+            return
+        try:
+            commit_staged_group(get_staging_path(dst_dir), dst_dir)
+        except Exception as e:
+            stats.errors.append((src_dir, e))
+            print(f"Error committing {dst_dir}: {e}")
+            return
+        if on_tree_copied is not None:
+            on_tree_copied(src_dir, dst_dir, dst_disk)
+
+    def copy_job(job):
+        tree_index, relative, size = job
+        src_dir, dst_dir, src_disk, dst_disk = trees[tree_index]
+        src = os.path.join(src_dir, relative)
+        try:
+            start = time.time()
+            used = copy_file(src, os.path.join(get_staging_path(dst_dir), relative), method)
+            stats.add(src_disk, dst_disk, size, used, start, time.time())
+        except Exception as e:
+            stats.errors.append((src, e))
+            with lock:
+                failed_trees.add(tree_index)
+            raise
+        finally:
+            with lock:
+                files_left[tree_index] -= 1
+                tree_done = files_left[tree_index] == 0
+            if tree_done:
+                commit(tree_index)
+
+    jobs = []
+    for tree_index, (src_dir, dst_dir, src_disk, dst_disk) in enumerate(trees):
+        staging_dir = get_staging_path(dst_dir)
+        if os.path.exists(staging_dir):  # Left over from an interrupted run
+            shutil.rmtree(staging_dir)
+        dirs, files = list_tree(src_dir)
+        os.makedirs(staging_dir)
+        for relative in dirs:
+            os.makedirs(os.path.join(staging_dir, relative), exist_ok=True)
+
+        files_left[tree_index] = len(files)
+        if not files:
+            commit(tree_index)
+        jobs += [((src_disk, dst_disk), (tree_index, relative, size)) for relative, size in files]
+
+    for disks, job in jobs:
+        scheduler.submit(disks, job)
+    scheduler.close()
+    scheduler.run(num_threads, copy_job)
+
+    return stats
+
+
+def build_manifest(root: str, skipped_suffixes=SKIPPED_SUFFIXES) -> dict:
+    """
+    Size and modification time of every file under root
+
+    Args:
+        root (str): Directory to scan. May not exist (empty manifest)
+        skipped_suffixes (tuple[str]): Files and directories ending in one of these are left out, with everything
+            under them
+
+    Returns:
+        dict: relative path -> (size in bytes, mtime in ns)
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        if skipped_suffixes:
+            dirnames[:] = [name for name in dirnames if not name.endswith(skipped_suffixes)]
+        for name in filenames:
+            if skipped_suffixes and name.endswith(skipped_suffixes):
+                continue
+            path = os.path.join(dirpath, name)
+            stat = os.stat(path)
+            manifest[os.path.relpath(path, root)] = (stat.st_size, stat.st_mtime_ns)
+
+    return manifest
+
+
+def plan_sync(src_dir: str, dst_dir: str, compare_hashes=False) -> dict:
+    """
+    What it takes to make dst_dir an exact copy of src_dir. A file is copied if it is missing in dst_dir or its
+    size or mtime differ (copies keep the source mtime). With compare_hashes, files whose size and mtime match are
+    also compared by checksum. Files and directories only in dst_dir are orphans and get deleted, including
+    leftovers of interrupted copies. Uncommitted groups in src_dir (see SKIPPED_SUFFIXES) are not copied
+
+    Returns:
+        dict: 'copy' [(relative path, size)], 'delete' [relative path of orphaned files], 'delete_dirs'
+            [relative path of the topmost orphaned directories], 'unchanged_files', 'unchanged_bytes',
+            'delete_bytes'
+    """
+    src_manifest = build_manifest(src_dir)
+    dst_manifest = build_manifest(dst_dir, skipped_suffixes=())
+
+    plan = dict(copy=[], delete=[], delete_dirs=[], unchanged_files=0, unchanged_bytes=0, delete_bytes=0)
+    for relative, (size, mtime) in src_manifest.items():
+        changed = dst_manifest.get(relative) != (size, mtime)
+        if not changed and compare_hashes:
+            changed = (get_file_checksum(os.path.join(src_dir, relative))
+                       != get_file_checksum(os.path.join(dst_dir, relative)))
+        if changed:
+            plan['copy'].append((relative, size))
+        else:
+            plan['unchanged_files'] += 1
+            plan['unchanged_bytes'] += size
+
+    for relative, (size, _) in dst_manifest.items():
+        if relative not in src_manifest:
+            plan['delete'].append(relative)
+            plan['delete_bytes'] += size
+
+    src_dirs = set(list_tree(src_dir, SKIPPED_SUFFIXES)[0])
+    orphaned_dirs = {d for d in list_tree(dst_dir)[0] if d not in src_dirs}
+    # Only the topmost orphaned directories; deleting them takes everything below along
+    plan['delete_dirs'] = sorted(d for d in orphaned_dirs if os.path.dirname(d) not in orphaned_dirs)
+
+    return plan
+
+
+def print_sync_report(plans: dict, dry_run=False):
+    """
+    Summarize sync plans
+
+    Args:
+        plans (dict): (source dir, destination dir) -> plan_sync() result
+        dry_run (bool): Word the report as what would happen
+    """
+    total = dict(copy_files=0, copy_bytes=0, delete_files=0, delete_bytes=0, unchanged_files=0, unchanged_bytes=0)
+    for (src_dir, dst_dir), plan in plans.items():
+        copy_bytes = sum(size for _, size in plan['copy'])
+        if plan['copy'] or plan['delete'] or plan['delete_dirs']:
+            print(f"{src_dir} -> {dst_dir}: {len(plan['copy'])} files ({copy_bytes / 1024 ** 3:.2f} GB) to copy, "
+                  f"{len(plan['delete'])} files ({plan['delete_bytes'] / 1024 ** 3:.2f} GB) to delete")
+        total['copy_files'] += len(plan['copy'])
+        total['copy_bytes'] += copy_bytes
+        total['delete_files'] += len(plan['delete'])
+        total['delete_bytes'] += plan['delete_bytes']
+        total['unchanged_files'] += plan['unchanged_files']
+        total['unchanged_bytes'] += plan['unchanged_bytes']
+
+    verb = "Would" if dry_run else "Will"
+    print(f"{verb} copy {total['copy_files']} files ({total['copy_bytes'] / 1024 ** 3:.2f} GB) and delete "
+          f"{total['delete_files']} orphaned files ({total['delete_bytes'] / 1024 ** 3:.2f} GB). "
+          f"{total['unchanged_files']} files ({total['unchanged_bytes'] / 1024 ** 3:.2f} GB) are up to date")
+
+    return total
+
+
+def sync_trees(trees, num_threads=34, max_per_disk=1, method='auto', compare_hashes=False, dry_run=False,
+               on_tree_synced=None):
+    """
+    Incrementally make each destination tree an exact copy of its source: copy only missing or changed files and
+    delete orphans. Each file is copied to a temporary name next to its destination and renamed over it, so readers
+    never see a partial file. Copies are scheduled like in copy_trees()
+
+    Args:
+        trees (list): (source dir, destination dir, source disk, destination disk) of every tree
+        num_threads (int), max_per_disk (int or dict), method (str): See copy_trees()
+        compare_hashes (bool): Also compare files with matching size and mtime by checksum. Reads both copies
+        dry_run (bool): Only print what would be copied and deleted
+        on_tree_synced (callable): Called with (source dir, destination dir, destination disk) of every tree whose
+            files were all synced
+
+    Returns:
+        tuple: (dict of totals, see print_sync_report(), CopyStats or None on a dry run)
+    """
+    plans = {}
+    for src_dir, dst_dir, _, _ in trees:
+        plans[(src_dir, dst_dir)] = plan_sync(src_dir, dst_dir, compare_hashes)
+    totals = print_sync_report(plans, dry_run)
+    if dry_run:
+        return totals, None
+
+    scheduler = DiskScheduler([], max_per_disk)
+    stats = CopyStats()
+    stats.errors = []
+    lock = threading.Lock()
+    files_left = {}
+    failed_trees = set()
+
+    def finish(tree_index):
+        src_dir, dst_dir, _, dst_disk = trees[tree_index]
+        if tree_index not in failed_trees and on_tree_synced is not None:
+            on_tree_synced(src_dir, dst_dir, dst_disk)
+
+    def copy_job(job):
+        tree_index, relative, size = job
+        src_dir, dst_dir, src_disk, dst_disk = trees[tree_index]
+        src, dst = os.path.join(src_dir, relative), os.path.join(dst_dir, relative)
+        try:
+            start = time.time()
+            temporary = get_staging_path(dst)
+            used = copy_file(src, temporary, method)
+            os.replace(temporary, dst)
+            stats.add(src_disk, dst_disk, size, used, start, time.time())
+        except Exception as e:
+            stats.errors.append((src, e))
+            with lock:
+                failed_trees.add(tree_index)
+            raise
+        finally:
+            with lock:
+                files_left[tree_index] -= 1
+                tree_done = files_left[tree_index] == 0
+            if tree_done:
+                finish(tree_index)
+
+    jobs = []
+    for tree_index, (src_dir, dst_dir, src_disk, dst_disk) in enumerate(trees):
+        plan = plans[(src_dir, dst_dir)]
+        for relative in plan['delete']:
+            os.remove(os.path.join(dst_dir, relative))
+        for relative in plan['delete_dirs']:
+            shutil.rmtree(os.path.join(dst_dir, relative), ignore_errors=True)
+        for relative in list_tree(src_dir, SKIPPED_SUFFIXES)[0]:
+            os.makedirs(os.path.join(dst_dir, relative), exist_ok=True)
+
+        files_left[tree_index] = len(plan['copy'])
+        if not plan['copy']:
+            finish(tree_index)
+        jobs += [((src_disk, dst_disk), (tree_index, relative, size)) for relative, size in plan['copy']]
+
+    for disks, job in jobs:
+        scheduler.submit(disks, job)
+    scheduler.close()
+    scheduler.run(num_threads, copy_job)
+
+    return totals, stats
@@ -0,0 +1,351 @@
+"""
+    Global-coordinate reads across the Zarr groups of one timestep: boxes, point sets, and stencils that straddle
+    subcube boundaries.
+
+    Every 512^3 subcube is a separate Zarr group, so an 8^3 stencil within 4 points of a group face also needs data
+    from the neighboring groups, and a large box spans many groups. HaloReader resolves each group a read touches
+    from the placement catalog (or the node assignment) and splits the read into per-disk work lists: the part of
+    every group, cut into slabs of whole chunks for boxes. The work lists are served concurrently with
+    scheduler_utils.DiskScheduler, at most max_reads_per_disk reads per disk, and every piece is copied straight
+    into one preallocated result. Node coloring puts neighboring groups on different disks, so the reads of the up to
+    8 groups of a stencil cost about one parallel round, and the bandwidth of a box read grows with the nr. of disks
+    it touches.
+
+    Groups written with a halo (see write_utils.split_zarr_group()) also store the outer cells of their neighbors
+    and record the layout in their attributes. Stencils of side at most 2 * halo are then read from the single group
+    owning their center point; estimate_halo_tradeoff() weighs the extra storage against the crossings saved.
+"""
+import threading
+
+import numpy as np
+import zarr
+
+from . import morton_utils, shard_utils, stencil_utils
+from .cache_utils import CachingStore
+from .catalog_utils import PlacementCatalog
+from .scheduler_utils import DiskScheduler
+
+
+class HaloReader:
+    """
+    Reads a variable of one dataset timestep in global (z, y, x) coordinates
+
+    Attributes
+    ----------
+    placements : list[dict]
+        Placement rows of the timestep's groups, see catalog_utils.PlacementCatalog
+    group_length : int
+        Side length of one Zarr group
+    shape : tuple
+        Global shape of the variable, e.g. (2048, 2048, 2048, 3)
+    halo : int
+        Halo cells stored on every side of the groups, from their attributes. 0 for disjoint groups
+
+    Args:
+        placements (list[dict]): Placement rows with the 'path', 'disk' and bounds of every group of the timestep,
+            e.g. from PlacementCatalog.get_placements() or Dataset.get_subcube_placements()
+        variable (str): Variable to read, e.g. 'velocity'
+        max_reads_per_disk (int or dict): See scheduler_utils.DiskScheduler
+        cache (cache_utils.ChunkCache): Serve chunk files through this cache, e.g. cache_utils.get_shared_cache().
+            None reads them from disk every time
+        read_ahead (int): Chunks to read ahead on a cache miss, see cache_utils.CachingStore
+    """
+
+    def __init__(self, placements, variable: str = 'velocity', max_reads_per_disk=1, cache=None, read_ahead: int = 0):
+        if not placements:
+            raise ValueError("No placements to read from")
+
+        self.placements = list(placements)
+        self.variable = variable
+        self.max_reads_per_disk = max_reads_per_disk
+        self.cache = cache
+        self.read_ahead = read_ahead
+        self.group_length = self.placements[0]['z_end'] - self.placements[0]['z_start']
+
+        starts = np.array([[p['z_start'], p['y_start'], p['x_start']] for p in self.placements])
+        positions = starts // self.group_length
+        self._groups = np.full(positions.max(axis=0) + 1, -1, dtype=np.int64)  # Group position -> placement index
+        self._groups[tuple(positions.T)] = np.arange(len(self.placements))
+
+        self._arrays = {}
+        self._stores = {}  # Placement index -> store of the group, closed by close()
+        self._origins = {}  # Placement index -> global (z, y, x) of array index 0
+        self._lock = threading.Lock()
+        first = self._get_array(0)
+        self.shape = tuple(n * self.group_length for n in self._groups.shape) + tuple(first.shape[3:])
+        self.dtype = first.dtype
+        self.halo = self._halo
+
+    @classmethod
+    def from_catalog(cls, catalog_path: str, dataset: str, write_mode: str, timestep: int, variable: str = 'velocity',
+                     **kwargs):
+        """Reader of the groups of one timestep recorded in a placement catalog. kwargs go to HaloReader()"""
+        with PlacementCatalog(catalog_path) as catalog:
+            placements = catalog.get_placements(dataset, write_mode, timestep)
+        if not placements:
+            raise ValueError(f"Timestep {timestep} of {dataset} ({write_mode}) is not in the catalog {catalog_path}")
+
+        return cls(placements, variable, **kwargs)
+
+    def _get_array(self, i: int):
+        """The variable's Zarr array in group i, opened once"""
+        with self._lock:
+            if i not in self._arrays:
+                store = self._stores[i] = shard_utils.get_store(self.placements[i]['path'])
+                if self.cache is not None:
+                    store = CachingStore(store, self.cache, self.read_ahead)
+                group = zarr.open_group(store, mode='r')
+                self._halo = group.attrs.get('halo', 0)
+                self._origins[i] = np.array(group.attrs['storage_start'] if self._halo else self._get_core_start(i))
+                self._arrays[i] = group[self.variable]
+            return self._arrays[i]
+
+    def close(self):
+        """Close the files of the groups opened so far, e.g. shard files. Reading again reopens them"""
+        with self._lock:
+            stores = list(self._stores.values())
+        for store in stores:
+            store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_core_start(self, i: int) -> np.ndarray:
+        """Global (z, y, x) of the first point group i owns"""
+        placement = self.placements[i]
+        return np.array([placement['z_start'], placement['y_start'], placement['x_start']])
+
+    def _get_origin(self, i: int) -> np.ndarray:
+        """Global (z, y, x) of index 0 of group i's arrays: before the core start by the halo"""
+        self._get_array(i)
+        return self._origins[i]
+
+    def get_touched_groups(self, starts: np.ndarray, ends: np.ndarray) -> dict:
+        """
+        placement index -> indices of the boxes [starts, ends) that overlap the group
+
+        Raises:
+            ValueError: If a box sticks out of the domain or touches a group missing from the placements
+        """
+        if len(starts) and ((starts < 0).any() or (ends > np.array(self.shape[:3])).any()):
+            raise ValueError(f"Some reads stick out of the domain of shape {self.shape[:3]}")
+
+        first = starts // self.group_length
+        last = (ends - 1) // self.group_length
+        spans = (last - first).max(axis=0) + 1 if len(starts) else np.zeros(3, dtype=np.int64)
+
+        touched = {}
+        for offset in np.ndindex(*spans):
+            position = first + offset
+            overlapping = np.flatnonzero(np.all(position <= last, axis=1))
+            groups = self._groups[tuple(position[overlapping].T)]
+            if (groups < 0).any():
+                raise ValueError(f"No placement for the group at {position[overlapping][groups < 0][0]}")
+            for group in np.unique(groups):
+                touched.setdefault(int(group), []).append(overlapping[groups == group])
+
+        return {group: np.concatenate(boxes) for group, boxes in touched.items()}
+
+    def _run(self, jobs: list, handler, num_threads: int = None):
+        """
+        Run handler(group, job) for every (group, job), on per-disk work lists. Raises the first error
+
+        Args:
+            jobs (list[tuple]): (placement index, job) pairs
+            handler (callable): Reads one job
+            num_threads (int): Worker threads. Defaults to the sum of the limits of the disks touched, so every disk
+                is kept busy
+        """
+        scheduler = DiskScheduler([], self.max_reads_per_disk)
+        for group, job in jobs:
+            scheduler.submit(self.placements[group]['disk'], (group, job))
+        scheduler.close()
+
+        if num_threads is None:
+            num_threads = sum(scheduler.limits.values())
+        scheduler.run(max(1, min(num_threads, len(jobs))), lambda item: handler(*item))
+        if scheduler.errors:
+            (group, _), error = scheduler.errors[0]
+            raise RuntimeError(f"Could not read {self.placements[group]['path']}") from error
+
+    def _get_disk_limit(self, group: int) -> int:
+        disk = self.placements[group]['disk']
+        if isinstance(self.max_reads_per_disk, dict):
+            return self.max_reads_per_disk.get(disk, 1)
+        return self.max_reads_per_disk
+
+    def _split_rows(self, group: int, rows: np.ndarray, corners: np.ndarray) -> list:
+        """
+        Split the points a group serves into one work item per concurrent read of its disk, in Morton order of the
+        chunks their corners fall into, so items mostly read different chunks
+        """
+        parts = min(self._get_disk_limit(group), len(rows))
+        if parts <= 1:
+            return [rows]
+
+        chunks = np.array(self._get_array(group).chunks[:3])
+        grid = -(-self.group_length // chunks)
+        # Corners in a neighboring group count as the group's first or last chunk
+        chunk = np.clip((corners[rows] - self._get_origin(group)) // chunks, 0, grid - 1)
+        bits = max(1, int(np.ceil(np.log2(grid.max()))))
+        codes = morton_utils.encode(chunk[:, 2], chunk[:, 1], chunk[:, 0], bits)
+        order = np.argsort(codes, kind='stable')
+        # Only cut between different chunks
+        cuts = [np.searchsorted(codes[order], codes[order][i]) for i in range(0, len(rows), -(-len(rows) // parts))]
+
+        return [part for part in np.split(rows[order], sorted(set(cuts))[1:]) if len(part)]
+
+    def read_region(self, start, shape, out: np.ndarray = None, num_threads: int = None) -> np.ndarray:
+        """
+        A box of the variable in global coordinates. The part of every group it overlaps is cut into slabs of whole
+        chunks along z, and the slabs are read concurrently, per disk
+
+        Args:
+            start (tuple): Global (z, y, x) of the box's first point
+            shape (tuple): (z, y, x) size of the box
+            out (np.ndarray): Optional result buffer to fill, see Returns
+            num_threads (int): Concurrent reads. Defaults to the sum of the limits of the disks touched
+
+        Returns:
+            np.ndarray: (*shape, *self.shape[3:]) block
+        """
+        start, end = np.array(start, dtype=np.int64), np.array(start, dtype=np.int64) + np.array(shape)
+        result_shape = tuple(int(n) for n in shape) + self.shape[3:]
+        if out is None:
+            out = np.empty(result_shape, dtype=self.dtype)
+        elif out.shape != result_shape:
+            raise ValueError(f"out has shape {out.shape}, expected {result_shape}")
+
+        self._run(self.get_region_pieces(start, end),
+                  lambda group, bounds: self.read_region_piece(group, bounds, start, out), num_threads)
+
+        return out
+
+    def get_region_pieces(self, start: np.ndarray, end: np.ndarray) -> list:
+        """
+        Split the box [start, end) into (placement index, (low, high)) pieces: the part of every group it overlaps,
+        cut into slabs of whole chunks of the group along z
+        """
+        pieces = []
+        for group in self.get_touched_groups(start[np.newaxis], end[np.newaxis]):
+            core_start = self._get_core_start(group)
+            low = np.maximum(start, core_start)
+            high = np.minimum(end, core_start + self.group_length)
+            chunk_length = self._get_array(group).chunks[0]
+            origin = self._get_origin(group)[0]  # Slabs follow the group's own chunk grid
+            slab_starts = [low[0]] + list(range(origin + ((low[0] - origin) // chunk_length + 1) * chunk_length,
+                                                high[0], chunk_length))
+            for z_start, z_end in zip(slab_starts, slab_starts[1:] + [high[0]]):
+                pieces.append((group, (np.array([z_start, low[1], low[2]]), np.array([z_end, high[1], high[2]]))))
+
+        return pieces
+
+    def read_region_piece(self, group: int, bounds: tuple, start: np.ndarray, out: np.ndarray):
+        """Copy one piece of get_region_pieces() into out, the result of the box starting at global start"""
+        low, high = bounds
+        origin = self._get_origin(group)
+        self._get_array(group).get_basic_selection(tuple(slice(a, b) for a, b in zip(low - origin, high - origin)),
+                                                   out=out[tuple(slice(a, b) for a, b in zip(low - start,
+                                                                                              high - start))])
+
+    def read_points(self, points, num_threads: int = None) -> np.ndarray:
+        """
+        The variable at many global grid points, reading each chunk they fall into once
+
+        Args:
+            points (array-like): (N, 3) global (z, y, x) coordinates
+            num_threads (int): Concurrent reads. Defaults to the sum of the limits of the disks touched
+
+        Returns:
+            np.ndarray: (N, *self.shape[3:]) values
+        """
+        return self.gather_stencils(points, side=1, num_threads=num_threads)[:, 0, 0, 0]
+
+    def gather_stencils(self, indices, side: int = 8, out: np.ndarray = None, num_threads: int = None) -> np.ndarray:
+        """
+        The side^3 neighborhood of many points in global coordinates, like stencil_utils.gather_stencils() over the
+        whole domain. The points are split into work items per group touched, one per concurrent read of the
+        group's disk. Each item reads each of its chunks once, and the items run in parallel
+
+        Args:
+            indices (array-like): (N, 3) global (z, y, x) coordinates of the points. Every stencil must lie inside
+                the domain
+            side (int): Stencil side length. At most the chunk length
+            out (np.ndarray): Optional result buffer to fill, see Returns
+            num_threads (int): Concurrent reads. Defaults to the sum of the limits of the disks touched
+
+        Returns:
+            np.ndarray: (N, side, side, side, *self.shape[3:]) neighborhoods
+        """
+        corners = stencil_utils.get_stencil_corners(indices, side)
+        result_shape = (len(corners), side, side, side) + self.shape[3:]
+        if out is None:
+            out = np.empty(result_shape, dtype=self.dtype)
+        elif out.shape != result_shape:
+            raise ValueError(f"out has shape {out.shape}, expected {result_shape}")
+
+        self._run(self.get_stencil_work(corners, side),
+                  lambda group, rows: self.fill_stencil_rows(group, rows, corners, side, out), num_threads)
+
+        return out
+
+    def get_stencil_work(self, corners: np.ndarray, side: int) -> list:
+        """
+        Split stencils starting at global corners into (placement index, rows) work items, one per concurrent read
+        of the disk of every group touched. With a large enough halo, each stencil only goes to the group owning its
+        center point
+        """
+        if self.halo >= side // 2:
+            # Every stencil lies in the halo of the group owning its center point
+            centers = corners + side // 2
+            touched = self.get_touched_groups(centers, centers + 1)
+        else:
+            touched = self.get_touched_groups(corners, corners + side)
+
+        return [(group, part) for group, rows in touched.items() for part in self._split_rows(group, rows, corners)]
+
+    def fill_stencil_rows(self, group: int, rows: np.ndarray, corners: np.ndarray, side: int, out: np.ndarray):
+        """Fill the part of stencils out[rows] stored in a group. Cells stored in two groups are identical"""
+        stencil_utils.fill_stencils(self._get_array(group), corners[rows] - self._get_origin(group), side, out,
+                                    rows=rows)
+
+
+def estimate_halo_tradeoff(domain_length: int, group_length: int, halo: int, side: int = 8) -> dict:
+    """
+    Storage overhead of groups stored with a halo, against how often a side^3 stencil at a uniformly random position
+    in the domain needs more than one group, with and without the halo
+
+    Args:
+        domain_length (int): Side of the whole domain, e.g. 2048
+        group_length (int): Side of one group's core, e.g. 512
+        halo (int): Halo cells per side
+        side (int): Stencil side length
+
+    Returns:
+        dict: storage_overhead (fraction of extra bytes), crossing_without_halo and crossing_with_halo (fractions
+            of stencils that need more than one group)
+    """
+    # Per axis, then combined: a stencil fits into one group iff it does along every axis
+    starts = np.arange(domain_length - side + 1)
+    fits_without = (starts // group_length == (starts + side - 1) // group_length).mean()
+
+    owners = (starts + side // 2) // group_length
+    low = np.maximum(owners * group_length - halo, 0)
+    high = np.minimum((owners + 1) * group_length + halo, domain_length)
+    fits_with = ((starts >= low) & (starts + side <= high)).mean()
+
+    groups = domain_length // group_length
+    stored_length = domain_length + 2 * halo * (groups - 1)  # Halos are clipped at the domain's faces
+
+    return dict(halo=halo, side=side, storage_overhead=(stored_length / domain_length) ** 3 - 1,
+                crossing_without_halo=1 - fits_without ** 3, crossing_with_halo=1 - fits_with ** 3)
+
+
+def format_halo_report(tradeoff: dict) -> str:
+    """One line summary of estimate_halo_tradeoff()"""
+    return (f"Halo of {tradeoff['halo']} cells: {tradeoff['storage_overhead']:+.2%} storage, "
+            f"{tradeoff['side']}^3 stencils needing more than one group {tradeoff['crossing_without_halo']:.2%} -> "
+            f"{tradeoff['crossing_with_halo']:.2%}")
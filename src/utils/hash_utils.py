@@ -0,0 +1,217 @@
+"""
+    In-process file hashing for the integrity checks of the original NetCDF files.
+
+    hashlib releases the GIL while it digests large buffers, so threads hash at disk speed without one sha256sum
+    process per file. Files are read sequentially with readinto() into one reusable, page-aligned buffer per file,
+    and are scheduled per source disk with scheduler_utils.DiskScheduler, so each disk sees a fixed number of
+    sequential readers. Digests are kept in a SQLite cache keyed by (path, size, mtime, inode); a file that has not
+    changed since it was last hashed is not read again.
+"""
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import time
+
+from .scheduler_utils import DiskScheduler
+
+# Default location of the digest cache. Can be overridden with the HASH_CACHE_PATH env var
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'zarrify-across-network', 'hash_cache.sqlite')
+
+# Large enough to keep a disk streaming, small enough for dozens of concurrent readers
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (path, algorithm)
+);
+"""
+
+
+def hash_file(path: str, algorithm: str = 'sha256', buffer_size: int = DEFAULT_BUFFER_SIZE) -> str:
+    """
+    Hex digest of one file, identical to sha256sum's for the default algorithm
+
+    Args:
+        path (str): File to hash
+        algorithm (str): Any hashlib algorithm
+        buffer_size (int): Bytes per read. Rounded up to a multiple of the page size
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.new(algorithm)
+    buffer_size = -(-buffer_size // mmap.PAGESIZE) * mmap.PAGESIZE
+    buffer = mmap.mmap(-1, buffer_size)  # Anonymous mapping: page-aligned, reused for every read
+    view = memoryview(buffer)
+
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while n := f.readinto(view):
+                digest.update(view[:n])
+    finally:
+        view.release()
+        buffer.close()
+
+    return digest.hexdigest()
+
+
+def get_disk(path: str) -> str:
+    """Mount point of the filesystem holding path, used to group files by the disk they are read from"""
+    path = os.path.realpath(path)
+    device = os.stat(path).st_dev
+    while path != os.path.dirname(path) and os.stat(os.path.dirname(path)).st_dev == device:
+        path = os.path.dirname(path)
+
+    return path
+
+
+class HashCache:
+    """
+    SQLite-backed cache of file digests. A cached digest is only returned while the file's size, mtime and inode
+    are unchanged. Safe to share between threads; access is serialized with a lock
+
+    Attributes
+    ----------
+    path : str
+        Location of the SQLite file
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.environ.get('HASH_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self._lock = threading.Lock()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        with self._lock, self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, path: str, stat: os.stat_result, algorithm: str = 'sha256'):
+        """Cached digest of path, or None if it was never hashed or has changed since"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT digest FROM digests WHERE path = ? AND algorithm = ? AND size = ? AND mtime_ns = ? "
+                "AND inode = ?", (os.path.abspath(path), algorithm, stat.st_size, stat.st_mtime_ns,
+                                  stat.st_ino)).fetchone()
+        return row[0] if row else None
+
+    def put(self, path: str, stat: os.stat_result, digest: str, algorithm: str = 'sha256'):
+        """Store the digest of path as of stat"""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO digests (path, algorithm, size, mtime_ns, inode, digest) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (os.path.abspath(path), algorithm, stat.st_size, stat.st_mtime_ns,
+                                              stat.st_ino, digest))
+
+
+class HashStats:
+    """
+    Bytes hashed per disk and the time between a disk's first and last hash, to report per-disk throughput
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.disks = {}  # disk -> dict(bytes, files, cached_files, first, last)
+        self.errors = []  # (path, exception) of every file that could not be hashed
+
+    def add(self, disk, nbytes, start, end):
+        with self._lock:
+            entry = self.disks.setdefault(disk, dict(bytes=0, files=0, cached_files=0, first=start, last=end))
+            entry['bytes'] += nbytes
+            entry['files'] += 1
+            entry['first'] = min(entry['first'], start)
+            entry['last'] = max(entry['last'], end)
+
+    def add_cached(self, disk):
+        with self._lock:
+            now = time.perf_counter()
+            entry = self.disks.setdefault(disk, dict(bytes=0, files=0, cached_files=0, first=now, last=now))
+            entry['cached_files'] += 1
+
+    def throughput(self) -> dict:
+        """disk -> dict(GBps, bytes, files, cached_files)"""
+        with self._lock:
+            result = {}
+            for disk, entry in self.disks.items():
+                seconds = max(entry['last'] - entry['first'], 1e-9)
+                result[disk] = dict(GBps=entry['bytes'] / 1024 ** 3 / seconds if entry['files'] else 0.0,
+                                    bytes=entry['bytes'], files=entry['files'], cached_files=entry['cached_files'])
+            return result
+
+    def print_report(self):
+        print(f"{'disk':<50}{'GB/s':>8}{'GB hashed':>11}{'files':>8}{'cached':>8}")
+        for disk, entry in sorted(self.throughput().items()):
+            print(f"{disk:<50}{entry['GBps']:>8.2f}{entry['bytes'] / 1024 ** 3:>11.2f}{entry['files']:>8}"
+                  f"{entry['cached_files']:>8}")
+
+
+def hash_files(paths, threads_per_disk: int = 1, cache: HashCache = None, algorithm: str = 'sha256',
+               buffer_size: int = DEFAULT_BUFFER_SIZE):
+    """
+    Hash many files in parallel, one pool of threads_per_disk readers per source disk
+
+    Args:
+        paths (list[str]): Files to hash
+        threads_per_disk (int): Concurrent readers per disk. 1 keeps every spinning disk reading sequentially
+        cache (HashCache): Digest cache to consult and update. None hashes every file
+        algorithm (str): Any hashlib algorithm
+        buffer_size (int): Bytes per read, see hash_file()
+
+    Returns:
+        tuple: (dict path -> hex digest, HashStats). Files that could not be hashed are missing from the dict and
+            listed in HashStats.errors
+    """
+    digests = {}
+    stats = HashStats()
+    scheduler = DiskScheduler([], threads_per_disk)
+
+    for path in paths:
+        try:
+            disk = get_disk(path)
+            stat = os.stat(path)
+        except OSError as e:
+            print(f"Error hashing {path}: {e}")
+            stats.errors.append((path, e))
+            continue
+        cached = cache.get(path, stat, algorithm) if cache is not None else None
+        if cached is not None:
+            digests[path] = cached
+            stats.add_cached(disk)
+        else:
+            scheduler.submit(disk, (path, disk, stat))
+    scheduler.close()
+
+    def hash_job(job):
+        path, disk, stat = job
+        start = time.perf_counter()
+        digest = hash_file(path, algorithm, buffer_size)
+        stats.add(disk, stat.st_size, start, time.perf_counter())
+        digests[path] = digest
+        # Only cache the digest if the file did not change while it was being read
+        if cache is not None and os.stat(path).st_mtime_ns == stat.st_mtime_ns:
+            cache.put(path, stat, digest, algorithm)
+
+    scheduler.run(max(len(scheduler.queues), 1) * threads_per_disk, hash_job)
+    stats.errors += [(job[0], e) for job, e in scheduler.errors]
+
+    return digests, stats
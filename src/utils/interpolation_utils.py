@@ -0,0 +1,141 @@
+"""
+    Vectorized Lagrangian interpolation of order 4, 6 and 8 at fractional grid positions, for scalar fields and for
+    the joint velocity field.
+
+    An order-n interpolation at position p uses the n^3 grid points floor(p) - n/2 + 1 ... floor(p) + n/2 along every
+    axis, the Lag4/Lag6/Lag8 schemes of the Johns Hopkins Turbulence Databases. The stencils of a batch of points
+    are read with stencil_utils.gather_stencils(), the 1D weights of all points are computed at once and each
+    stencil is reduced with one batched matrix product, so no Python code runs per point.
+"""
+import numpy as np
+
+from . import stencil_utils
+
+ORDERS = (4, 6, 8)
+
+# Points interpolated per gather. The order-8 stencils of 10^5 velocity points take 600 MB
+DEFAULT_BATCH_SIZE = 100_000
+
+
+def get_nodes(order: int) -> np.ndarray:
+    """Offsets of the order's grid points from floor(position), e.g. -3 ... 4 for order 8"""
+    if order not in ORDERS:
+        raise ValueError(f"Unsupported interpolation order {order}. Use one of {ORDERS}")
+
+    return np.arange(order) - (order // 2 - 1)
+
+
+def lagrange_weights(fractions, order: int = 8) -> np.ndarray:
+    """
+    1D Lagrange weights of many points at once
+
+    Args:
+        fractions (array-like): (N,) offsets of the points from their floor grid point, in [0, 1)
+        order (int): One of ORDERS
+
+    Returns:
+        np.ndarray: (N, order) float64 weights of the grid points get_nodes(order). Each row sums to 1
+    """
+    nodes = get_nodes(order).astype(np.float64)
+    differences = np.asarray(fractions, dtype=np.float64)[:, np.newaxis] - nodes  # (N, order)
+
+    # prod over k != j of (f - x_k), as the product of everything left and right of j: no division by f - x_j = 0
+    ones = np.ones((len(differences), 1))
+    left = np.cumprod(np.hstack([ones, differences[:, :-1]]), axis=1)
+    right = np.cumprod(np.hstack([ones, differences[:, :0:-1]]), axis=1)[:, ::-1]
+    denominators = np.array([np.prod([xj - xk for xk in nodes if xk != xj]) for xj in nodes])
+
+    return left * right / denominators
+
+
+def interpolate_stencils(stencils: np.ndarray, fractions, order: int = 8) -> np.ndarray:
+    """
+    Interpolate gathered stencils
+
+    Args:
+        stencils (np.ndarray): (N, order, order, order, ...) neighborhoods starting at floor(position) - order / 2
+            + 1, see stencil_utils.gather_stencils()
+        fractions (array-like): (N, 3) position - floor(position) of the points, in [0, 1)
+        order (int): One of ORDERS
+
+    Returns:
+        np.ndarray: (N, ...) interpolated values, e.g. (N, 3) for velocity
+    """
+    fractions = np.asarray(fractions)
+    dtype = stencils.dtype if np.issubdtype(stencils.dtype, np.floating) else np.float64
+    weights = [lagrange_weights(fractions[:, axis], order).astype(dtype) for axis in range(3)]
+
+    # Outer product of the 1D weights, then one batched matrix product over the order^3 stencil points per point:
+    # several times faster than contracting the stencil axis by axis
+    weights = weights[0][:, :, None, None] * weights[1][:, None, :, None] * weights[2][:, None, None, :]
+    weights = weights.reshape(len(stencils), 1, order ** 3)
+    result = np.matmul(weights, stencils.reshape(len(stencils), order ** 3, -1))
+
+    return result.reshape((len(stencils),) + stencils.shape[4:])
+
+
+def interpolate(array, positions, order: int = 8, batch_size: int = DEFAULT_BATCH_SIZE) -> np.ndarray:
+    """
+    Lagrangian interpolation of a chunked array at fractional grid positions, batch_size points per gather
+
+    Args:
+        array: Zarr array (or anything gather_stencils() reads), e.g. group['velocity'] of shape (512, 512, 512, 3)
+            or group['temperature'] of shape (512, 512, 512, 1). Axes after the first 3 are interpolated
+            independently
+        positions (array-like): (N, 3) positions in grid units, in the array's axis order (z, y, x). Every stencil
+            must lie inside the array, i.e. order / 2 - 1 <= position < len - order / 2 along every axis
+        order (int): One of ORDERS
+        batch_size (int): Points per stencil gather, which bounds memory
+
+    Returns:
+        np.ndarray: (N, *array.shape[3:]) interpolated values
+
+    Raises:
+        ValueError: If a stencil sticks out of the array, see stencil_utils.gather_stencils()
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    if positions.ndim != 2 or positions.shape[1] != 3:
+        raise ValueError(f"positions must have shape (N, 3), got {positions.shape}")
+    get_nodes(order)
+
+    floors = np.floor(positions)
+    dtype = array.dtype if np.issubdtype(array.dtype, np.floating) else np.float64
+    out = np.empty((len(positions),) + tuple(array.shape[3:]), dtype=dtype)
+    for start in range(0, len(positions), batch_size):
+        batch = slice(start, start + batch_size)
+        # gather_stencils() starts stencils at index - order / 2: index floor + 1 starts them at floor - order / 2 + 1
+        stencils = stencil_utils.gather_stencils(array, floors[batch].astype(np.int64) + 1, side=order)
+        out[batch] = interpolate_stencils(stencils, positions[batch] - floors[batch], order)
+
+    return out
+
+
+def interpolate_reference(array, position, order: int = 8) -> np.ndarray:
+    """
+    Lagrangian interpolation at one position, straight from the definition with a loop over the stencil. Slow;
+    used to check interpolate()
+
+    Args:
+        array: Array to interpolate, indexable with integers
+        position (tuple): (z, y, x) position in grid units
+        order (int): One of ORDERS
+
+    Returns:
+        np.ndarray: Interpolated values, of shape array.shape[3:]
+    """
+    nodes = get_nodes(order)
+    floors = [int(np.floor(p)) for p in position]
+
+    def weight(fraction, j):
+        return np.prod([(fraction - nodes[k]) / (nodes[j] - nodes[k]) for k in range(order) if k != j])
+
+    fractions = [p - f for p, f in zip(position, floors)]
+    result = 0.0
+    for i in range(order):
+        for j in range(order):
+            for k in range(order):
+                value = np.asarray(array[floors[0] + nodes[i], floors[1] + nodes[j], floors[2] + nodes[k]],
+                                   dtype=np.float64)
+                result = result + weight(fractions[0], i) * weight(fractions[1], j) * weight(fractions[2], k) * value
+
+    return np.asarray(result)
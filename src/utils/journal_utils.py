@@ -0,0 +1,85 @@
+"""
+    Write journal for resumable distribution.
+
+    Each Zarr group is written under a staging name and renamed into place once complete (see
+    write_utils.commit_staged_group()). Only then is it appended to the journal, one JSON line per committed
+    (timestep, subcube, destination). A killed job therefore leaves either committed groups, which are in the
+    journal, or staging directories, which are not; a resumed run skips the former and rewrites the latter.
+"""
+import json
+import os
+import threading
+import time
+
+from .catalog_utils import get_directory_checksum, get_directory_size
+
+
+class WriteJournal:
+    """
+    Append-only JSON-lines journal of committed Zarr groups. Safe to share between the writer threads of one
+    process. Every entry is flushed and fsync-ed before record() returns
+
+    Attributes
+    ----------
+    path : str
+        Location of the journal file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, timestep: int, subcube: int, path: str, byte_size: int, checksum: str = None):
+        """Append one committed group to the journal, with the checksum of the group if one was computed"""
+        entry = dict(timestep=timestep, subcube=subcube, path=path, byte_size=byte_size, committed_at=time.time())
+        if checksum is not None:
+            entry['checksum'] = checksum
+
+        with self._lock:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self) -> dict:
+        """
+        All committed groups, keyed by destination path. Later entries win. A truncated last line (job killed
+        mid-append) is ignored
+
+        Returns:
+            dict: path -> journal entry
+        """
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+
+        with self._lock, open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                entries[entry['path']] = entry
+
+        return entries
+
+    @staticmethod
+    def is_committed(entry: dict, path: str) -> bool:
+        """
+        Whether the group at path matches its journal entry: it exists, is a Zarr group, still has the recorded
+        size on disk and, if the entry has a checksum, the recorded checksum. Entries without a checksum (written
+        without record_checksums) fall back to the size alone, which misses a chunk overwritten by one of equal
+        size
+
+        Args:
+            entry (dict): Journal entry of path, or None if it has none
+            path (str): Zarr group path
+        """
+        if entry is None or not os.path.exists(os.path.join(path, '.zgroup')):
+            return False
+        if get_directory_size(path) != entry['byte_size']:
+            return False
+
+        return entry.get('checksum') is None or get_directory_checksum(path) == entry['checksum']
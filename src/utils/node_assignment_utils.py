@@ -0,0 +1,196 @@
+"""
+    Node coloring engine behind write_utils.node_assignment(), plus its on-disk cache and a validator.
+
+    Subcubes of a dataset are colored with disks such that no two cells of a neighborhood share a disk. The greedy
+    order and tie-breaking are those of Ryan's original node_assignment() code, so the 4^3 / 34-disk layout already on
+    FileDB is reproduced exactly.
+"""
+import os
+import warnings
+from functools import lru_cache
+from itertools import product
+
+import numpy as np
+
+# Default location of the on-disk cache. Can be overridden with the NODE_ASSIGNMENT_CACHE_DIR env var
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'zarrify-across-network', 'node_assignment')
+
+# Version of color_grid()'s output, part of every on-disk cache file name. Bump it whenever a change to the greedy
+# order, tie-breaking or neighborhoods changes the assignment, so caches of the old algorithm are never served
+ALGORITHM_VERSION = 1
+
+# Supported neighborhoods: cells sharing a face (6), a face or edge (18), or a face, edge or corner (26)
+NEIGHBORHOODS = (6, 18, 26)
+
+
+def get_neighbor_offsets(neighborhood: int = 26) -> np.ndarray:
+    """
+    Offsets (di, dj, dk) of the neighbors of a cell, excluding the cell itself
+
+    Args:
+        neighborhood (int): One of NEIGHBORHOODS
+
+    Returns:
+        np.ndarray: (neighborhood, 3) array of offsets
+    """
+    if neighborhood not in NEIGHBORHOODS:
+        raise ValueError(f"neighborhood must be one of {NEIGHBORHOODS}, got {neighborhood}")
+
+    # Number of non-zero components allowed: 1 -> faces, 2 -> edges, 3 -> corners
+    max_nonzero = NEIGHBORHOODS.index(neighborhood) + 1
+    offsets = [offset for offset in product((-1, 0, 1), repeat=3)
+               if 0 < np.count_nonzero(offset) <= max_nonzero]
+
+    return np.array(offsets, dtype=int)
+
+
+def color_grid(cube_side: int, num_disks: int = 34, neighborhood: int = 26) -> np.ndarray:
+    """
+    Greedily assign 1-indexed disks to every cell of a cube_side^3 grid, so that no two cells in the same neighborhood
+    share a disk. Cells are visited in C order and get the least-used disk not taken by a neighbor, ties going to the
+    lowest disk number.
+
+    Only neighbors that were already visited can hold a disk, so each cell looks at half of its neighborhood through
+    precomputed flat offsets into a zero-padded grid, instead of slicing and set-differencing the full neighborhood.
+
+    Args:
+        cube_side (int): Number of subcubes along each dimension
+        num_disks (int): Number of disks (colors) available
+        neighborhood (int): One of NEIGHBORHOODS
+
+    Returns:
+        np.ndarray: (cube_side, cube_side, cube_side) int array of 1-indexed disk numbers
+    """
+    offsets = get_neighbor_offsets(neighborhood)
+
+    padded_side = cube_side + 2
+    strides = np.array([padded_side * padded_side, padded_side, 1])
+    flat_offsets = offsets @ strides
+    previously_visited = flat_offsets[flat_offsets < 0]
+
+    # Zero border means "no disk", so border lookups need no bounds checks
+    padded = np.zeros(padded_side ** 3, dtype=np.int64)
+
+    unavailable = np.iinfo(np.int64).max
+    # Index 0 stands for "no disk yet" and can never be picked
+    color_counts = np.zeros(num_disks + 1, dtype=np.int64)
+    color_counts[0] = unavailable
+
+    interior = np.arange(1, cube_side + 1)
+    for flat_idx in (np.add.outer(np.add.outer(interior * strides[0], interior * strides[1]), interior)).ravel():
+        candidates = color_counts.copy()
+        candidates[padded[flat_idx + previously_visited]] = unavailable
+        color = int(np.argmin(candidates))
+        if candidates[color] == unavailable:
+            raise ValueError(f"Ran out of disks while coloring a {cube_side}^3 grid with {num_disks} disks")
+
+        color_counts[color] += 1
+        padded[flat_idx] = color
+
+    return padded.reshape((padded_side,) * 3)[1:-1, 1:-1, 1:-1].astype(int)
+
+
+def _get_cache_path(cube_side: int, num_disks: int, neighborhood: int, cache_dir: str = None) -> str:
+    if cache_dir is None:
+        cache_dir = os.environ.get('NODE_ASSIGNMENT_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+    return os.path.join(cache_dir, f"node_assignment_v{ALGORITHM_VERSION}_{cube_side}_{num_disks}_{neighborhood}.npy")
+
+
+@lru_cache(maxsize=None)
+def _cached_node_assignment(cube_side: int, num_disks: int, neighborhood: int, cache_dir: str) -> np.ndarray:
+    cache_path = _get_cache_path(cube_side, num_disks, neighborhood, cache_dir)
+
+    if os.path.exists(cache_path):
+        nodes = np.load(cache_path)
+        if nodes.shape != (cube_side,) * 3:
+            warnings.warn(f"Ignoring node assignment cache {cache_path} with unexpected shape {nodes.shape}")
+        elif not validate_node_assignment(nodes, neighborhood, num_disks)['valid']:
+            warnings.warn(f"Ignoring node assignment cache {cache_path} with neighbors sharing a disk")
+        else:
+            return nodes
+
+    nodes = color_grid(cube_side, num_disks, neighborhood)
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write to a temporary name first so concurrent jobs never read a half-written file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, nodes)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        warnings.warn(f"Could not write node assignment cache {cache_path}: {e}")
+
+    return nodes
+
+
+def get_node_assignment(cube_side: int, num_disks: int = 34, neighborhood: int = 26, use_cache: bool = True,
+                        cache_dir: str = None) -> np.ndarray:
+    """
+    Node assignment for a cube_side^3 grid of subcubes, served from an in-process and on-disk cache keyed by
+    (ALGORITHM_VERSION, cube_side, num_disks, neighborhood). Cache files that fail validate_node_assignment() are
+    recomputed
+
+    Args:
+        cube_side (int): Number of subcubes along each dimension
+        num_disks (int): Number of disks (colors) available
+        neighborhood (int): One of NEIGHBORHOODS
+        use_cache (bool): Set to False to always recompute
+        cache_dir (str): Directory of the on-disk cache. Defaults to $NODE_ASSIGNMENT_CACHE_DIR or DEFAULT_CACHE_DIR
+
+    Returns:
+        np.ndarray: (cube_side, cube_side, cube_side) int array of 1-indexed disk numbers
+    """
+    if not use_cache:
+        return color_grid(cube_side, num_disks, neighborhood)
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('NODE_ASSIGNMENT_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+    # Copy so callers can't modify the cached array
+    return _cached_node_assignment(cube_side, num_disks, neighborhood, cache_dir).copy()
+
+
+def validate_node_assignment(nodes: np.ndarray, neighborhood: int = 26, num_disks: int = None) -> dict:
+    """
+    Check that no two cells in the same neighborhood share a disk, and report how evenly disks are used
+
+    Args:
+        nodes (np.ndarray): 3D array of 1-indexed disk numbers, as returned by get_node_assignment()
+        neighborhood (int): One of NEIGHBORHOODS
+        num_disks (int): Total number of disks. Defaults to the largest disk number in use
+
+    Returns:
+        dict: 'valid' (bool), 'conflicts' (list of ((i, j, k), (i, j, k)) cell pairs sharing a disk), 'disk_counts'
+            (nr. of cells per disk, index 0 is disk 1), 'min_cells_per_disk', 'max_cells_per_disk' and 'imbalance'
+            (max / mean cells per disk; 1.0 is perfectly balanced)
+    """
+    nodes = np.asarray(nodes)
+    if num_disks is None:
+        num_disks = int(nodes.max())
+
+    conflicts = []
+    for offset in get_neighbor_offsets(neighborhood):
+        if tuple(offset) <= (0, 0, 0):  # Every pair is seen from both sides, check it once
+            continue
+
+        # Overlap of the grid with itself shifted by `offset`
+        src = tuple(slice(0, side - o) if o >= 0 else slice(-o, side) for side, o in zip(nodes.shape, offset))
+        dst = tuple(slice(o, side) if o >= 0 else slice(0, side + o) for side, o in zip(nodes.shape, offset))
+
+        for cell in np.argwhere(nodes[src] == nodes[dst]):
+            first = tuple(int(c + s.start) for c, s in zip(cell, src))
+            second = tuple(int(c + d.start) for c, d in zip(cell, dst))
+            conflicts.append((first, second))
+
+    disk_counts = np.bincount(nodes.ravel(), minlength=num_disks + 1)[1:]
+
+    return {
+        'valid': len(conflicts) == 0 and nodes.min() >= 1 and nodes.max() <= num_disks,
+        'conflicts': conflicts,
+        'disk_counts': disk_counts.tolist(),
+        'min_cells_per_disk': int(disk_counts.min()),
+        'max_cells_per_disk': int(disk_counts.max()),
+        'imbalance': float(disk_counts.max() / disk_counts.mean()),
+    }
@@ -0,0 +1,223 @@
+"""
+    Direct chunk writer for uncompressed Zarr v2 arrays.
+
+    With compressor=None and no filters, a Zarr chunk file is nothing but the chunk's values as C-order bytes in the
+    array's dtype, padded with fill_value at the array's edges. write_group() therefore lets xarray write the
+    metadata (.zgroup, .zattrs, .zarray, .zmetadata) once, without computing anything, and then writes every chunk
+    file itself: one os.write() per chunk from a contiguous buffer, no dask graph per chunk and no Zarr codec
+    pipeline. The files are byte-identical to what Dataset.to_zarr() writes.
+"""
+import json
+import math
+import mmap
+import os
+
+import dask.array
+import numpy as np
+
+# O_DIRECT needs buffers, file offsets and write sizes aligned to the logical block size. 4 KiB covers current disks
+DIRECT_IO_ALIGNMENT = 4096
+SYNC_POLICIES = ('none', 'fsync', 'direct')
+
+
+def read_array_metadata(array_path: str) -> dict:
+    """The .zarray metadata of a Zarr array"""
+    with open(os.path.join(array_path, '.zarray')) as f:
+        return json.load(f)
+
+
+def is_raw_array(metadata: dict) -> bool:
+    """Whether the chunks of a Zarr array are stored as plain bytes, i.e. can be written by write_array()"""
+    return (metadata.get('zarr_format') == 2 and metadata.get('compressor') is None
+            and not metadata.get('filters') and metadata.get('order', 'C') == 'C')
+
+
+def is_raw_encoding(encoding: dict) -> bool:
+    """
+    Whether every variable of an xarray encoding is uncompressed and unfiltered. Variables without a 'compressor'
+    key get Zarr's default compressor, so they are not raw
+    """
+    return all('compressor' in var_encoding and var_encoding['compressor'] is None
+               and not var_encoding.get('filters') for var_encoding in encoding.values())
+
+
+def decode_fill_value(metadata: dict):
+    """fill_value of .zarray metadata as a value of the array's dtype"""
+    fill_value = metadata.get('fill_value')
+    dtype = np.dtype(metadata['dtype'])
+    if fill_value is None:
+        return np.zeros((), dtype=dtype)[()]
+    if isinstance(fill_value, str) and dtype.kind == 'f':
+        return dtype.type({'NaN': np.nan, 'Infinity': np.inf, '-Infinity': -np.inf}[fill_value])
+
+    return dtype.type(fill_value)
+
+
+def get_chunk_key(chunk_index, separator='.') -> str:
+    """File name of a chunk, e.g. '1.0.3.0'"""
+    return separator.join(str(i) for i in chunk_index)
+
+
+def write_chunk_file(path: str, buffer: np.ndarray, sync_policy='none'):
+    """
+    Write one chunk file with a single os.write() (repeated only if the kernel writes less)
+
+    Args:
+        path (str): Chunk file
+        buffer (np.ndarray): C-contiguous chunk data
+        sync_policy (str): 'none' leaves the data in the page cache. 'fsync' fsyncs the file. 'direct' writes with
+            O_DIRECT, bypassing the page cache, and fsyncs. Falls back to 'fsync' where O_DIRECT is unavailable
+            (e.g. tmpfs) or the chunk size is not block-aligned
+    """
+    data = memoryview(buffer).cast('B')
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+
+    fd = None
+    if sync_policy == 'direct' and hasattr(os, 'O_DIRECT') and len(data) % DIRECT_IO_ALIGNMENT == 0:
+        try:
+            fd = os.open(path, flags | os.O_DIRECT, 0o666)
+        except OSError:
+            fd = None
+        if fd is not None:
+            aligned = mmap.mmap(-1, len(data))  # Page-aligned, as O_DIRECT requires
+            aligned[:] = data
+            data = memoryview(aligned)
+    if fd is None:
+        fd = os.open(path, flags, 0o666)
+
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        if sync_policy != 'none':
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_array(array_path: str, data: np.ndarray, start=None, sync_policy='none', metadata=None):
+    """
+    Write a block of data into an existing uncompressed Zarr array, chunk file by chunk file
+
+    Args:
+        array_path (str): Zarr array, e.g. 'group1.zarr/velocity'
+        data (np.ndarray): Values to write. Must cover whole chunks, except where it ends at the array's edge
+        start (tuple[int]): Where data starts in the array. Must be a multiple of the chunk shape. Default: origin
+        sync_policy (str): See write_chunk_file()
+        metadata (dict): .zarray metadata of the array, if already read
+
+    Raises:
+        ValueError: If the array is compressed, or data is not chunk-aligned
+    """
+    if metadata is None:
+        metadata = read_array_metadata(array_path)
+    if not is_raw_array(metadata):
+        raise ValueError(f"{array_path} is compressed or filtered, so its chunks can't be written directly")
+
+    shape, chunks = tuple(metadata['shape']), tuple(metadata['chunks'])
+    dtype = np.dtype(metadata['dtype'])
+    separator = metadata.get('dimension_separator') or '.'
+    start = (0,) * len(shape) if start is None else tuple(start)
+    data = np.asarray(data).astype(dtype, copy=False)
+
+    for axis, (s, n, c, length) in enumerate(zip(start, data.shape, chunks, shape)):
+        if s % c != 0 or (n % c != 0 and s + n != length) or s + n > length:
+            raise ValueError(f"Block at {start} with shape {data.shape} is not chunk-aligned along axis {axis} of "
+                             f"{array_path} (shape {shape}, chunks {chunks})")
+
+    fill_value = None
+    grid = [range(math.ceil(n / c)) for n, c in zip(data.shape, chunks)]
+    for block_index in np.ndindex(*[len(r) for r in grid]):
+        selection = tuple(slice(i * c, (i + 1) * c) for i, c in zip(block_index, chunks))
+        block = data[selection]
+        if block.shape != chunks:  # Edge chunk: Zarr pads it to the full chunk shape with fill_value
+            if fill_value is None:
+                fill_value = decode_fill_value(metadata)
+            padded = np.full(chunks, fill_value, dtype=dtype)
+            padded[tuple(slice(0, n) for n in block.shape)] = block
+            block = padded
+        elif not block.flags.c_contiguous:
+            block = np.ascontiguousarray(block)
+
+        chunk_index = [s // c + i for s, c, i in zip(start, chunks, block_index)]
+        write_chunk_file(os.path.join(array_path, get_chunk_key(chunk_index, separator)), block, sync_policy)
+
+
+class RawArrayTarget:
+    """
+    Write target for dask.array.store(): every stored block goes to write_array(). Dask blocks must line up with
+    the Zarr chunks, as they must for to_zarr()
+    """
+
+    def __init__(self, array_path: str, sync_policy='none', metadata=None):
+        self.array_path = array_path
+        self.sync_policy = sync_policy
+        self.metadata = read_array_metadata(array_path) if metadata is None else metadata
+        self.shape = tuple(self.metadata['shape'])
+        self.dtype = np.dtype(self.metadata['dtype'])
+
+    def __setitem__(self, key, value):
+        start = tuple(k.start or 0 for k in key)
+        write_array(self.array_path, value, start, self.sync_policy, self.metadata)
+
+
+def sync_path(path: str):
+    """fsync one file or directory"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_tree(path: str):
+    """fsync every file and directory under path (e.g. a Zarr group's metadata), then path's parent directory"""
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            sync_path(os.path.join(dirpath, name))
+        sync_path(dirpath)
+
+    sync_path(os.path.dirname(os.path.abspath(path)))
+
+
+def write_group(dataset, path: str, encoding: dict, sync_policy='none'):
+    """
+    Write an xarray.Dataset to a new Zarr group, byte-identical to dataset.to_zarr(path, mode='w',
+    encoding=encoding), writing the chunk files directly
+
+    Args:
+        dataset (xarray.Dataset): Data to write, lazy (dask) or in memory
+        path (str): Zarr group path
+        encoding (dict): Zarr encoding of each variable. Must be uncompressed, see is_raw_encoding()
+        sync_policy (str): 'none', 'fsync' or 'direct', see write_chunk_file(). Except for 'none', the group's
+            metadata and directories are fsync-ed as well
+    """
+    if sync_policy not in SYNC_POLICIES:
+        raise ValueError(f"Unknown sync_policy '{sync_policy}'. Use one of {SYNC_POLICIES}")
+
+    # Metadata only. to_zarr(compute=False) still writes in-memory variables, so make them lazy first. The
+    # explicit token keeps dask from hashing all the data to name the template
+    template = dataset
+    if not all(isinstance(var.data, dask.array.Array) for var in dataset.data_vars.values()):
+        template = dataset.chunk(token=path)
+    template.to_zarr(path, mode='w', encoding=encoding, compute=False)
+
+    sources, targets = [], []
+    for name, var in dataset.data_vars.items():
+        array_path = os.path.join(path, name)
+        metadata = read_array_metadata(array_path)
+        if tuple(metadata['shape']) != var.shape:
+            raise ValueError(f"{array_path} has shape {metadata['shape']}, expected {var.shape}")
+
+        if isinstance(var.data, dask.array.Array):
+            sources.append(var.data)
+            targets.append(RawArrayTarget(array_path, sync_policy, metadata))
+        else:
+            write_array(array_path, var.data, None, sync_policy, metadata)
+
+    # One compute for all variables, as to_zarr() does. Each dask block lands in RawArrayTarget.__setitem__
+    if sources:
+        dask.array.store(sources, targets, lock=False)
+
+    if sync_policy != 'none':
+        sync_tree(path)
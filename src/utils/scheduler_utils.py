@@ -0,0 +1,148 @@
+"""
+    Disk-affine job scheduler: one queue per FileDB disk, with a concurrency limit per disk.
+
+    Node coloring spreads subcubes over disks, but a single shared queue can still send several threads to the same
+    spindle while other disks idle. DiskScheduler keeps a FIFO per disk and only starts a job when every disk it
+    touches is below its limit. Each worker prefers its own "home" disk and steals from the deepest eligible queue
+    when its home disk has nothing runnable.
+"""
+import threading
+from collections import deque
+
+
+class DiskScheduler:
+    """
+    Per-disk queues with bounded per-disk concurrency
+
+    Attributes
+    ----------
+    limits : dict
+        Maximum nr. of concurrent jobs per disk
+
+    Args:
+        disks (list[str]): Disks jobs can be submitted to, e.g. write_utils.list_fileDB_folders()
+        max_per_disk (int or dict): Concurrency limit for every disk, or a {disk: limit} dict for disks that need
+            different limits (e.g. SSDs vs. spinning disks). Disks missing from the dict get a limit of 1
+    """
+
+    def __init__(self, disks, max_per_disk=1):
+        self.queues = {disk: deque() for disk in disks}
+        self._max_per_disk = max_per_disk
+        self.limits = {disk: self._get_limit(disk) for disk in disks}
+        self.active = {disk: 0 for disk in disks}
+        self.errors = []  # (job, exception) of every failed job
+
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def _get_limit(self, disk):
+        if isinstance(self._max_per_disk, dict):
+            return self._max_per_disk.get(disk, 1)
+        return self._max_per_disk
+
+    def submit(self, disks, job):
+        """
+        Queue a job
+
+        Args:
+            disks (str or tuple[str]): Disk(s) the job reads or writes. The job is queued on the first one and only
+                starts when all of them are below their limit
+            job: Passed to the handler given to run()
+        """
+        disks = (disks,) if isinstance(disks, str) else tuple(disks)
+        for disk in disks:
+            if disk not in self.queues:  # Disks outside the initial list are added with their limit
+                with self._condition:
+                    self.queues.setdefault(disk, deque())
+                    self.limits.setdefault(disk, self._get_limit(disk))
+                    self.active.setdefault(disk, 0)
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Cannot submit to a closed DiskScheduler")
+            self.queues[disks[0]].append((disks, job))
+            self._condition.notify_all()
+
+    def close(self):
+        """No more jobs will be submitted. Workers exit once the queues are drained"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def queue_depths(self) -> dict:
+        """Nr. of jobs waiting on each disk"""
+        with self._condition:
+            return {disk: len(q) for disk, q in self.queues.items()}
+
+    def active_jobs(self) -> dict:
+        """Nr. of jobs currently running on each disk"""
+        with self._condition:
+            return dict(self.active)
+
+    def _runnable(self, disk):
+        q = self.queues[disk]
+        return q and all(self.active[d] < self.limits[d] for d in q[0][0])
+
+    def _take(self, home_disk):
+        """Next job for a worker, or None once closed and drained. Must hold the condition"""
+        while True:
+            if home_disk is not None and self._runnable(home_disk):
+                disk = home_disk
+            else:
+                # Work stealing: the deepest queue that can start right now
+                candidates = [d for d in self.queues if self._runnable(d)]
+                disk = max(candidates, key=lambda d: len(self.queues[d])) if candidates else None
+
+            if disk is not None:
+                disks, job = self.queues[disk].popleft()
+                for d in disks:
+                    self.active[d] += 1
+                return disks, job
+
+            if self._closed and not any(self.queues.values()):
+                return None
+            self._condition.wait()
+
+    def _worker(self, handler, home_disk):
+        while True:
+            with self._condition:
+                taken = self._take(home_disk)
+            if taken is None:
+                return
+
+            disks, job = taken
+            try:
+                handler(job)
+            except Exception as e:
+                self.errors.append((job, e))
+                print(f"Error running job on {', '.join(disks)}: {e}")
+            finally:
+                with self._condition:
+                    for d in disks:
+                        self.active[d] -= 1
+                    self._condition.notify_all()
+
+    def run(self, num_workers, handler, status_interval=None):
+        """
+        Process jobs with num_workers threads until close() was called and every queue is empty. Jobs may keep
+        being submitted from other threads while this runs
+
+        Args:
+            num_workers (int): Nr. of worker threads. Worker i prefers disk i (mod nr. of disks)
+            handler (callable): Called with each job. Exceptions are collected in self.errors
+            status_interval (float): If set, print the per-disk queue depths every status_interval seconds
+        """
+        disks = list(self.queues)
+        threads = [threading.Thread(target=self._worker, args=(handler, disks[i % len(disks)] if disks else None))
+                   for i in range(num_workers)]
+        for t in threads:
+            t.start()
+
+        if status_interval is not None:
+            while any(t.is_alive() for t in threads):
+                next(t for t in threads if t.is_alive()).join(timeout=status_interval)
+                depths = {disk: depth for disk, depth in self.queue_depths().items() if depth}
+                print(f"Queued jobs per disk: {depths}")
+
+        for t in threads:
+            t.join()
@@ -0,0 +1,296 @@
+"""
+    Sharded layout of Zarr groups: every array's chunk files packed into a few shard files, plus one offset index.
+
+    A 512^3 group with 64^3 chunks holds 512 chunk files per variable, so about 2,048 files per group and 13,000,000
+    per 105-timestep dataset, which is what FileDB's inode counts, copytree(), rmtree() and
+    delete_backup_directories() pay for. shard_group() packs the chunk files of each array into shards_per_array
+    files, in Morton order of their first 3 chunk indices so neighboring chunks sit next to each other, and records
+    where every chunk is in the group's INDEX_NAME. Metadata files (.zgroup, .zarray, .zattrs, ...) stay as they are.
+    A sharded group has about 15 files.
+
+    ShardedStore is a read-only Zarr store over a sharded group. It serves every chunk with a single positioned read
+    (os.pread) of its byte range, and get_chunk_range() gives that range for readers that fetch byte ranges
+    themselves. get_store() opens either layout. unshard_group() converts back to one file per chunk.
+
+    Open sharded groups with get_store(): a plain zarr.DirectoryStore finds no chunk files in them and returns the
+    fill value everywhere.
+"""
+import json
+import math
+import os
+import shutil
+import threading
+from collections.abc import MutableMapping
+
+import numpy as np
+import zarr
+
+from . import morton_utils
+
+# Offset index of a sharded group, at its root. Zarr ignores it
+INDEX_NAME = '.zshards'
+LAYOUTS = ('directory', 'sharded')
+
+
+def is_sharded_group(group_path: str) -> bool:
+    """Whether a Zarr group has the sharded layout"""
+    return os.path.exists(os.path.join(group_path, INDEX_NAME))
+
+
+def get_store(group_path: str):
+    """A Zarr store for a group of either layout: ShardedStore for sharded groups, zarr.DirectoryStore otherwise"""
+    if is_sharded_group(group_path):
+        return ShardedStore(group_path)
+    return zarr.DirectoryStore(group_path)
+
+
+def list_group_files(group_path: str) -> tuple:
+    """
+    The files of a Zarr group in the directory layout, relative to it with '/' separators
+
+    Returns:
+        tuple: (list of metadata files, whose name starts with '.', dict array path -> list of its chunk files)
+    """
+    metadata, chunks = [], {}
+    for root, dirs, files in os.walk(group_path):
+        dirs.sort()
+        relative_root = os.path.relpath(root, group_path).replace(os.sep, '/')
+        for filename in sorted(files):
+            key = filename if relative_root == '.' else f'{relative_root}/{filename}'
+            if filename.startswith('.'):
+                metadata.append(key)
+
+    arrays = sorted(os.path.dirname(key) for key in metadata if os.path.basename(key) == '.zarray')
+    for root, dirs, files in os.walk(group_path):
+        relative_root = os.path.relpath(root, group_path).replace(os.sep, '/')
+        # Chunk files of nested ('/' separated) keys sit in sub-folders of their array
+        array = max((a for a in arrays if relative_root == a or relative_root.startswith(a + '/')), key=len,
+                    default=None)
+        if array is None:
+            continue
+        chunks.setdefault(array, []).extend(f'{relative_root}/{filename}' for filename in files
+                                            if not filename.startswith('.'))
+
+    return metadata, chunks
+
+
+def sort_chunks_by_morton(array: str, keys: list) -> list:
+    """Chunk files of an array, e.g. 'velocity/1.0.2.0', in Morton order of their first 3 chunk indices"""
+    indices = np.array([[int(i) for i in key[len(array) + 1:].replace('/', '.').split('.')[:3]] for key in keys],
+                       dtype=np.int64).reshape(-1, 3)
+    if not len(indices):
+        return []
+
+    bits = max(1, math.ceil(math.log2(indices.max() + 1)))
+    codes = morton_utils.encode(indices[:, 2], indices[:, 1], indices[:, 0], bits)
+
+    return [keys[i] for i in np.argsort(codes, kind='stable')]
+
+
+def shard_group(source: str, dest: str, shards_per_array: int = 1) -> dict:
+    """
+    Write a copy of a directory-layout Zarr group in the sharded layout. Written under dest + '.sharding' and renamed
+    into place when complete
+
+    Args:
+        source (str): Zarr group in the directory layout
+        dest (str): Path of the sharded group. Must not exist
+        shards_per_array (int): Shard files per array. Each holds a contiguous Morton range of about the same nr. of
+            chunks
+
+    Returns:
+        dict: The index, dict(shards=[shard file, ...], chunks={chunk key: [shard nr., offset, nbytes]})
+    """
+    if os.path.exists(dest):
+        raise FileExistsError(f"{dest} already exists")
+    staging_path = dest.rstrip('/') + '.sharding'
+    if os.path.exists(staging_path):
+        shutil.rmtree(staging_path)
+
+    metadata, chunks = list_group_files(source)
+    index = dict(shards=[], chunks={})
+    for key in metadata:
+        os.makedirs(os.path.dirname(os.path.join(staging_path, key)), exist_ok=True)
+        shutil.copyfile(os.path.join(source, key), os.path.join(staging_path, key))
+
+    for array, keys in sorted(chunks.items()):
+        keys = sort_chunks_by_morton(array, keys)
+        nr_shards = max(1, min(shards_per_array, len(keys)))
+        for part in np.array_split(np.arange(len(keys)), nr_shards):
+            shard = f'{array}/shard.{len([s for s in index["shards"] if s.startswith(array + "/")])}'
+            index['shards'].append(shard)
+            offset = 0
+            with open(os.path.join(staging_path, shard), 'wb') as out:
+                for i in part:
+                    with open(os.path.join(source, keys[i]), 'rb') as f:
+                        data = f.read()
+                    out.write(data)
+                    index['chunks'][keys[i]] = [len(index['shards']) - 1, offset, len(data)]
+                    offset += len(data)
+
+    with open(os.path.join(staging_path, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    os.rename(staging_path, dest)
+
+    return index
+
+
+def unshard_group(source: str, dest: str):
+    """
+    Write a copy of a sharded Zarr group in the directory layout, one file per chunk. Written under
+    dest + '.unsharding' and renamed into place when complete
+
+    Args:
+        source (str): Sharded Zarr group
+        dest (str): Path of the directory-layout group. Must not exist
+    """
+    if os.path.exists(dest):
+        raise FileExistsError(f"{dest} already exists")
+    staging_path = dest.rstrip('/') + '.unsharding'
+    if os.path.exists(staging_path):
+        shutil.rmtree(staging_path)
+
+    store = ShardedStore(source)
+    try:
+        for key in store:
+            path = os.path.join(staging_path, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(store[key])
+    finally:
+        store.close()
+    os.rename(staging_path, dest)
+
+
+def convert_in_place(group_path: str, layout: str, shards_per_array: int = 1):
+    """
+    Convert a Zarr group to a layout, replacing the original once the converted copy is complete. Does nothing if
+    the group already has the layout
+
+    Args:
+        group_path (str): Zarr group
+        layout (str): One of LAYOUTS
+        shards_per_array (int): See shard_group()
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout '{layout}'. Use one of {LAYOUTS}")
+    group_path = group_path.rstrip('/')
+    if (layout == 'sharded') == is_sharded_group(group_path):
+        return
+
+    converted = group_path + '.converted'
+    if os.path.exists(converted):
+        shutil.rmtree(converted)
+    if layout == 'sharded':
+        shard_group(group_path, converted, shards_per_array)
+    else:
+        unshard_group(group_path, converted)
+
+    old_path = group_path + '.old'
+    os.rename(group_path, old_path)
+    os.rename(converted, group_path)
+    shutil.rmtree(old_path)
+
+
+class ShardedStore(MutableMapping):
+    """
+    Read-only Zarr store over a sharded group. Shard files are opened once and read with os.pread(), so the store
+    can be shared between threads. Close it, or use it as a context manager, to release the shard files; they are
+    also closed when the store is garbage collected
+
+    Args:
+        path (str): Sharded Zarr group, see shard_group()
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fds = {}
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            index = json.load(f)
+        self.shards = index['shards']
+        self.chunks = index['chunks']
+        self._reading = 0  # Reads in progress, which close() waits for
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        for fd in getattr(self, '_fds', {}).values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def get_chunk_range(self, key: str) -> tuple:
+        """(shard file path, offset, nbytes) of a chunk, for byte-range reads. KeyError if the chunk is missing"""
+        shard, offset, nbytes = self.chunks[key]
+        return os.path.join(self.path, self.shards[shard]), offset, nbytes
+
+    def _start_read(self, shard: int) -> int:
+        """File descriptor of a shard, opened on first use. Pair with _end_read()"""
+        with self._condition:
+            if shard not in self._fds:
+                self._fds[shard] = os.open(os.path.join(self.path, self.shards[shard]), os.O_RDONLY)
+            self._reading += 1
+            return self._fds[shard]
+
+    def _end_read(self):
+        with self._condition:
+            self._reading -= 1
+            self._condition.notify_all()
+
+    def __getitem__(self, key):
+        if key in self.chunks:
+            shard, offset, nbytes = self.chunks[key]
+            fd = self._start_read(shard)
+            try:
+                return os.pread(fd, nbytes, offset)
+            finally:
+                self._end_read()
+
+        if not key.rsplit('/', 1)[-1].startswith('.'):  # Chunks missing from the index are fill values
+            raise KeyError(key)
+        try:
+            with open(os.path.join(self.path, key), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.chunks:
+            return True
+        return key.rsplit('/', 1)[-1].startswith('.') and os.path.isfile(os.path.join(self.path, key))
+
+    def _list_metadata(self) -> list:
+        metadata, _ = list_group_files(self.path)
+        return [key for key in metadata if key != INDEX_NAME]
+
+    def __iter__(self):
+        yield from self._list_metadata()
+        yield from self.chunks
+
+    def __len__(self):
+        return len(self._list_metadata()) + len(self.chunks)
+
+    def listdir(self, path: str = '') -> list:
+        """Names directly below path, which zarr uses to find the arrays of a group"""
+        prefix = path.rstrip('/') + '/' if path else ''
+        return sorted({key[len(prefix):].split('/', 1)[0] for key in self if key.startswith(prefix)})
+
+    def __setitem__(self, key, value):
+        raise PermissionError("Sharded groups are read-only. Convert with unshard_group() to modify one")
+
+    def __delitem__(self, key):
+        raise PermissionError("Sharded groups are read-only. Convert with unshard_group() to modify one")
+
+    def close(self):
+        """Close the shard files once the reads in progress are done. Later reads open them again"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._reading == 0)
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
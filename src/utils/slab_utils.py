@@ -0,0 +1,322 @@
+"""
+    Slab-streaming ingest: read NetCDF variables as large contiguous slabs and cut them into Zarr chunks in memory.
+
+    The dask path opens the NetCDF with 64^3 chunks, so every variable is fetched as thousands of small, scattered
+    HDF5 reads. Here each read is a slab that spans the file's leading axis by a few chunk lengths, one subcube along
+    the second axis and the whole third axis. For contiguous variables every plane of a slab is one long run on disk;
+    for chunked variables slabs are aligned to the file's own chunks. Slabs are then sliced into the pieces of every
+    Zarr group they cover and written chunk-aligned, so Zarr never reads chunks back.
+"""
+import math
+import os
+import threading
+
+import netCDF4
+import numpy as np
+import xarray as xr
+import zarr
+
+from . import raw_zarr_utils
+from .scheduler_utils import DiskScheduler
+from .write_utils import MemoryBudget
+
+# Attributes xarray's CF decoding (xr.open_dataset(), the dask path) acts on when reading numbers
+CF_DECODED_ATTRIBUTES = {'_FillValue', 'missing_value', 'scale_factor', 'add_offset', '_Unsigned'}
+
+
+def get_source_layout(nc_path: str, variable: str):
+    """
+    Dimension names, shape, dtype and on-disk chunk shape of a NetCDF variable
+
+    Returns:
+        tuple: (dims, shape, dtype, chunks). chunks is None for contiguous variables
+    """
+    with netCDF4.Dataset(nc_path) as nc:
+        var = nc[variable]
+        chunking = var.chunking()
+        chunks = None if chunking == 'contiguous' or chunking is None else tuple(chunking)
+
+        return tuple(var.dimensions), tuple(var.shape), var.dtype, chunks
+
+
+def plan_slab_depth(nc_path: str, source_variables: list, group_length: int, chunk_length: int,
+                    max_bytes: int) -> int:
+    """
+    Deepest slab (along the file's leading axis) whose double-buffered footprint fits in max_bytes. A slab is
+    read while the previous one is being written, and the velocity components are interleaved into a copy, so about
+    two slabs plus one interleaved velocity block are alive at once
+
+    Args:
+        nc_path (str): NetCDF file
+        source_variables (list[str]): All NetCDF variables read per slab, e.g. ['u', 'v', 'w', 'e', 't', 'p']
+        group_length (int): Side length of one Zarr group, e.g. 512
+        chunk_length (int): Side length of one Zarr chunk, e.g. 64
+        max_bytes (int): Memory budget for slabs
+
+    Returns:
+        int: Slab depth. A multiple of chunk_length that divides group_length, rounded to the file's own chunking
+            along the leading axis where possible. Never less than chunk_length
+    """
+    dims, shape, dtype, file_chunks = get_source_layout(nc_path, source_variables[0])
+    # One slab of one variable: depth x group_length x whole third axis
+    bytes_per_plane = group_length * shape[2] * np.dtype(dtype).itemsize
+    bytes_per_depth = bytes_per_plane * (len(source_variables) * 2 + 3)
+
+    depths = [d for d in range(chunk_length, group_length + 1, chunk_length) if group_length % d == 0]
+    if file_chunks is not None:
+        # Prefer depths that read whole file chunks
+        aligned = [d for d in depths if d % file_chunks[0] == 0]
+        depths = aligned or depths
+
+    fitting = [d for d in depths if d * bytes_per_depth <= max_bytes]
+
+    return max(fitting) if fitting else min(depths)
+
+
+def read_slab(nc: netCDF4.Dataset, sources: list, lead: slice, second: slice, third: slice = slice(None)) -> np.ndarray:
+    """
+    Read one slab of one output variable
+
+    Args:
+        nc (netCDF4.Dataset): Open NetCDF file
+        sources (list[str]): NetCDF variables making up the output variable, e.g. ['u', 'v', 'w'] for velocity or
+            ['e'] for energy. They become the last axis
+        lead (slice): Range along the file's leading axis
+        second (slice): Range along the file's second axis
+        third (slice): Range along the file's third axis. Default: all of it
+
+    Returns:
+        np.ndarray: (lead, second, third, len(sources)) array in file axis order
+    """
+    components = []
+    for name in sources:
+        var = nc[name]
+        var.set_auto_maskandscale(False)  # Raw values, decoded below exactly as xarray decodes them
+        data = var[lead, second, third]
+
+        attrs = {key: var.getncattr(key) for key in var.ncattrs()}
+        if CF_DECODED_ATTRIBUTES & attrs.keys():
+            # Masking, scale_factor/add_offset and _Unsigned, with xarray's dtype rules, so both ingests agree
+            data = xr.conventions.decode_cf_variable(name, xr.Variable(var.dimensions, data, attrs)).values
+        components.append(data)
+
+    if len(components) == 1:
+        return components[0][..., np.newaxis]
+
+    return np.stack(components, axis=-1)
+
+
+def iter_slabs(nc_path: str, variables: dict, group_length: int, slab_depth: int):
+    """
+    Stream a whole NetCDF file as slabs
+
+    Args:
+        nc_path (str): NetCDF file
+        variables (dict): Output variable name -> list of NetCDF variables, e.g. {'velocity': ['u', 'v', 'w'],
+            'energy': ['e']}
+        group_length (int): Band width along the file's second axis, e.g. 512
+        slab_depth (int): Slab depth along the file's leading axis, see plan_slab_depth()
+
+    Yields:
+        tuple: (file dims, {dim name: slab start}, {output variable: slab array in file axis order})
+    """
+    first_source = next(iter(variables.values()))[0]
+    dims, shape, _, _ = get_source_layout(nc_path, first_source)
+
+    with netCDF4.Dataset(nc_path) as nc:
+        for lead_start in range(0, shape[0], slab_depth):
+            lead = slice(lead_start, min(lead_start + slab_depth, shape[0]))
+            for second_start in range(0, shape[1], group_length):
+                second = slice(second_start, min(second_start + group_length, shape[1]))
+                slabs = {name: read_slab(nc, sources, lead, second) for name, sources in variables.items()}
+
+                yield dims, {dims[0]: lead_start, dims[1]: second_start, dims[2]: 0}, slabs
+
+
+def get_slab_pieces(dims, slab_starts: dict, slab_shape: tuple, groups: list, out_dims: tuple):
+    """
+    Where a slab overlaps each Zarr group
+
+    Args:
+        dims (tuple[str]): Dimension names of the slab (file axis order)
+        slab_starts (dict): Dimension name -> global start of the slab
+        slab_shape (tuple): Shape of the slab's first 3 axes
+        groups (list): (key, {dim name: (global start, global end)}) of every group that may be written
+        out_dims (tuple[str]): Axis order of the Zarr arrays, e.g. ('nnz', 'nny', 'nnx')
+
+    Returns:
+        list: (key, slab selection in file axis order, Zarr selection in out_dims order) of every overlap
+    """
+    pieces = []
+    for key, ranges in groups:
+        slab_selection = []
+        for axis, dim in enumerate(dims):
+            start = max(ranges[dim][0], slab_starts[dim])
+            end = min(ranges[dim][1], slab_starts[dim] + slab_shape[axis])
+            if start >= end:
+                break
+            slab_selection.append(slice(start - slab_starts[dim], end - slab_starts[dim]))
+        else:
+            zarr_selection = []
+            for dim in out_dims:
+                axis = dims.index(dim)
+                start = slab_selection[axis].start + slab_starts[dim] - ranges[dim][0]
+                zarr_selection.append(slice(start, start + slab_selection[axis].stop - slab_selection[axis].start))
+            pieces.append((key, tuple(slab_selection), tuple(zarr_selection)))
+
+    return pieces
+
+
+def write_piece(group_path: str, slabs: dict, dims, slab_selection: tuple, zarr_selection: tuple, out_dims: tuple,
+                writer='xarray', sync_policy='none'):
+    """
+    Write the part of a slab that falls into one Zarr group. The group's arrays must already exist
+
+    Args:
+        group_path (str): Zarr group
+        slabs (dict): Output variable -> slab array, as yielded by iter_slabs()
+        dims (tuple[str]): Dimension names of the slab (file axis order)
+        slab_selection (tuple[slice]): Part of the slab to write, in file axis order
+        zarr_selection (tuple[slice]): Where it goes in the group, in out_dims order
+        out_dims (tuple[str]): Axis order of the Zarr arrays
+        writer (str): 'xarray' writes through Zarr. 'raw' writes the chunk files of uncompressed arrays directly,
+            see raw_zarr_utils.write_array(). Compressed arrays are always written through Zarr
+        sync_policy (str): Raw writer only. See raw_zarr_utils.write_chunk_file()
+    """
+    transpose = [dims.index(dim) for dim in out_dims] + [3]
+    group = None
+
+    for name, slab in slabs.items():
+        block = slab[slab_selection].transpose(transpose)
+        array_path = os.path.join(group_path, name)
+        if writer == 'raw':
+            metadata = raw_zarr_utils.read_array_metadata(array_path)
+            if raw_zarr_utils.is_raw_array(metadata):
+                start = tuple(s.start for s in zarr_selection) + (0,)
+                raw_zarr_utils.write_array(array_path, block, start, sync_policy, metadata)
+                continue
+
+        if group is None:
+            group = zarr.open_group(group_path, mode='r+')
+        group[name][zarr_selection] = block
+
+
+def estimate_slab_bytes(nc_path: str, variables: dict, group_length: int, slab_depth: int) -> int:
+    """Memory taken by the slabs of all output variables at one position"""
+    first_source = next(iter(variables.values()))[0]
+    _, shape, dtype, _ = get_source_layout(nc_path, first_source)
+    nr_components = sum(len(sources) for sources in variables.values())
+
+    return math.prod((slab_depth, group_length, shape[2], nr_components)) * np.dtype(dtype).itemsize
+
+
+def stream_slabs_to_groups(sources, group_length: int, chunk_length: int, num_threads: int = 34,
+                           max_bytes: int = 8 * 1024 ** 3, max_writes_per_disk=1, on_group_done=None,
+                           writer='xarray', sync_policy='none') -> dict:
+    """
+    Read NetCDF files slab by slab and write every slab's pieces into existing Zarr groups. A reader thread
+    stays at most max_bytes of slabs ahead of the writers, which are scheduled per destination disk
+
+    Args:
+        sources (iterable): (nc_path, variables, out_dims, groups) per file, consumed lazily by the reader thread.
+            variables maps output variable -> NetCDF variables (see iter_slabs()). groups is a list of dicts with
+            'ranges' ({dim name: (global start, global end)}), 'path' (Zarr group whose arrays already exist) and
+            'disk' (for scheduling)
+        group_length (int): Side length of one Zarr group
+        chunk_length (int): Side length of one Zarr chunk
+        num_threads (int): Nr. of writer threads
+        max_bytes (int): Memory budget for slabs read but not yet fully written
+        max_writes_per_disk (int or dict): See scheduler_utils.DiskScheduler
+        on_group_done (callable): Called with (group, error) once all pieces of a group are written. error is the
+            first exception raised while writing the group, or None
+        writer (str), sync_policy (str): See write_piece()
+
+    Returns:
+        dict: 'bytes_read', 'errors' (list of (group path, exception))
+    """
+    scheduler = DiskScheduler([], max_writes_per_disk)
+    budget = MemoryBudget(max_bytes)
+    lock = threading.Lock()
+    pieces_left = {}  # group path -> nr. of pieces not yet written
+    group_errors = {}  # group path -> first exception
+    slab_refs = {}  # slab nr. -> [nr. of pieces not yet written, bytes]
+    stats = dict(bytes_read=0, errors=[])
+    reader_errors = []
+
+    def write_job(job):
+        slab_id, group, slabs, dims, slab_selection, zarr_selection, out_dims = job
+        error = None
+        try:
+            write_piece(group['path'], slabs, dims, slab_selection, zarr_selection, out_dims, writer, sync_policy)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with lock:
+                slab_refs[slab_id][0] -= 1
+                release = slab_refs[slab_id][1] if slab_refs[slab_id][0] == 0 else None
+                if release is not None:
+                    del slab_refs[slab_id]
+                if error is not None:
+                    group_errors.setdefault(group['path'], error)
+                pieces_left[group['path']] -= 1
+                group_done = pieces_left[group['path']] == 0
+            if release is not None:
+                budget.release(release)
+            if group_done and on_group_done is not None:
+                on_group_done(group, group_errors.get(group['path']))
+
+    def read():
+        slab_id = 0
+        try:
+            for nc_path, variables, out_dims, groups in sources:
+                if not groups:
+                    continue
+                slab_depth = plan_slab_depth(nc_path, [s for names in variables.values() for s in names],
+                                             group_length, chunk_length, max_bytes)
+                slab_bytes = estimate_slab_bytes(nc_path, variables, group_length, slab_depth)
+                print(f"Reading {nc_path} in slabs of depth {slab_depth} ({slab_bytes / 1024 ** 2:.0f} MB)")
+
+                with lock:
+                    for group in groups:
+                        pieces_left[group['path']] = math.ceil(group_length / slab_depth)
+                group_keys = [(i, group['ranges']) for i, group in enumerate(groups)]
+
+                slabs_iter = iter_slabs(nc_path, variables, group_length, slab_depth)
+                while True:
+                    budget.acquire(slab_bytes)
+                    try:
+                        dims, slab_starts, slabs = next(slabs_iter)
+                    except StopIteration:
+                        budget.release(slab_bytes)
+                        break
+                    stats['bytes_read'] += sum(slab.nbytes for slab in slabs.values())
+
+                    slab_shape = next(iter(slabs.values())).shape[:3]
+                    pieces = get_slab_pieces(dims, slab_starts, slab_shape, group_keys, out_dims)
+                    if not pieces:
+                        budget.release(slab_bytes)
+                        continue
+
+                    with lock:
+                        slab_refs[slab_id] = [len(pieces), slab_bytes]
+                    for i, slab_selection, zarr_selection in pieces:
+                        scheduler.submit(groups[i]['disk'], (slab_id, groups[i], slabs, dims, slab_selection,
+                                                             zarr_selection, out_dims))
+                    slab_id += 1
+        except Exception as e:
+            reader_errors.append(e)
+            print(f"Error reading slabs: {e}")
+        finally:
+            scheduler.close()
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    scheduler.run(num_threads, write_job)
+    reader.join()
+
+    stats['errors'] = [(job[1]['path'], error) for job, error in scheduler.errors]
+    if reader_errors:
+        raise reader_errors[0]
+
+    return stats
@@ -0,0 +1,162 @@
+"""
+    Batched stencil gather: the side^3 neighborhoods of many points of a chunked array, reading every touched chunk
+    exactly once.
+
+    access_patterns.index_8_interpolation() slices one 8^3 neighborhood per point, so Zarr reads and decodes up to
+    eight whole 64^3 chunks for every point, again and again for nearby points. gather_stencils() first works out
+    which chunks each stencil overlaps, visits those chunks in Morton order and fills the part of every stencil that
+    falls into the current chunk with vectorized NumPy indexing.
+"""
+import math
+
+import numpy as np
+
+from . import morton_utils
+
+
+def get_stencil_corners(indices, side: int = 8) -> np.ndarray:
+    """
+    Lowest corner of the stencil of every point. Stencils span [index - side // 2, index + side // 2), like the
+    slices of access_patterns.index_8_interpolation()
+
+    Args:
+        indices (array-like): (N, 3) integer coordinates, in the array's axis order
+        side (int): Stencil side length
+
+    Returns:
+        np.ndarray: (N, 3) int64 corners
+    """
+    indices = np.asarray(indices)
+    if indices.ndim != 2 or indices.shape[1] != 3:
+        raise ValueError(f"indices must have shape (N, 3), got {indices.shape}")
+
+    return indices.astype(np.int64) - side // 2
+
+
+def get_chunk_visits(corners: np.ndarray, side: int, chunks, grid=None) -> tuple:
+    """
+    Every (point, chunk) pair where a stencil overlaps a chunk, ordered by the Morton code of the chunk
+
+    Args:
+        corners (np.ndarray): (N, 3) stencil corners, see get_stencil_corners()
+        side (int): Stencil side length
+        chunks (tuple): Chunk shape of the first 3 axes
+        grid (tuple): Nr. of chunks along the first 3 axes. If given, chunks outside the grid are left out
+
+    Returns:
+        tuple: (point indices (P,), chunk indices (P, 3), start of each chunk's run in the two arrays, ending
+            with P)
+    """
+    chunks = np.asarray(chunks[:3], dtype=np.int64)
+    first = corners // chunks
+    last = (corners + side - 1) // chunks
+
+    # A stencil no larger than a chunk overlaps at most 2 chunks per axis
+    points, chunk_indices = [], []
+    spans = (last - first).max(axis=0) + 1 if len(corners) else np.ones(3, dtype=np.int64)
+    for offset in np.ndindex(*spans):
+        chunk = first + offset
+        overlapping = np.all(chunk <= last, axis=1)
+        if grid is not None:
+            overlapping &= np.all((chunk >= 0) & (chunk < np.asarray(grid[:3])), axis=1)
+        points.append(np.flatnonzero(overlapping))
+        chunk_indices.append(chunk[overlapping])
+    points = np.concatenate(points)
+    chunk_indices = np.concatenate(chunk_indices)
+
+    bits = max(1, math.ceil(math.log2(int(chunk_indices.max()) + 1))) if len(chunk_indices) else 1
+    codes = morton_utils.encode(chunk_indices[:, 2], chunk_indices[:, 1], chunk_indices[:, 0], bits)
+    order = np.argsort(codes, kind='stable')
+    points, chunk_indices, codes = points[order], chunk_indices[order], codes[order]
+    run_starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=int)
+
+    return points, chunk_indices, np.r_[run_starts, len(codes)]
+
+
+def _fill_from_chunk(out, block, points, local, side):
+    """Copy the parts of the stencils of points that fall into one chunk's data block. local: (P, 3) corners"""
+    inside = np.all((local >= 0) & (local + side <= np.array(block.shape[:3])), axis=1)
+
+    # Stencils entirely inside the chunk: one fancy index into a sliding-window view of the block
+    if inside.any():
+        windows = np.lib.stride_tricks.sliding_window_view(block, (side, side, side), axis=(0, 1, 2))
+        whole = local[inside]
+        gathered = windows[whole[:, 0], whole[:, 1], whole[:, 2]]  # (P, *trailing, side, side, side)
+        out[points[inside]] = np.moveaxis(gathered, (-3, -2, -1), (1, 2, 3))
+
+    # Stencils straddling the chunk's faces: only their cells inside the chunk
+    if not inside.all():
+        points, local = points[~inside], local[~inside]
+        offsets = np.arange(side)
+        coords = [local[:, axis, np.newaxis] + offsets for axis in range(3)]  # 3 x (P, side)
+        valid = [(c >= 0) & (c < n) for c, n in zip(coords, block.shape[:3])]
+        mask = valid[0][:, :, None, None] & valid[1][:, None, :, None] & valid[2][:, None, None, :]
+        p, i, j, k = np.nonzero(mask)
+        out[points[p], i, j, k] = block[coords[0][p, i], coords[1][p, j], coords[2][p, k]]
+
+
+def fill_stencils(array, corners: np.ndarray, side: int, out: np.ndarray, rows=None, chunks=None):
+    """
+    Copy the parts of side^3 stencils that lie inside array into out, reading each chunk they touch exactly once.
+    Cells of a stencil outside the array are left untouched, so stencils straddling several arrays can be assembled
+    with one call per array
+
+    Args:
+        array: Zarr array (or anything sliceable with a chunks attribute)
+        corners (np.ndarray): (N, 3) stencil corners relative to the array's origin. May lie outside it
+        side (int): Stencil side length. At most the chunk length
+        out (np.ndarray): (M, side, side, side, *array.shape[3:]) buffer to fill
+        rows (np.ndarray): (N,) row of out each stencil goes to. Defaults to 0 ... N - 1
+        chunks (tuple): Chunk shape, if array has no chunks attribute
+    """
+    chunks = tuple(chunks if chunks is not None else array.chunks)
+    shape = tuple(array.shape)
+    if side > min(chunks[:3]):
+        raise ValueError(f"Stencil side {side} is larger than the chunks {chunks[:3]}")
+    rows = np.arange(len(corners)) if rows is None else np.asarray(rows)
+
+    grid = [math.ceil(n / c) for n, c in zip(shape[:3], chunks[:3])]
+    points, chunk_indices, run_starts = get_chunk_visits(corners, side, chunks, grid)
+    for start, end in zip(run_starts[:-1], run_starts[1:]):
+        chunk = chunk_indices[start]
+        origin = chunk * np.array(chunks[:3])
+        selection = tuple(slice(o, min(o + c, n)) for o, c, n in zip(origin, chunks[:3], shape[:3]))
+        block = np.asarray(array[selection])  # One whole chunk: decoded once
+        _fill_from_chunk(out, block, rows[points[start:end]], corners[points[start:end]] - origin, side)
+
+
+def gather_stencils(array, indices, side: int = 8, out: np.ndarray = None, chunks=None) -> np.ndarray:
+    """
+    The side^3 neighborhood of every point, reading each chunk the neighborhoods touch exactly once
+
+    Args:
+        array: Zarr array (or anything sliceable with a chunks attribute), e.g. group['velocity'] of shape
+            (512, 512, 512, 3). Axes after the first 3 are returned whole
+        indices (array-like): (N, 3) integer coordinates of the points, in the array's axis order. Every stencil
+            must lie inside the array
+        side (int): Stencil side length. At most the chunk length
+        out (np.ndarray): Optional result buffer to fill, see Returns
+        chunks (tuple): Chunk shape, if array has no chunks attribute
+
+    Returns:
+        np.ndarray: (N, side, side, side, *array.shape[3:]) neighborhoods, e.g. (N, 8, 8, 8, 3) for velocity.
+            out[n] equals array[z - side // 2:z + side // 2, ...] for the n-th point (z, y, x). That is 6 KB per
+            point for float32 velocity, so gather 10^7 points in batches
+
+    Raises:
+        ValueError: If a stencil sticks out of the array or is larger than a chunk
+    """
+    shape = tuple(array.shape)
+    corners = get_stencil_corners(indices, side)
+    if len(corners) and ((corners < 0).any() or (corners + side > np.array(shape[:3])).any()):
+        raise ValueError(f"Some stencils of side {side} stick out of the array of shape {shape[:3]}")
+
+    result_shape = (len(corners), side, side, side) + shape[3:]
+    if out is None:
+        out = np.empty(result_shape, dtype=array.dtype)
+    elif out.shape != result_shape:
+        raise ValueError(f"out has shape {out.shape}, expected {result_shape}")
+
+    fill_stencils(array, corners, side, out, chunks=chunks)
+
+    return out
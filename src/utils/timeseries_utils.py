@@ -0,0 +1,269 @@
+"""
+    Time-series reads: the history of a region or of many points over a range of timesteps, as one (T, ...) array.
+
+    Every timestep of a dataset is stored as separate {name}{subcube}_{timestep}.zarr groups, so the history of a
+    point over 105 timesteps touches 105 groups. TimeSeriesReader keeps one halo_utils.HaloReader per timestep, whose
+    open group handles are reused by later queries, splits a query into the pieces of every timestep's groups and
+    reads all of them in a single scheduler_utils.DiskScheduler run, so the reads of different timesteps overlap
+    across disks. Every piece is copied straight into the preallocated (T, z, y, x[, 3]) result.
+
+    Datasets whose queries are mostly temporal can also get a time-chunked companion layout: per subcube and range
+    of timesteps one group whose arrays have the timesteps as their 4th axis, (z, y, x, T[, 3]), in chunks that are
+    small in space and span all its timesteps. write_time_chunked_group() builds it from the timestep groups. The
+    history of a small region is then a few chunk reads instead of at least one per timestep. Prod writes are split
+    into timestep ranges over several jobs, so every range gets companions of its own.
+"""
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import zarr
+
+from . import shard_utils, stencil_utils, write_utils
+from .halo_utils import HaloReader
+from .scheduler_utils import DiskScheduler
+
+# Timesteps whose groups are kept open. 105 covers a whole NCAR dataset
+DEFAULT_MAX_OPEN_TIMESTEPS = 128
+
+# Spatial chunk length of the time-chunked layout. A velocity chunk of 16^3 points x 105 timesteps is 5 MB
+DEFAULT_TIME_CHUNK_LENGTH = 16
+
+
+class TimeSeriesReader:
+    """
+    Reads a variable of one dataset over many timesteps in global (z, y, x) coordinates
+
+    Attributes
+    ----------
+    variable : str
+        Variable read
+    time_chunked : list[HaloReader]
+        Reader of every set of time-chunked companion groups, one set per timestep range. A query is served by the
+        first set holding all its timesteps
+
+    Args:
+        get_placements (callable): timestep -> placement rows of its groups, e.g. Dataset.get_placements
+        variable (str): Variable to read, e.g. 'velocity'
+        max_reads_per_disk (int or dict): See scheduler_utils.DiskScheduler
+        cache (cache_utils.ChunkCache): Serve chunk files through this cache, see halo_utils.HaloReader
+        read_ahead (int): Chunks to read ahead on a cache miss, see cache_utils.CachingStore
+        max_open_timesteps (int): Keep the groups of at most this many timesteps open, least recently used dropped
+        time_chunked_placements (list[list[dict]]): Placement rows of every set of time-chunked companion groups,
+            one row per subcube in each set, see write_time_chunked_group(). None reads the timestep groups only
+    """
+
+    def __init__(self, get_placements, variable: str = 'velocity', max_reads_per_disk=1, cache=None,
+                 read_ahead: int = 0, max_open_timesteps: int = DEFAULT_MAX_OPEN_TIMESTEPS,
+                 time_chunked_placements=None):
+        self.get_placements = get_placements
+        self.variable = variable
+        self.max_reads_per_disk = max_reads_per_disk
+        self.reader_options = dict(max_reads_per_disk=max_reads_per_disk, cache=cache, read_ahead=read_ahead)
+        self.max_open_timesteps = max_open_timesteps
+
+        self._readers = OrderedDict()  # timestep -> HaloReader, least recently used first
+        self._lock = threading.Lock()
+
+        self.time_chunked = []
+        self._time_chunked_indices = []  # Per set, timestep -> index along the 4th axis of its arrays
+        for placements in time_chunked_placements or []:
+            self.time_chunked.append(HaloReader(placements, variable, **self.reader_options))
+            with shard_utils.get_store(placements[0]['path']) as store:
+                timesteps = zarr.open_group(store, mode='r').attrs['timesteps']
+            self._time_chunked_indices.append({timestep: i for i, timestep in enumerate(timesteps)})
+
+    def get_reader(self, timestep: int) -> HaloReader:
+        """The HaloReader of a timestep. Created on first use and kept, with its open groups, for later queries"""
+        with self._lock:
+            if timestep in self._readers:
+                self._readers.move_to_end(timestep)
+                return self._readers[timestep]
+
+        placements = self.get_placements(timestep)
+        if not placements:
+            raise ValueError(f"No placements for timestep {timestep}")
+        reader = HaloReader(placements, self.variable, **self.reader_options)
+
+        with self._lock:
+            if self._readers.setdefault(timestep, reader) is not reader:  # Another thread opened it first
+                reader.close()
+                reader = self._readers[timestep]
+            self._readers.move_to_end(timestep)
+            evicted = [self._readers.popitem(last=False)[1]
+                       for _ in range(len(self._readers) - self.max_open_timesteps)]
+        # Queries still reading from an evicted reader are waited for, see shard_utils.ShardedStore.close()
+        for old_reader in evicted:
+            old_reader.close()
+        return reader
+
+    def close(self):
+        """Close the files of all open timesteps and of the time-chunked groups"""
+        with self._lock:
+            readers = list(self._readers.values())
+            self._readers.clear()
+        for reader in readers + self.time_chunked:
+            reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_time_chunked(self, timesteps):
+        """The reader of the first time-chunked set holding all timesteps, and their indices in it. None if none does"""
+        for reader, index in zip(self.time_chunked, self._time_chunked_indices):
+            if all(t in index for t in timesteps):
+                return reader, [index[t] for t in timesteps]
+        return None
+
+    def _run(self, jobs: list, num_threads: int = None):
+        """
+        Run every (reader, group, read) job, where read() reads one piece, on per-disk work lists shared by all
+        timesteps. Raises the first error
+
+        Args:
+            jobs (list[tuple]): (HaloReader, placement index, callable) triples
+            num_threads (int): Worker threads. Defaults to the sum of the limits of the disks touched
+        """
+        scheduler = DiskScheduler([], self.max_reads_per_disk)
+        for job in jobs:
+            reader, group, _ = job
+            scheduler.submit(reader.placements[group]['disk'], job)
+        scheduler.close()
+
+        if num_threads is None:
+            num_threads = sum(scheduler.limits.values())
+        scheduler.run(max(1, min(num_threads, len(jobs))), lambda job: job[2]())
+        if scheduler.errors:
+            (reader, group, _), error = scheduler.errors[0]
+            raise RuntimeError(f"Could not read {reader.placements[group]['path']}") from error
+
+    def read_region(self, start, shape, timesteps, out: np.ndarray = None, num_threads: int = None) -> np.ndarray:
+        """
+        A box of the variable in global coordinates at many timesteps. The pieces of all timesteps are read
+        concurrently, per disk
+
+        Args:
+            start (tuple): Global (z, y, x) of the box's first point
+            shape (tuple): (z, y, x) size of the box
+            timesteps (list[int]): Timesteps to read, in the order of the result
+            out (np.ndarray): Optional result buffer to fill, see Returns
+            num_threads (int): Concurrent reads. Defaults to the sum of the limits of the disks touched
+
+        Returns:
+            np.ndarray: (len(timesteps), *shape, *rest) block, e.g. (T, z, y, x, 3) for velocity
+        """
+        timesteps = list(timesteps)
+        start, end = np.array(start, dtype=np.int64), np.array(start, dtype=np.int64) + np.array(shape)
+
+        time_chunked = self._get_time_chunked(timesteps)
+        if time_chunked is not None:
+            reader, indices = time_chunked
+            block = np.moveaxis(reader.read_region(start, shape, num_threads=num_threads).take(indices, axis=3), 3, 0)
+            if out is None:
+                return block
+            out[...] = block
+            return out
+
+        readers = [self.get_reader(timestep) for timestep in timesteps]
+        result_shape = (len(timesteps),) + tuple(int(n) for n in shape) + readers[0].shape[3:]
+        if out is None:
+            out = np.empty(result_shape, dtype=readers[0].dtype)
+        elif out.shape != result_shape:
+            raise ValueError(f"out has shape {out.shape}, expected {result_shape}")
+
+        jobs = []
+        for reader, block in zip(readers, out):
+            for group, bounds in reader.get_region_pieces(start, end):
+                jobs.append((reader, group, lambda r=reader, g=group, b=bounds, o=block: r.read_region_piece(
+                    g, b, start, o)))
+        self._run(jobs, num_threads)
+
+        return out
+
+    def read_points(self, points, timesteps, num_threads: int = None) -> np.ndarray:
+        """
+        The variable at many global grid points at many timesteps, reading each chunk of every timestep once
+
+        Args:
+            points (array-like): (N, 3) global (z, y, x) coordinates
+            timesteps (list[int]): Timesteps to read, in the order of the result
+            num_threads (int): Concurrent reads. Defaults to the sum of the limits of the disks touched
+
+        Returns:
+            np.ndarray: (len(timesteps), N, *rest) values, e.g. (T, N, 3) for velocity
+        """
+        timesteps = list(timesteps)
+        time_chunked = self._get_time_chunked(timesteps)
+        if time_chunked is not None:
+            reader, indices = time_chunked
+            values = reader.read_points(points, num_threads=num_threads)  # (N, all timesteps of the set, ...)
+            return np.moveaxis(values.take(indices, axis=1), 1, 0)
+
+        corners = stencil_utils.get_stencil_corners(points, 1)
+        readers = [self.get_reader(timestep) for timestep in timesteps]
+        out = np.empty((len(timesteps), len(corners), 1, 1, 1) + readers[0].shape[3:], dtype=readers[0].dtype)
+
+        jobs = []
+        for reader, values in zip(readers, out):
+            for group, rows in reader.get_stencil_work(corners, 1):
+                jobs.append((reader, group, lambda r=reader, g=group, rows=rows, o=values: r.fill_stencil_rows(
+                    g, rows, corners, 1, o)))
+        self._run(jobs, num_threads)
+
+        return out[:, :, 0, 0, 0]
+
+
+def write_time_chunked_group(paths, timesteps, dest, variables=('velocity',),
+                             chunk_length: int = DEFAULT_TIME_CHUNK_LENGTH):
+    """
+    Write the time-chunked companion group of one subcube: every variable with the timesteps as 4th axis. The
+    source is read one chunk of all timesteps at a time, so memory stays at one source chunk per timestep. Written
+    under a staging name and renamed into place when complete
+
+    Args:
+        paths (list[str]): The subcube's Zarr group of every timestep, in time order
+        timesteps (list[int]): Timestep of each path, stored in the group's 'timesteps' attribute
+        dest (str): Path of the companion group
+        variables (tuple[str]): Variables to write
+        chunk_length (int): Spatial chunk length. Chunks span all timesteps
+
+    Returns:
+        str: dest
+    """
+    if len(paths) != len(timesteps):
+        raise ValueError(f"Got {len(paths)} paths for {len(timesteps)} timesteps")
+
+    staging_path = write_utils.get_staging_path(dest)
+    if os.path.exists(staging_path):
+        shutil.rmtree(staging_path)
+    stores = [shard_utils.get_store(path) for path in paths]
+    try:
+        sources = [zarr.open_group(store, mode='r') for store in stores]
+        group = zarr.open_group(staging_path, mode='w')
+        # Bounds and halo attributes of the subcube stay valid, see halo_utils.HaloReader
+        group.attrs.update(dict(sources[0].attrs), timesteps=[int(t) for t in timesteps])
+
+        for variable in variables:
+            arrays = [source[variable] for source in sources]
+            first = arrays[0]
+            shape = first.shape[:3] + (len(arrays),) + first.shape[3:]
+            array = group.create_dataset(variable, shape=shape, chunks=(chunk_length,) * 3 + shape[3:],
+                                         dtype=first.dtype, compressor=first.compressor, filters=first.filters)
+
+            for block in np.ndindex(*first.cdata_shape[:3]):
+                selection = tuple(slice(b * c, min((b + 1) * c, n))
+                                  for b, c, n in zip(block, first.chunks, first.shape))
+                array[selection] = np.stack([source[selection] for source in arrays], axis=3)
+    finally:
+        for store in stores:
+            store.close()
+
+    write_utils.commit_staged_group(staging_path, dest)
+    print(f"Finished writing {dest}")
+
+    return dest
@@ -0,0 +1,285 @@
+"""
+    Data correctness verification of written Zarr groups against the original NetCDF files, reading each source
+    file once.
+
+    Source files are streamed in the same slabs as the slab ingest (see slab_utils) and every slab is compared
+    with the parts of all Zarr groups it covers. Comparisons are scheduled per destination disk, so the FileDB disks
+    are read in parallel while one thread streams the source. Mismatches are reported per Zarr chunk. With a
+    fraction below 1, only a random sample of chunks is read from the source and compared, chunk by chunk, for
+    quick spot checks.
+"""
+import math
+import threading
+
+import netCDF4
+import numpy as np
+import zarr
+
+from . import shard_utils
+from .scheduler_utils import DiskScheduler
+from .slab_utils import (estimate_slab_bytes, get_slab_pieces, get_source_layout, iter_slabs, plan_slab_depth,
+                         read_slab)
+from .write_utils import MemoryBudget
+
+
+def get_stored_ranges(group_path: str, ranges: list) -> list:
+    """
+    Where the data stored in a Zarr group starts and ends, from its halo attributes (see
+    write_utils.get_halo_attrs()). Groups without them, or that do not exist, store their core ranges
+
+    Args:
+        group_path (str): Zarr group
+        ranges (list): Core [[start, end], ...] of the group
+
+    Returns:
+        list: [[dim_0 start, end], ...] of the stored data
+    """
+    try:
+        with shard_utils.get_store(group_path) as store:
+            attrs = zarr.open_group(store, mode='r').attrs.asdict()
+    except (FileNotFoundError, zarr.errors.GroupNotFoundError):
+        return ranges
+    if 'storage_start' not in attrs:
+        return ranges
+
+    return [[start, end] for start, end in zip(attrs['storage_start'], attrs['storage_end'])]
+
+
+def get_mismatched_chunks(expected: np.ndarray, actual: np.ndarray, chunk_length: int) -> np.ndarray:
+    """
+    Zarr chunks in which two blocks differ. NaNs compare equal
+
+    Args:
+        expected (np.ndarray): (z, y, x, ...) block from the source, in Zarr axis order, starting on a chunk boundary
+        actual (np.ndarray): The same block read from Zarr
+        chunk_length (int): Side length of one Zarr chunk
+
+    Returns:
+        np.ndarray: (N, 3) offsets of the differing chunks, in chunks from the blocks' first chunk
+    """
+    if expected.shape != actual.shape:
+        raise ValueError(f"Shape mismatch: source block {expected.shape}, Zarr block {actual.shape}")
+
+    differs = expected != actual
+    if np.issubdtype(expected.dtype, np.floating):
+        differs &= ~(np.isnan(expected) & np.isnan(actual))
+    differs = differs.reshape(differs.shape[:3] + (-1,)).any(axis=3)
+    for axis in range(3):
+        differs = np.logical_or.reduceat(differs, np.arange(0, differs.shape[axis], chunk_length), axis=axis)
+
+    return np.argwhere(differs)
+
+
+class VerificationReport:
+    """
+    Chunks compared and mismatches found, collected from the comparison threads
+
+    Attributes
+    ----------
+    mismatches : list[dict]
+        One dict(path, timestep, variable, chunk, start) per differing chunk. chunk is the chunk index within the
+        group, start the chunk's global (z, y, x) start
+    errors : list
+        (group path, exception) of every comparison that failed, e.g. because the group is missing
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.chunks_checked = 0
+        self.bytes_compared = 0
+        self.mismatches = []
+        self.errors = []
+
+    def add(self, group, variable, chunk_starts, chunk_offsets, nr_chunks, nbytes, chunk_length, out_dims):
+        with self._lock:
+            self.chunks_checked += nr_chunks
+            self.bytes_compared += nbytes
+            for offset in chunk_offsets:
+                chunk = tuple(int(s + o) for s, o in zip(chunk_starts, offset))
+                start = tuple(group['ranges'][dim][0] + c * chunk_length for dim, c in zip(out_dims, chunk))
+                self.mismatches.append(dict(path=group['path'], timestep=group.get('timestep'), variable=variable,
+                                            chunk=chunk, start=start))
+
+    def mismatched_groups(self) -> set:
+        """Paths of the groups with at least one differing chunk"""
+        return {mismatch['path'] for mismatch in self.mismatches}
+
+    def print_report(self):
+        print(f"Compared {self.chunks_checked} chunks ({self.bytes_compared / 1024 ** 3:.2f} GB): "
+              f"{len(self.mismatches)} mismatched, {len(self.errors)} comparisons failed")
+        for mismatch in self.mismatches:
+            print(f"Mismatch in {mismatch['path']}, {mismatch['variable']} chunk {mismatch['chunk']} "
+                  f"(global start {mismatch['start']})")
+        for path, error in self.errors:
+            print(f"Could not verify {path}: {error}")
+
+
+def compare_piece(group: dict, slabs: dict, dims, slab_selection: tuple, zarr_selection: tuple, out_dims: tuple,
+                  chunk_length: int, report: VerificationReport):
+    """
+    Compare the part of a slab that falls into one Zarr group with the group. The group is read one row of chunks
+    at a time, to bound the memory of each comparison thread
+
+    Args:
+        group (dict): 'path' and 'ranges' of the Zarr group, see verify_against_source()
+        slabs, dims, slab_selection, zarr_selection, out_dims: See slab_utils.write_piece()
+        chunk_length (int): Side length of one Zarr chunk
+        report (VerificationReport): Where results go
+    """
+    transpose = [dims.index(dim) for dim in out_dims] + [3]
+    with shard_utils.get_store(group['path']) as store:
+        zarr_group = zarr.open_group(store, mode='r')
+
+        for name, slab in slabs.items():
+            block = slab[slab_selection].transpose(transpose)
+            array = zarr_group[name]
+            rows = [range(0, n, chunk_length) for n in block.shape[:2]]
+            for row_start in np.ndindex(*[len(r) for r in rows]):
+                local = tuple(slice(r[i], r[i] + chunk_length) for r, i in zip(rows, row_start))
+                expected = block[local]
+                selection = tuple(slice(z.start + s.start, z.start + s.start + n)
+                                  for z, s, n in zip(zarr_selection, local, expected.shape)) + (zarr_selection[2],)
+                actual = array[selection]
+
+                chunk_starts = [s.start // chunk_length for s in selection]
+                offsets = get_mismatched_chunks(expected, actual, chunk_length)
+                nr_chunks = math.prod(math.ceil(n / chunk_length) for n in expected.shape[:3])
+                report.add(group, name, chunk_starts, offsets, nr_chunks, expected.nbytes, chunk_length, out_dims)
+
+
+def iter_sampled_chunks(nc_path: str, variables: dict, groups: list, chunk_length: int, fraction: float,
+                        rng: np.random.Generator):
+    """
+    Read a random sample of the Zarr chunks of some groups from a NetCDF file, in file order
+
+    Args:
+        nc_path (str): NetCDF file
+        variables (dict): Output variable -> NetCDF variables, see slab_utils.iter_slabs()
+        groups (list[dict]): Groups with their 'ranges', see verify_against_source()
+        chunk_length (int): Side length of one Zarr chunk
+        fraction (float): Fraction of each group's chunks to read, at least one per group
+        rng (np.random.Generator): Random source of the sample
+
+    Yields:
+        tuple: (file dims, {dim name: chunk start}, {output variable: chunk array in file axis order}, group index)
+    """
+    first_source = next(iter(variables.values()))[0]
+    dims, _, _, _ = get_source_layout(nc_path, first_source)
+
+    sample = []
+    for i, group in enumerate(groups):
+        grid = [math.ceil((group['ranges'][dim][1] - group['ranges'][dim][0]) / chunk_length) for dim in dims]
+        picks = rng.choice(math.prod(grid), size=max(1, math.ceil(fraction * math.prod(grid))), replace=False)
+        for chunk in zip(*np.unravel_index(picks, grid)):
+            sample.append((tuple(group['ranges'][dim][0] + int(c) * chunk_length for dim, c in zip(dims, chunk)), i))
+    sample.sort()  # File order, so reads move forward through the file
+
+    with netCDF4.Dataset(nc_path) as nc:
+        for starts, i in sample:
+            selection = [slice(s, min(s + chunk_length, groups[i]['ranges'][dim][1])) for s, dim in zip(starts, dims)]
+            chunks = {name: read_slab(nc, sources, *selection) for name, sources in variables.items()}
+
+            yield dims, dict(zip(dims, starts)), chunks, i
+
+
+def verify_against_source(sources, group_length: int, chunk_length: int, num_threads: int = 34,
+                          max_bytes: int = 8 * 1024 ** 3, max_reads_per_disk=1, fraction: float = 1.0,
+                          seed: int = 0) -> VerificationReport:
+    """
+    Compare Zarr groups with the NetCDF files they were written from. A reader thread streams each file once,
+    staying at most max_bytes ahead of the comparison threads, which are scheduled per destination disk
+
+    Args:
+        sources (iterable): (nc_path, variables, out_dims, groups) per file, as for
+            slab_utils.stream_slabs_to_groups(). Each group is a dict with 'ranges', 'path' (written Zarr group),
+            'disk' and optionally 'timestep'
+        group_length (int): Side length of one Zarr group
+        chunk_length (int): Side length of one Zarr chunk
+        num_threads (int): Nr. of comparison threads
+        max_bytes (int): Memory budget for source data read but not yet compared
+        max_reads_per_disk (int or dict): See scheduler_utils.DiskScheduler
+        fraction (float): 1 compares every chunk, streaming whole files. Below 1, compares this fraction of the
+            chunks of every group, reading only those from the source
+        seed (int): Seed of the chunk sample
+
+    Returns:
+        VerificationReport: Chunks compared, mismatches and failed comparisons
+    """
+    scheduler = DiskScheduler([], max_reads_per_disk)
+    budget = MemoryBudget(max_bytes)
+    report = VerificationReport()
+    lock = threading.Lock()
+    block_refs = {}  # block nr. -> [nr. of pieces not yet compared, bytes]
+    reader_errors = []
+
+    def compare_job(job):
+        block_id, group, blocks, dims, slab_selection, zarr_selection, out_dims = job
+        try:
+            compare_piece(group, blocks, dims, slab_selection, zarr_selection, out_dims, chunk_length, report)
+        finally:
+            with lock:
+                block_refs[block_id][0] -= 1
+                release = block_refs.pop(block_id)[1] if block_refs[block_id][0] == 0 else None
+            if release is not None:
+                budget.release(release)
+
+    def read():
+        rng = np.random.default_rng(seed)
+        block_id = 0
+        try:
+            for nc_path, variables, out_dims, groups in sources:
+                if not groups:
+                    continue
+                group_keys = [(i, group['ranges']) for i, group in enumerate(groups)]
+                nr_components = sum(len(names) for names in variables.values())
+                _, _, dtype, _ = get_source_layout(nc_path, next(iter(variables.values()))[0])
+
+                if fraction >= 1:
+                    slab_depth = plan_slab_depth(nc_path, [s for names in variables.values() for s in names],
+                                                 group_length, chunk_length, max_bytes)
+                    block_bytes = estimate_slab_bytes(nc_path, variables, group_length, slab_depth)
+                    print(f"Verifying against {nc_path} in slabs of depth {slab_depth}")
+                    blocks = ((dims, starts, slabs, group_keys)
+                              for dims, starts, slabs in iter_slabs(nc_path, variables, group_length, slab_depth))
+                else:
+                    block_bytes = chunk_length ** 3 * nr_components * np.dtype(dtype).itemsize
+                    print(f"Verifying {fraction:.1%} of the chunks of {len(groups)} groups against {nc_path}")
+                    blocks = ((dims, starts, chunks, [group_keys[i]]) for dims, starts, chunks, i
+                              in iter_sampled_chunks(nc_path, variables, groups, chunk_length, fraction, rng))
+
+                while True:
+                    budget.acquire(block_bytes)
+                    try:
+                        dims, starts, data, keys = next(blocks)
+                    except StopIteration:
+                        budget.release(block_bytes)
+                        break
+
+                    shape = next(iter(data.values())).shape[:3]
+                    pieces = get_slab_pieces(dims, starts, shape, keys, out_dims)
+                    if not pieces:
+                        budget.release(block_bytes)
+                        continue
+
+                    with lock:
+                        block_refs[block_id] = [len(pieces), block_bytes]
+                    for i, slab_selection, zarr_selection in pieces:
+                        scheduler.submit(groups[i]['disk'], (block_id, groups[i], data, dims, slab_selection,
+                                                             zarr_selection, out_dims))
+                    block_id += 1
+        except Exception as e:
+            reader_errors.append(e)
+            print(f"Error reading source data: {e}")
+        finally:
+            scheduler.close()
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    scheduler.run(num_threads, compare_job)
+    reader.join()
+
+    report.errors = [(job[1]['path'], error) for job, error in scheduler.errors]
+    if reader_errors:
+        raise reader_errors[0]
+
+    return report
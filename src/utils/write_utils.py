@@ -1,67 +1,39 @@
-import math
+import contextlib
 import os
 import queue
 import re
-import subprocess
-import sys
-from itertools import product
+import resource
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import dask
 import dask.array as da
+from dask.base import tokenize
 import numpy as np
 import xarray as xr
 
-try:
-    import morton
-except ImportError:
-    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'morton-py'])
-finally:
-    import morton
+from . import checksum_utils, morton_utils, node_assignment_utils, raw_zarr_utils, shard_utils
 
 
-def node_assignment(cube_side: int):
+def node_assignment(cube_side: int, num_disks: int = 34, neighborhood: int = 26, use_cache: bool = True):
     """
-    Ryan's node assignment code that solves the Color-matching problem
+    Ryan's node assignment code that solves the Color-matching problem. Assigns
+    nodes greedily such that there is not a matching node within the
+    (8 + 9 + 9) 26 cube neighborhood. See node_assignment_utils for the engine,
+    its on-disk cache and validate_node_assignment()
 
     :param cube_side: Length of the cube side to be assigned to nodes
+    :param num_disks: Number of available nodes. There are 34 FileDB nodes
+    :param neighborhood: Neighbors that may not share a node (6, 18 or 26)
+    :param use_cache: Whether to reuse a previously computed assignment
+    :return: cube_side^3 array of 1-indexed node numbers
     """
-
-    def get_bounds(idx: int, mx: int):
-        """Helper for requesting valid indicies around an index"""
-        return max(idx - 1, 0), min(idx + 2, mx)
-
-    # There are 34 availble nodes that are 1-indexed
-    colors = np.arange(34) + 1
-    # An array for holding how often a node has been assigned too.
-    color_counts = np.zeros_like(colors)
-    # An array to store the node assignment the 8192^3 data is broken into 512^3
-    # sub-cubes so we need to 8192/512=16 assignments along each dimension
-
-    nodes = np.zeros([cube_side, cube_side, cube_side], dtype=int)
-
-    # iterate through the position indicies in `nodes` and assign available 
-    # nodes greedily such that there is not a matching node within the 
-    # (8 + 9 + 9) 26 cube neighborhood.
-    for i, j, k in product(np.arange(cube_side), np.arange(cube_side), np.arange(cube_side)):
-        if nodes[i, j, k] == 0:
-            neighbor_colors = nodes[
-                slice(*get_bounds(i, cube_side)),
-                slice(*get_bounds(j, cube_side)),
-                slice(*get_bounds(k, cube_side))
-            ]
-            avail_colors = np.setdiff1d(colors, neighbor_colors.flatten())
-            color_idxs = avail_colors - 1
-            greedy_color_idx = np.argmin(color_counts[color_idxs])
-            greedy_color = colors[color_idxs[greedy_color_idx]]
-            color_counts[color_idxs[greedy_color_idx]] += 1
-
-            nodes[i, j, k] = greedy_color
-
-    return nodes
+    return node_assignment_utils.get_node_assignment(cube_side, num_disks, neighborhood, use_cache=use_cache)
 
 
 # ChatGPT
-def split_zarr_group(ds, smaller_size, dims):
+def split_zarr_group(ds, smaller_size, dims, halo=0, chunk_size=None):
     """
     Takes an xarray group of arrays and splits it into smaller groups
     E.g. it takes a 2048^3 group of 6 arrays and returns 64 groups of 512^3
@@ -72,49 +44,113 @@ def split_zarr_group(ds, smaller_size, dims):
         dims (tuple): Names of the dimensions in order (dim_0, dim_1,
         dim_2). This can be gotten in reverse order using
         [dim for dim in data_xr.dims]
-        
+        halo (int): Cells of the neighboring groups to also store on every
+        side of each group, clipped at the domain's faces. The layout is
+        recorded in each group's attributes, see get_halo_attrs()
+        chunk_size (int): Zarr chunk length. With a halo, groups are
+        rechunked to it, since their dask chunks no longer line up
+
     Returns:
         list[xarray.Dataset]: A list of lists of lists of smaller Datasets.
     """
 
     # Calculate the number of chunks along each dimension
     num_chunks = [ds.sizes[dim] // smaller_size for dim in dims]
+    array_sizes = [ds.sizes[dim] for dim in dims]
 
     # I want this to be a 3D list of lists
     outer_dim = []
 
-    range_list = []  # Where chunks start and end. Needed for Mike's code to find correct chunks to access
-
     for i in range(num_chunks[0]):
         mid_dim = []
         for j in range(num_chunks[1]):
             inner_dim = []
 
             for k in range(num_chunks[2]):
+                ranges = [[n * smaller_size, (n + 1) * smaller_size] for n in (i, j, k)]
+                stored = get_halo_ranges(ranges, array_sizes, halo)
                 # Select the chunk from each DataArray
                 # These are first distributed along the last (i.e. the x)-index
                 chunk = ds.isel(
-                    {dims[0]: slice(i * smaller_size, (i + 1) * smaller_size),  # nnz
-                     dims[1]: slice(j * smaller_size, (j + 1) * smaller_size),  # nny
-                     dims[2]: slice(k * smaller_size, (k + 1) * smaller_size)}  # nnx
+                    {dims[0]: slice(*stored[0]),  # nnz
+                     dims[1]: slice(*stored[1]),  # nny
+                     dims[2]: slice(*stored[2])}  # nnx
                 )
+                if halo:
+                    chunk = chunk.assign_attrs(get_halo_attrs(ranges, stored, halo))
+                    if chunk_size is not None:
+                        chunk = chunk.chunk({dim: chunk_size for dim in dims})
 
                 inner_dim.append(chunk)
 
-                a = []
-                a.append([i * smaller_size, (i + 1) * smaller_size])
-                a.append([j * smaller_size, (j + 1) * smaller_size])
-                a.append([k * smaller_size, (k + 1) * smaller_size])
-
-                range_list.append(a)
-
             mid_dim.append(inner_dim)
 
         outer_dim.append(mid_dim)
 
+    # Where chunks start and end. Needed for Mike's code to find correct chunks to access
+    range_list = get_range_list(array_sizes, smaller_size)
+
     return outer_dim, range_list
 
 
+def get_halo_ranges(ranges, array_sizes, halo):
+    """
+    Where a subarray's stored data starts and ends when halo cells of its
+    neighbors are stored on every side, clipped to the domain
+
+    Args:
+        ranges (list): [[dim_0 start, end], ...] of the subarray, see get_range_list()
+        array_sizes (list[int]): Length of the whole array along each of the 3 dims
+        halo (int): Halo cells per side
+
+    Returns:
+        list: [[dim_0 start, end], ...] of the stored data
+    """
+    return [[max(start - halo, 0), min(end + halo, size)] for (start, end), size in zip(ranges, array_sizes)]
+
+
+def get_halo_attrs(ranges, stored_ranges, halo):
+    """
+    Group attributes describing a group stored with a halo. Array index 0
+    is global coordinate storage_start; the group owns [core_start, core_end)
+
+    Args:
+        ranges (list): Core [[start, end], ...] of the group, see get_range_list()
+        stored_ranges (list): Stored [[start, end], ...], see get_halo_ranges()
+        halo (int): Halo cells per side
+
+    Returns:
+        dict: halo, core_start, core_end, storage_start and storage_end, in (dim_0, dim_1, dim_2) order
+    """
+    return dict(halo=int(halo), core_start=[int(r[0]) for r in ranges], core_end=[int(r[1]) for r in ranges],
+                storage_start=[int(r[0]) for r in stored_ranges], storage_end=[int(r[1]) for r in stored_ranges])
+
+
+def get_range_list(array_sizes, smaller_size):
+    """
+    Where each smaller subarray starts and ends, in the order split_zarr_group()
+    creates them. Does not need the data itself
+
+    Args:
+        array_sizes (list[int]): Length of the array along each of the 3 dims
+        smaller_size (int): Side length of the subarrays
+
+    Returns:
+        list: [[dim_0 start, end], [dim_1 start, end], [dim_2 start, end]] for every subarray
+    """
+    num_chunks = [size // smaller_size for size in array_sizes]
+
+    range_list = []
+    for i in range(num_chunks[0]):
+        for j in range(num_chunks[1]):
+            for k in range(num_chunks[2]):
+                range_list.append([[i * smaller_size, (i + 1) * smaller_size],
+                                   [j * smaller_size, (j + 1) * smaller_size],
+                                   [k * smaller_size, (k + 1) * smaller_size]])
+
+    return range_list
+
+
 def list_fileDB_folders():
     # base_dir = '/Volumes/backup-hdd/ncar/'  # Macos debugging for Ariel
     base_dir = "/home/idies/workspace/turb"
@@ -128,6 +164,21 @@ def list_fileDB_folders():
     return filedb_folders
 
 
+def get_filedb_folder(path):
+    """
+    The FileDB disk folder (one of list_fileDB_folders()) that path lives on
+
+    :param path: Path of a file or folder on FileDB
+    :return: The FileDB folder, or None if path is not on FileDB
+    """
+    path = os.path.abspath(path)
+    for folder in list_fileDB_folders():
+        if path.startswith(folder) or path == folder.rstrip('/'):
+            return folder
+
+    return None
+
+
 def merge_velocities(transposed_ds, chunk_size_base=64):
     """
         Merge the 3 velocity components/directions - such merging
@@ -150,11 +201,77 @@ def merge_velocities(transposed_ds, chunk_size_base=64):
     return result
 
 
+def merge_velocities_blockwise(transposed_ds, chunk_size_base=64):
+    """
+    Same result as merge_velocities(), built as one task per (chunk_size_base^3, 3) velocity chunk. Each task gets
+    the matching u, v and w blocks of the source chunks and interleaves them into a preallocated chunk, so the
+    graph has no stacked, squeezed or rechunked intermediates. Sources opened with chunk_size_base^3 chunks, as
+    _prepare_NCAR_NetCDF() does, are used as they are; others are rechunked to it first. How many chunks are merged
+    at once is up to the dask pool, see shared_dask_pool()
+
+    Args:
+        transposed_ds (xarray.Dataset): (nnz, nny, nnx, extra_dim) variables including u, v and w, lazy
+        chunk_size_base (int): Chunk length of the merged velocity
+
+    Returns:
+        xarray.Dataset: transposed_ds without u, v and w, with velocity of shape (nnz, nny, nnx, 3)
+    """
+    components = [transposed_ds[name].data.rechunk((chunk_size_base,) * 3 + (1,)) for name in ('u', 'v', 'w')]
+    dtype = np.result_type(*[component.dtype for component in components])
+
+    def merge_chunk(u, v, w):
+        chunk = np.empty(u.shape[:3] + (3,), dtype=dtype)
+        for i, component in enumerate((u, v, w)):
+            chunk[..., i] = component[..., 0]
+        return chunk
+
+    velocity = da.map_blocks(merge_chunk, *components, chunks=components[0].chunks[:3] + ((3,),), dtype=dtype,
+                             meta=np.empty((0, 0, 0, 0), dtype=dtype),
+                             name='merge-velocities-' + tokenize(*components))
+
+    result = transposed_ds.drop_vars(['u', 'v', 'w'])
+    result['velocity'] = xr.DataArray(velocity, dims=('nnz', 'nny', 'nnx', 'velocity component (xyz)'))
+
+    return result
+
+
+@contextlib.contextmanager
+def shared_dask_pool(num_threads=None):
+    """
+    Run every dask computation of this process, from any thread, on one pool of num_threads threads while inside.
+    Called from a thread other than the main one, dask otherwise starts a pool of cpu_count threads for that thread,
+    so N writer threads run up to N * cpu_count tasks at once, each holding the blocks it reads and builds
+
+    Args:
+        num_threads (int): Threads of the pool. None leaves dask's pools alone
+    """
+    if num_threads is None:
+        yield
+        return
+    with ThreadPoolExecutor(num_threads) as pool, dask.config.set(pool=pool):
+        yield
+
+
+def get_peak_rss():
+    """Peak resident memory of this process so far, in bytes (Linux reports ru_maxrss in KiB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def morton_pack(array_cube_side, x, y, z):
-    bits = int(math.log(array_cube_side, 2))
-    mortoncurve = morton.Morton(dimensions=3, bits=bits)
+    """
+    Packs x, y, z coordinates into a Morton code. Coordinates may be ints or
+    arrays, in which case an array of codes is returned
+
+    Args:
+        array_cube_side (int): length of the array we are (un)packing
+        x, y, z (int or array-like): coordinates to pack
 
-    return mortoncurve.pack(x, y, z)
+    Returns:
+        int or np.ndarray: the Morton code(s) of the coordinates
+    """
+    codes = morton_utils.encode(x, y, z, morton_utils.bits_for_side(array_cube_side))
+
+    return int(codes) if codes.ndim == 0 else codes
 
 
 def morton_unpack(array_cube_side: int, morton_code: int) -> list:
@@ -167,24 +284,37 @@ def morton_unpack(array_cube_side: int, morton_code: int) -> list:
     Returns:
         list: the x, y, z coordinates corresponding to the morton code
     """
-    bits = int(math.log(array_cube_side, 2))
-    mortoncurve = morton.Morton(dimensions=3, bits=bits)
+    x, y, z = morton_utils.decode(morton_code, morton_utils.bits_for_side(array_cube_side))
 
-    return mortoncurve.unpack(morton_code)
+    if x.ndim == 0:
+        return [int(x), int(y), int(z)]
+    return [x, y, z]
 
-def get_sorted_morton_list(range_list, array_cube_side=2048):
-    sorted_morton_list = []  # Sorting by Morton code to be consistent with Isotropic8192
 
-    for i in range(len(range_list)):
-        min_coord = [a[0] for a in range_list[i]]
-        max_coord = [a[1] - 1 for a in range_list[i]]
+def get_range_morton_codes(range_list, array_cube_side=2048):
+    """
+    Morton codes of the first and last point of every subarray in range_list
+
+    Args:
+        range_list (list): Where subarrays start and end, as returned by split_zarr_group()
+        array_cube_side (int): length of the whole array
 
-        sorted_morton_list.append((morton_pack(array_cube_side, min_coord[0], min_coord[1], min_coord[2]),
-                                   morton_pack(array_cube_side, max_coord[0], max_coord[1], max_coord[2])))
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Morton codes of the min and max corner of each subarray
+    """
+    ranges = np.asarray(range_list, dtype=np.int64).reshape(-1, 3, 2)
+    min_coords = ranges[:, :, 0]
+    max_coords = ranges[:, :, 1] - 1
 
-    sorted_morton_list = sorted(sorted_morton_list)
+    return (morton_pack(array_cube_side, min_coords[:, 0], min_coords[:, 1], min_coords[:, 2]),
+            morton_pack(array_cube_side, max_coords[:, 0], max_coords[:, 1], max_coords[:, 2]))
 
-    return sorted_morton_list
+
+def get_sorted_morton_list(range_list, array_cube_side=2048):
+    # Sorting by Morton code to be consistent with Isotropic8192
+    min_codes, max_codes = get_range_morton_codes(range_list, array_cube_side)
+
+    return sorted(zip(min_codes.tolist(), max_codes.tolist()))
 
 
 def get_chunk_morton_mapping(range_list, dest_folder_name):
@@ -223,23 +353,29 @@ def search_dict_by_value(dictionary, value):
     return None  # Value not found in the dictionary
 
 
-def write_to_disk(q):
+def write_to_disk(q, on_written=None):
     """
     Spawn threads to write Zarr cubes to disk. Do not use Dask for this as seems to cause
     worse performance than Threads
 
     Args:
         q (Queue): Queue of jobs
+        on_written (callable): Optional, called with the destination path after each successful write,
+            e.g. to record it in the placement catalog
     """
     while True:
         processed = False
         try:
             chunk, dest_groupname, encoding = q.get(timeout=10)  # Adjust timeout as necessary
 
-            print(f"Starting write to {dest_groupname}...")
-            chunk.to_zarr(store=dest_groupname, mode="w", encoding=encoding)
-            print(f"Finished writing to {dest_groupname}.")
+            write_zarr_group(chunk, dest_groupname, encoding)
             processed = True
+
+            if on_written is not None:
+                try:
+                    on_written(dest_groupname)
+                except Exception as e:  # Bookkeeping errors should not stop the remaining writes
+                    print(f"Error after writing {dest_groupname}: {e}")
         except queue.Empty:
             return  # Exit the thread if the queue is empty
         finally:
@@ -250,6 +386,131 @@ def write_to_disk(q):
                 q.task_done()
 
 
+def write_zarr_group(chunk, dest_groupname, encoding, staged=False, writer='xarray', sync_policy='none',
+                     checksums=False, layout='directory', staging_path=None, before_commit=None):
+    """
+    Write one (lazy) xarray group to a Zarr group on disk
+
+    Args:
+        chunk (xarray.Dataset): Data to write
+        dest_groupname (str): Destination Zarr group path
+        encoding (dict): Zarr encoding of each variable
+        staged (bool): Write to get_staging_path(dest_groupname) and only move the
+            group to dest_groupname once it is complete, so an interrupted write
+            never leaves a partial group under the real name
+        writer (str): 'xarray' writes with to_zarr(). 'raw' writes uncompressed
+            chunk files directly, see raw_zarr_utils.write_group(). Falls back to
+            'xarray' if the encoding is compressed
+        sync_policy (str): 'none', 'fsync' or 'direct' (O_DIRECT, raw writer
+            only). Except for 'none', the whole group is fsync-ed
+        checksums (bool): Store per-chunk checksums in the group before it is
+            committed, see checksum_utils.write_manifest()
+        layout (str): 'directory' keeps one file per chunk. 'sharded' packs
+            the chunks into a few shard files before committing, see shard_utils
+        staging_path (str): Staged only. Where to stage the group instead of
+            get_staging_path(dest_groupname), e.g. a path of one worker's own
+        before_commit (callable): Staged only. Called once the group is
+            staged; if it returns False, the staged group is deleted instead
+            of committed
+
+    Returns:
+        bool: Whether the group was written to dest_groupname
+    """
+    print(f"Starting write to {dest_groupname}...")
+    path = (staging_path or get_staging_path(dest_groupname)) if staged else dest_groupname
+    if staged and os.path.exists(path):  # Left over from an interrupted run
+        shutil.rmtree(path)
+
+    if writer == 'raw' and raw_zarr_utils.is_raw_encoding(encoding):
+        raw_zarr_utils.write_group(chunk, path, encoding, sync_policy)
+    else:
+        chunk.to_zarr(store=path, mode="w", encoding=encoding)
+    if checksums:
+        checksum_utils.write_manifest(path)
+    shard_utils.convert_in_place(path, layout)
+
+    if staged:
+        if before_commit is not None and not before_commit():
+            shutil.rmtree(path)
+            print(f"Discarded the write to {dest_groupname}.")
+            return False
+        commit_staged_group(path, dest_groupname, sync=sync_policy != 'none')
+    elif sync_policy != 'none':
+        raw_zarr_utils.sync_tree(path)
+    print(f"Finished writing to {dest_groupname}.")
+    return True
+
+
+def get_staging_path(dest_groupname, owner=None):
+    """
+    Where a Zarr group is written before being renamed to dest_groupname. Same folder, so same disk. With an owner,
+    e.g. a worker id, the path is the owner's own, so writers of the same group never share a staging folder
+    """
+    if owner is None:
+        return dest_groupname.rstrip('/') + '.partial'
+    return f"{dest_groupname.rstrip('/')}.{owner}.partial"
+
+
+def commit_staged_group(staging_path, dest_groupname, sync=False):
+    """
+    Move a completely written group from its staging path to its real name.
+    An existing group at dest_groupname is moved aside first and deleted
+    afterwards, since a directory can't be renamed over a non-empty one
+
+    Args:
+        staging_path (str): Fully written Zarr group
+        dest_groupname (str): Final Zarr group path
+        sync (bool): fsync the staged group before and its folder after the
+            rename, so the committed group survives a crash
+    """
+    if sync:
+        raw_zarr_utils.sync_tree(staging_path)
+
+    dest_groupname = dest_groupname.rstrip('/')
+    old_path = dest_groupname + '.old'
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+    if os.path.exists(dest_groupname):
+        os.rename(dest_groupname, old_path)
+    os.rename(staging_path, dest_groupname)
+
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if sync:
+        raw_zarr_utils.sync_path(os.path.dirname(os.path.abspath(dest_groupname)))
+
+
+class MemoryBudget:
+    """
+    Counts bytes held by staged data and blocks callers of acquire() while
+    the ceiling would be exceeded. A single reservation larger than the ceiling
+    is let through when nothing else is reserved, so it cannot stall forever
+
+    Args:
+        max_bytes (int): Ceiling in bytes. None means unlimited
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self.peak = 0  # Most bytes reserved at once
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._condition:
+            while (self.max_bytes is not None and self.reserved > 0
+                   and self.reserved + nbytes > self.max_bytes):
+                self._condition.wait()
+            self.reserved += nbytes
+            self.peak = max(self.peak, self.reserved)
+
+    def release(self, nbytes):
+        with self._condition:
+            self.reserved -= nbytes
+            self._condition.notify_all()
+
+
 def copy_folder(source, destination):
     try:
         # Delete the destination folder if it already exists
@@ -0,0 +1,76 @@
+"""
+Check the chunk cache in src/utils/cache_utils.py: cached reads return the
+same data, the memory tier stays within its budget and spills to disk, the
+counters add up, and read-ahead fetches the Morton-next chunks. Uses small
+Zarr groups in a temporary folder.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import zarr
+from parameterized import parameterized
+
+from src.utils.cache_utils import CachingStore, ChunkCache
+
+
+class VerifyChunkCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = np.random.default_rng(0).random((32, 32, 32, 3), dtype=np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_group(self, separator='.'):
+        path = os.path.join(self.folder, 'group.zarr')
+        group = zarr.open_group(zarr.DirectoryStore(path, dimension_separator=separator), mode='w')
+        group.array('velocity', self.data, chunks=(8, 8, 8, 3), compressor=None)  # Equal chunk sizes
+        return path
+
+    def test_hits_and_spill(self):
+        path = self.write_group()
+        chunk_bytes = len(zarr.DirectoryStore(path)['velocity/0.0.0.0'])
+        cache = ChunkCache(max_bytes=10 * chunk_bytes, spill_path=os.path.join(self.folder, 'spill'))
+
+        for _ in range(2):
+            array = zarr.open_group(CachingStore(zarr.DirectoryStore(path), cache), mode='r')['velocity']
+            np.testing.assert_array_equal(array[:8, :8, :16], self.data[:8, :8, :16])
+        stats = cache.stats()
+        self.assertEqual((stats['misses'], stats['hits']), (2, 2))
+
+        array[:]  # 64 chunks: all but 10 are evicted into the spill tier
+        stats = cache.stats()
+        self.assertEqual((stats['memory_chunks'], stats['evictions'], stats['spill_chunks']), (10, 54, 54))
+
+        np.testing.assert_array_equal(array[:8, :8, :8], self.data[:8, :8, :8])
+        self.assertEqual(cache.stats()['spill_hits'], 1)
+
+        cache.reset_counters()
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['spill_hits'], stats['misses'], stats['memory_chunks']), (0, 0, 0, 10))
+
+    @parameterized.expand([('.',), ('/',)])
+    def test_read_ahead(self, separator):
+        path = self.write_group(separator)
+        cache = ChunkCache()
+        array = zarr.open_group(CachingStore(zarr.DirectoryStore(path), cache, read_ahead=7), mode='r')['velocity']
+
+        array[0, 0, 0]
+        cache.wait_for_prefetches()
+        self.assertEqual(cache.stats()['prefetches'], 7)
+
+        np.testing.assert_array_equal(array[:16, :16, :16], self.data[:16, :16, :16])  # The first 8 Morton chunks
+        stats = cache.stats()
+        self.assertEqual((stats['misses'], stats['hits']), (1, 8))
+
+    def test_write_invalidates(self):
+        path = self.write_group()
+        cache = ChunkCache()
+        array = zarr.open_group(CachingStore(zarr.DirectoryStore(path), cache), mode='a')['velocity']
+        array[:8, :8, :8]
+        array[:8, :8, :8] = 1
+        np.testing.assert_array_equal(array[:8, :8, :8], 1)
@@ -0,0 +1,59 @@
+"""
+Check that the per-chunk checksum manifests in src/utils/checksum_utils.py
+are written by write_zarr_group() and catch corrupted, missing and extra
+chunk files. Uses temporary folders; does not need any data on disk.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import xarray as xr
+from parameterized import parameterized
+
+from src.utils import checksum_utils, write_utils
+
+
+class VerifyChunkChecksums(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.cube = xr.Dataset({
+            'velocity': (('z', 'y', 'x', 'c'), rng.random((16, 16, 16, 3), dtype=np.float32)),
+            'energy': (('z', 'y', 'x', 'c1'), rng.random((16, 16, 16, 1), dtype=np.float32))})
+        self.encoding = {'velocity': dict(chunks=(8, 8, 8, 3), compressor=None),
+                         'energy': dict(chunks=(8, 8, 8, 1), compressor=None)}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_group(self, writer='xarray'):
+        path = os.path.join(self.tmp_dir.name, 'group.zarr')
+        write_utils.write_zarr_group(self.cube, path, self.encoding, staged=True, writer=writer, checksums=True)
+        return path
+
+    @parameterized.expand([('xarray',), ('raw',)])
+    def test_manifest(self, writer):
+        path = self.write_group(writer)
+
+        manifest = checksum_utils.read_manifest(path)
+        self.assertEqual(manifest['algorithm'], checksum_utils.DEFAULT_ALGORITHM)
+        self.assertEqual(len(manifest['chunks']), 2 * 8)
+        self.assertIn('velocity/1.0.1.0', manifest['chunks'])
+        self.assertEqual(checksum_utils.verify_group(path), [])
+
+    def test_detects_damage(self):
+        path = self.write_group()
+        with open(os.path.join(path, 'velocity', '0.0.0.0'), 'r+b') as f:
+            f.write(b'\x01')
+        os.remove(os.path.join(path, 'energy', '1.1.1.0'))
+        with open(os.path.join(path, 'energy', '9.9.9.0'), 'wb') as f:
+            f.write(b'stray')
+
+        mismatches, errors = checksum_utils.verify_groups([(path, 'disk1'), (self.tmp_dir.name, 'disk2')])
+        self.assertEqual([key for key, _, _ in mismatches[path]], ['energy/1.1.1.0', 'energy/9.9.9.0',
+                                                                   'velocity/0.0.0.0'])
+        self.assertEqual(mismatches[path][0][2], None)  # Missing from disk
+        self.assertEqual(mismatches[path][1][1], None)  # Missing from the manifest
+        self.assertEqual([job for job, _ in errors], [self.tmp_dir.name])  # Not a group with a manifest
@@ -0,0 +1,45 @@
+"""
+Check that the Zarr codecs in src/utils/codec_utils.py are resolved from
+write_settings the way config.yaml documents them. Does not need any data
+on disk.
+"""
+
+import unittest
+
+import numcodecs
+from parameterized import parameterized
+
+from src.utils import codec_utils
+
+
+class VerifyCodecSettings(unittest.TestCase):
+    @parameterized.expand([
+        ('None',),
+        (None,),
+        ('none',),
+    ])
+    def test_uncompressed(self, compressor):
+        codecs = codec_utils.get_variable_codecs(dict(desired_zarr_compressor=compressor), ['velocity', 'energy'])
+        self.assertEqual(codecs, {'velocity': (None, None), 'energy': (None, None)})
+
+    def test_presets_configs_and_overrides(self):
+        write_settings = dict(
+            desired_zarr_compressor=dict(id='blosc', cname='lz4', clevel=5, shuffle=1),
+            desired_zarr_filters=None,
+            variable_codecs=dict(velocity='shuffle-zstd', energy=dict(compressor='None')))
+        codecs = codec_utils.get_variable_codecs(write_settings, ['velocity', 'energy', 'pressure'])
+
+        self.assertEqual(codecs['velocity'], (numcodecs.Zstd(level=3), [numcodecs.Shuffle(elementsize=4)]))
+        self.assertEqual(codecs['energy'], (None, None))
+        self.assertEqual(codecs['pressure'], (numcodecs.Blosc('lz4', 5, numcodecs.Blosc.SHUFFLE), None))
+
+    def test_build_encoding(self):
+        codecs = {'velocity': codec_utils.resolve_codecs('blosc-zstd-bitshuffle')}
+        encoding = codec_utils.build_encoding({'velocity': (64, 64, 64, 3), 'energy': (64, 64, 64, 1)}, codecs)
+
+        self.assertEqual(encoding['velocity']['compressor'].get_config()['shuffle'], numcodecs.Blosc.BITSHUFFLE)
+        self.assertEqual(encoding['energy'], dict(chunks=(64, 64, 64, 1), compressor=None))
+
+    def test_unknown_preset(self):
+        with self.assertRaises(ValueError):
+            codec_utils.get_codec('blosc-snappy-turbo')
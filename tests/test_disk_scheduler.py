@@ -0,0 +1,81 @@
+"""
+Check that the per-disk write scheduler in src/utils/scheduler_utils.py runs
+every job once and never exceeds a disk's concurrency limit.
+Does not need any data on disk.
+"""
+
+import threading
+import time
+import unittest
+
+from src.utils.scheduler_utils import DiskScheduler
+
+
+class VerifyDiskScheduler(unittest.TestCase):
+    def run_jobs(self, scheduler, jobs, num_workers):
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+        done = []
+
+        def handler(job):
+            disks, name = job
+            with lock:
+                for disk in disks:
+                    running[disk] = running.get(disk, 0) + 1
+                    peak[disk] = max(peak.get(disk, 0), running[disk])
+            time.sleep(0.01)
+            with lock:
+                for disk in disks:
+                    running[disk] -= 1
+                done.append(name)
+
+        for disks, name in jobs:
+            scheduler.submit(disks, (disks, name))
+        scheduler.close()
+        scheduler.run(num_workers, handler)
+
+        return done, peak
+
+    def test_per_disk_limits(self):
+        disks = ['disk_a', 'disk_b', 'disk_c']
+        scheduler = DiskScheduler(disks, max_per_disk={'disk_a': 1, 'disk_b': 2, 'disk_c': 3})
+        jobs = [((disks[i % 3],), i) for i in range(60)]
+
+        done, peak = self.run_jobs(scheduler, jobs, num_workers=10)
+
+        self.assertEqual(sorted(done), list(range(60)))
+        self.assertLessEqual(peak['disk_a'], 1)
+        self.assertLessEqual(peak['disk_b'], 2)
+        self.assertLessEqual(peak['disk_c'], 3)
+
+    def test_multi_disk_jobs_respect_all_limits(self):
+        disks = ['src_a', 'src_b', 'dst']
+        scheduler = DiskScheduler(disks, max_per_disk=1)
+        jobs = [(('src_a', 'dst'), i) for i in range(10)] + [(('src_b', 'dst'), i) for i in range(10, 20)]
+
+        done, peak = self.run_jobs(scheduler, jobs, num_workers=4)
+
+        self.assertEqual(sorted(done), list(range(20)))
+        self.assertEqual(peak['dst'], 1)
+
+    def test_disks_added_on_submit_get_the_limit(self):
+        scheduler = DiskScheduler([], max_per_disk=2)
+        jobs = [(('disk_a',), i) for i in range(20)]
+
+        done, peak = self.run_jobs(scheduler, jobs, num_workers=4)
+
+        self.assertEqual(sorted(done), list(range(20)))
+        self.assertEqual(peak['disk_a'], 2)
+
+    def test_errors_are_collected(self):
+        scheduler = DiskScheduler(['disk_a'])
+        scheduler.submit('disk_a', 'bad job')
+        scheduler.close()
+
+        def handler(job):
+            raise ValueError(job)
+
+        scheduler.run(2, handler)
+        self.assertEqual(len(scheduler.errors), 1)
+        self.assertEqual(scheduler.queue_depths(), {'disk_a': 0})
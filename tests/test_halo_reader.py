@@ -0,0 +1,100 @@
+"""
+Check that the cross-group reader in src/utils/halo_utils.py assembles
+stencils, point sets and regions that straddle Zarr group boundaries exactly
+like slicing the whole domain, with one or several concurrent reads per disk,
+and that groups written with a halo serve every stencil from a single group.
+Uses 8 small Zarr groups in a temporary folder, each on its own pretend disk.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import xarray as xr
+import zarr
+from parameterized import parameterized
+
+from src.utils import halo_utils, write_utils
+from src.utils.halo_utils import HaloReader
+
+GROUP_LENGTH = 32
+
+
+class VerifyHaloReader(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = np.random.default_rng(0).random((2 * GROUP_LENGTH,) * 3 + (3,), dtype=np.float32)
+
+        placements = []
+        for i, position in enumerate(np.ndindex(2, 2, 2)):
+            starts = [p * GROUP_LENGTH for p in position]
+            path = os.path.join(self.folder, f'group{i}.zarr')
+            group = zarr.open_group(path, mode='w')
+            group.array('velocity', self.data[tuple(slice(s, s + GROUP_LENGTH) for s in starts)],
+                        chunks=(16, 16, 16, 3))
+            placements.append(dict(path=path, disk=f'disk{i}', z_start=starts[0], z_end=starts[0] + GROUP_LENGTH,
+                                   y_start=starts[1], y_end=starts[1] + GROUP_LENGTH, x_start=starts[2],
+                                   x_end=starts[2] + GROUP_LENGTH))
+        self.placements = placements[::-1]
+        self.reader = HaloReader(self.placements)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @parameterized.expand([(1,), (3,)])
+    def test_stencils(self, max_reads_per_disk):
+        indices = np.random.default_rng(1).integers(4, 2 * GROUP_LENGTH - 3, size=(300, 3))
+        indices[0] = (GROUP_LENGTH,) * 3  # Touches all 8 groups
+        result = HaloReader(self.placements, max_reads_per_disk=max_reads_per_disk).gather_stencils(indices)
+
+        self.assertEqual(result.shape, (300, 8, 8, 8, 3))
+        for n, (z, y, x) in enumerate(indices):
+            np.testing.assert_array_equal(result[n], self.data[z - 4:z + 4, y - 4:y + 4, x - 4:x + 4])
+
+    def test_region_and_points(self):
+        np.testing.assert_array_equal(self.reader.read_region((10, 20, 30), (40, 30, 20)),
+                                      self.data[10:50, 20:50, 30:50])
+
+        points = np.random.default_rng(2).integers(0, 2 * GROUP_LENGTH, size=(500, 3))
+        np.testing.assert_array_equal(self.reader.read_points(points), self.data[tuple(points.T)])
+
+    def test_out_of_domain(self):
+        with self.assertRaises(ValueError):
+            self.reader.gather_stencils([[2, 10, 10]])
+        with self.assertRaises(ValueError):
+            self.reader.read_region((40, 40, 40), (30, 8, 8))
+
+    def test_halo_groups(self):
+        dims = ('nnz', 'nny', 'nnx')
+        ds = xr.Dataset({'velocity': (dims + ('xyz',), self.data)}).chunk({'nnz': 16, 'nny': 16, 'nnx': 16})
+        groups, range_list = write_utils.split_zarr_group(ds, GROUP_LENGTH, dims, halo=4, chunk_size=16)
+
+        halo_folder = os.path.join(self.folder, 'halo')
+        placements = []
+        for i, (a, b, c) in enumerate(np.ndindex(2, 2, 2)):
+            path = os.path.join(halo_folder, f'group{i}.zarr')
+            groups[a][b][c].to_zarr(path, encoding={'velocity': {'chunks': (16, 16, 16, 3)}})
+            ranges = range_list[i]
+            placements.append(dict(path=path, disk=f'disk{i}', z_start=ranges[0][0], z_end=ranges[0][1],
+                                   y_start=ranges[1][0], y_end=ranges[1][1], x_start=ranges[2][0],
+                                   x_end=ranges[2][1]))
+
+        attrs = zarr.open_group(placements[0]['path'], mode='r').attrs
+        self.assertEqual(attrs['halo'], 4)
+        self.assertEqual(attrs['storage_start'], [0, 0, 0])
+        self.assertEqual(attrs['storage_end'], [GROUP_LENGTH + 4] * 3)
+
+        reader = HaloReader(placements)
+        np.testing.assert_array_equal(reader.read_region((10, 20, 30), (40, 30, 20)), self.data[10:50, 20:50, 30:50])
+
+        # A stencil centered in group 0 but crossing into its neighbors is served by group 0 alone
+        for i in range(1, 8):
+            shutil.rmtree(placements[i]['path'])
+        result = HaloReader(placements).gather_stencils([[GROUP_LENGTH - 1] * 3])
+        np.testing.assert_array_equal(result[0], self.data[27:35, 27:35, 27:35])
+
+    def test_halo_tradeoff(self):
+        self.assertEqual(halo_utils.estimate_halo_tradeoff(2048, 512, 4)['crossing_with_halo'], 0)
+        self.assertGreater(halo_utils.estimate_halo_tradeoff(2048, 512, 0)['crossing_with_halo'], 0)
@@ -0,0 +1,57 @@
+"""
+Check that the in-process hashing engine in src/utils/hash_utils.py matches
+hashlib, and that its digest cache skips unchanged files and re-hashes
+changed ones. Uses temporary files; does not need any data on disk.
+"""
+
+import hashlib
+import os
+import tempfile
+import unittest
+
+from parameterized import parameterized
+
+from src.utils import hash_utils
+
+
+class VerifyHashEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i, size in enumerate([0, 1, 4096, 3 * 1024 * 1024 + 17]):
+            path = os.path.join(self.tmp_dir.name, f'file{i}.nc')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def expected(self, path):
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @parameterized.expand([(4096,), (1024 * 1024,), (1000,)])
+    def test_hash_file(self, buffer_size):
+        for path in self.paths:
+            self.assertEqual(hash_utils.hash_file(path, buffer_size=buffer_size), self.expected(path))
+
+    def test_cache(self):
+        with hash_utils.HashCache(os.path.join(self.tmp_dir.name, 'cache.sqlite')) as cache:
+            digests, stats = hash_utils.hash_files(self.paths, threads_per_disk=2, cache=cache)
+            self.assertEqual(digests, {path: self.expected(path) for path in self.paths})
+            self.assertEqual(sum(entry['files'] for entry in stats.throughput().values()), len(self.paths))
+
+            # Unchanged files come from the cache
+            digests, stats = hash_utils.hash_files(self.paths, cache=cache)
+            self.assertEqual(digests, {path: self.expected(path) for path in self.paths})
+            self.assertEqual(sum(entry['files'] for entry in stats.throughput().values()), 0)
+
+            # A rewritten file is hashed again
+            with open(self.paths[2], 'wb') as f:
+                f.write(b'changed')
+            os.utime(self.paths[2], ns=(1, 1))
+            digests, stats = hash_utils.hash_files(self.paths, cache=cache)
+            self.assertEqual(digests[self.paths[2]], self.expected(self.paths[2]))
+            self.assertEqual(sum(entry['files'] for entry in stats.throughput().values()), 1)
+            self.assertEqual(stats.errors, [])
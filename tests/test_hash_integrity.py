@@ -8,12 +8,12 @@ Tests whole folders at a time. Only need to specify DATASET env var.
 """
 
 import unittest
-import subprocess
 import os
 from parameterized import parameterized
 import yaml
 
 from src.dataset import NCAR_Dataset
+from src.utils import hash_utils
 
 
 config = {}
@@ -25,14 +25,26 @@ start_timestep = int(os.environ.get('START_TIMESTEP', -1))
 end_timestep = int(os.environ.get('END_TIMESTEP', -1))
 
 
+computed_hashes = None  # full_file_path -> SHA-256, filled for all files at once by the first test
+
+
 def get_sha256(full_file_path):
     """
-    Return the SHA-256 hash and filename in the format 'hash filename'.
+    Return the SHA-256 hash of a file. On the first call, every file listed in the selected hash.txt lines is
+    hashed in parallel, one reader per disk. Digests are cached across runs (see utils/hash_utils.py, cache
+    location overridable with HASH_CACHE_PATH), so unchanged files are not read again
     """
-    cmd = ["sha256sum", full_file_path]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE)
-    hash_value = result.stdout.decode().strip().split()[0]
-    return hash_value
+    global computed_hashes
+    if computed_hashes is None:
+        paths = [path for _, path in generate_hash_tests()]
+        with hash_utils.HashCache() as cache:
+            computed_hashes, stats = hash_utils.hash_files(paths, cache=cache)
+        stats.print_report()
+
+    if full_file_path not in computed_hashes:  # Not listed, or could not be read during the parallel pass
+        computed_hashes[full_file_path] = hash_utils.hash_file(full_file_path)
+
+    return computed_hashes[full_file_path]
 
 
 def generate_hash_tests():
@@ -0,0 +1,47 @@
+"""
+Check the vectorized Lagrangian interpolation in src/utils/interpolation_utils.py
+against the loop-based reference, and that every order reproduces polynomials
+of degree below the order exactly. Uses small in-memory Zarr arrays.
+"""
+
+import unittest
+
+import numpy as np
+import zarr
+from parameterized import parameterized
+
+from src.utils import interpolation_utils
+
+
+class VerifyInterpolation(unittest.TestCase):
+    @parameterized.expand([(4,), (6,), (8,)])
+    def test_matches_reference(self, order):
+        rng = np.random.default_rng(order)
+        data = rng.random((40, 40, 40, 3), dtype=np.float32)
+        array = zarr.array(data, chunks=(16, 16, 16, 3))
+        positions = rng.uniform(order // 2 - 1, 40 - order // 2 - 1e-6, size=(50, 3))
+
+        result = interpolation_utils.interpolate(array, positions, order, batch_size=16)
+        expected = np.array([interpolation_utils.interpolate_reference(data, p, order) for p in positions])
+
+        self.assertEqual(result.shape, (50, 3))
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-5)
+
+    @parameterized.expand([(4,), (6,), (8,)])
+    def test_polynomial_exactness(self, order):
+        z, y, x = np.meshgrid(*[np.arange(32) / 32] * 3, indexing='ij')
+        degree = order - 1
+        field = (z ** degree - 2 * y ** (degree - 1) + x * z + 1)[..., np.newaxis]
+        array = zarr.array(field, chunks=(16, 16, 16, 1))
+        positions = np.random.default_rng(0).uniform(order // 2 - 1, 32 - order // 2 - 1e-6, size=(200, 3))
+
+        result = interpolation_utils.interpolate(array, positions, order)[:, 0]
+        z, y, x = (positions / 32).T
+        np.testing.assert_allclose(result, z ** degree - 2 * y ** (degree - 1) + x * z + 1, rtol=1e-9, atol=1e-9)
+
+    def test_invalid(self):
+        array = zarr.zeros((32, 32, 32, 1), chunks=(16, 16, 16, 1))
+        with self.assertRaises(ValueError):
+            interpolation_utils.interpolate(array, [[2.5, 10, 10]], order=8)
+        with self.assertRaises(ValueError):
+            interpolation_utils.interpolate(array, [[10, 10, 10]], order=5)
@@ -0,0 +1,50 @@
+"""
+Check that the vectorized Morton encoder/decoder in src/utils/morton_utils.py
+matches morton-py bit for bit, including the largest (8192^3) domains we write.
+Does not need any data on disk.
+"""
+
+import unittest
+
+import numpy as np
+from parameterized import parameterized
+
+from src.utils import morton_utils, write_utils
+
+try:
+    import morton
+except ImportError:  # Reference implementation is optional
+    morton = None
+
+
+class VerifyMortonCodes(unittest.TestCase):
+    @parameterized.expand([(512,), (2048,), (8192,)])
+    def test_matches_morton_py(self, array_cube_side):
+        if morton is None:
+            self.skipTest("morton-py is not installed")
+
+        bits = morton_utils.bits_for_side(array_cube_side)
+        reference = morton.Morton(dimensions=3, bits=bits)
+
+        rng = np.random.default_rng(array_cube_side)
+        points = rng.integers(0, array_cube_side, size=(2000, 3))
+        # Always include the corners, which exercise the highest bits
+        points = np.vstack([points, [[0, 0, 0], [array_cube_side - 1] * 3, [array_cube_side - 1, 0, 0]]])
+
+        codes = write_utils.morton_pack(array_cube_side, points[:, 0], points[:, 1], points[:, 2])
+        expected = [reference.pack(int(x), int(y), int(z)) for x, y, z in points]
+        self.assertEqual(codes.tolist(), expected)
+
+        x, y, z = write_utils.morton_unpack(array_cube_side, codes)
+        np.testing.assert_array_equal(np.stack([x, y, z], axis=1), points)
+
+    def test_scalar_helpers(self):
+        code = write_utils.morton_pack(2048, 1536, 512, 1024)
+        self.assertIsInstance(code, int)
+        self.assertEqual(write_utils.morton_unpack(2048, code), [1536, 512, 1024])
+
+    def test_out_of_range(self):
+        with self.assertRaises(ValueError):
+            write_utils.morton_pack(2048, 2048, 0, 0)
+        with self.assertRaises(ValueError):
+            morton_utils.encode(0, 0, 0, morton_utils.MAX_BITS + 1)
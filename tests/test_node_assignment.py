@@ -0,0 +1,89 @@
+"""
+Check the node coloring engine in src/utils/node_assignment_utils.py: it must
+reproduce the original node_assignment() layout used on FileDB, never put two
+neighbors on the same disk, and round-trip through its on-disk cache.
+Does not need any data on disk.
+"""
+
+import os
+import tempfile
+import unittest
+from itertools import product
+
+import numpy as np
+from parameterized import parameterized
+
+from src.utils import node_assignment_utils, write_utils
+
+
+def original_node_assignment(cube_side):
+    """The node_assignment() that wrote the existing FileDB layout, kept as a reference"""
+    def get_bounds(idx, mx):
+        return max(idx - 1, 0), min(idx + 2, mx)
+
+    colors = np.arange(34) + 1
+    color_counts = np.zeros_like(colors)
+    nodes = np.zeros([cube_side, cube_side, cube_side], dtype=int)
+
+    for i, j, k in product(np.arange(cube_side), np.arange(cube_side), np.arange(cube_side)):
+        if nodes[i, j, k] == 0:
+            neighbor_colors = nodes[
+                slice(*get_bounds(i, cube_side)),
+                slice(*get_bounds(j, cube_side)),
+                slice(*get_bounds(k, cube_side))
+            ]
+            avail_colors = np.setdiff1d(colors, neighbor_colors.flatten())
+            color_idxs = avail_colors - 1
+            greedy_color_idx = np.argmin(color_counts[color_idxs])
+            greedy_color = colors[color_idxs[greedy_color_idx]]
+            color_counts[color_idxs[greedy_color_idx]] += 1
+
+            nodes[i, j, k] = greedy_color
+
+    return nodes
+
+
+class VerifyNodeAssignment(unittest.TestCase):
+    @parameterized.expand([(4,), (8,)])
+    def test_matches_original(self, cube_side):
+        np.testing.assert_array_equal(node_assignment_utils.color_grid(cube_side, num_disks=34),
+                                      original_node_assignment(cube_side))
+
+    @parameterized.expand([(4, 34, 26), (16, 34, 26), (16, 64, 26), (16, 8, 6)])
+    def test_no_neighbor_shares_disk(self, cube_side, num_disks, neighborhood):
+        nodes = node_assignment_utils.color_grid(cube_side, num_disks, neighborhood)
+        report = node_assignment_utils.validate_node_assignment(nodes, neighborhood, num_disks)
+
+        self.assertTrue(report['valid'], report['conflicts'][:10])
+        self.assertEqual(sum(report['disk_counts']), cube_side ** 3)
+
+    def test_validator_finds_conflicts(self):
+        nodes = node_assignment_utils.color_grid(4)
+        nodes[1, 1, 1] = nodes[2, 2, 2]
+
+        report = node_assignment_utils.validate_node_assignment(nodes)
+        self.assertFalse(report['valid'])
+        self.assertIn(((1, 1, 1), (2, 2, 2)), report['conflicts'])
+
+    def test_on_disk_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = node_assignment_utils.get_node_assignment(4, 34, 26, cache_dir=cache_dir)
+            version = node_assignment_utils.ALGORITHM_VERSION
+            self.assertTrue(os.path.exists(os.path.join(cache_dir, f'node_assignment_v{version}_4_34_26.npy')))
+
+            first[0, 0, 0] = -1  # Callers get a copy and can't corrupt the cache
+            second = node_assignment_utils.get_node_assignment(4, 34, 26, cache_dir=cache_dir)
+            np.testing.assert_array_equal(second, original_node_assignment(4))
+
+    def test_invalid_cache_is_recomputed(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_path = node_assignment_utils._get_cache_path(4, 34, 18, cache_dir)
+            np.save(cache_path, np.ones((4, 4, 4), dtype=int))  # Every neighbor on disk 1
+
+            with self.assertWarnsRegex(UserWarning, 'neighbors sharing a disk'):
+                nodes = node_assignment_utils.get_node_assignment(4, 34, 18, cache_dir=cache_dir)
+            np.testing.assert_array_equal(nodes, node_assignment_utils.color_grid(4, 34, 18))
+            np.testing.assert_array_equal(np.load(cache_path), nodes)
+
+    def test_write_utils_entry_point(self):
+        np.testing.assert_array_equal(write_utils.node_assignment(4, use_cache=False), original_node_assignment(4))
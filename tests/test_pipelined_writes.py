@@ -0,0 +1,128 @@
+"""
+Check the pipelined write path of Dataset.distribute_to_filedb(): it writes
+the same groups as the sequential path, never stages more than lookahead
+timesteps ahead of the oldest unfinished one, keeps staged subcubes within
+max_staged_bytes, and raises staging errors after writing what was staged.
+Uses small synthetic NetCDF files and temporary FileDB folders.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+from unittest import mock
+
+import numpy as np
+import xarray as xr
+import zarr
+from parameterized import parameterized
+
+from src.dataset import NCAR_Dataset
+from src.utils import write_utils
+from src.utils.journal_utils import WriteJournal
+
+NR_TIMESTEPS = 3
+SUBCUBES_PER_TIMESTEP = 8
+
+
+class VerifyPipelinedWrites(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        cls.source = os.path.join(cls.folder, 'source')
+        os.makedirs(cls.source)
+        for timestep in range(NR_TIMESTEPS):
+            data = {v: (('nnz', 'nny', 'nnx'), rng.standard_normal((32, 32, 32), dtype=np.float32))
+                    for v in 'uvwetp'}
+            xr.Dataset(data).to_netcdf(os.path.join(cls.source, f'jhd.{timestep:03d}.nc'))
+
+        cls.disks = []
+        cls.patcher = mock.patch.object(write_utils, 'list_fileDB_folders', side_effect=lambda: list(cls.disks))
+        cls.patcher.start()
+
+        sequential = cls.get_dataset('sequential')
+        sequential.distribute_to_filedb(NUM_THREADS=4)
+        cls.expected = cls.read_groups(sequential)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.patcher.stop()
+        shutil.rmtree(cls.folder)
+
+    @classmethod
+    def get_dataset(cls, name):
+        """Dataset writing to its own 8 FileDB folders under name"""
+        cls.disks[:] = [os.path.join(cls.folder, name, f'disk{i}') + '/' for i in range(8)]
+        for disk in cls.disks:
+            os.makedirs(disk)
+        dataset = NCAR_Dataset('sabl2048b', [cls.source], 4, 16, 'prod', 0, NR_TIMESTEPS - 1,
+                               catalog_path=os.path.join(cls.folder, name, 'catalog.sqlite'))
+        dataset.original_array_length = 32
+        return dataset
+
+    @staticmethod
+    def read_groups(dataset):
+        """Every variable of every written group, keyed by timestep and subcube"""
+        arrays = {}
+        with dataset.get_catalog() as catalog:
+            placements = catalog.get_placements(dataset.name, dataset.write_mode)
+        for placement in placements:
+            group = zarr.open_group(placement['path'], mode='r')
+            for name in group.array_keys():
+                arrays[placement['timestep'], placement['subcube'], name] = group[name][:]
+        return arrays
+
+    @parameterized.expand([(0,), (1,)])
+    def test_matches_sequential(self, lookahead):
+        dataset = self.get_dataset(f'pipelined{lookahead}')
+        journal = WriteJournal(dataset.journal_path)
+        transform_to_zarr = dataset.transform_to_zarr
+        staged = []  # (timestep, nr. of timesteps whose subcubes were all committed when it was staged)
+
+        def stage(timestep):
+            subcubes = Counter(entry['timestep'] for entry in journal.load().values())
+            staged.append((timestep, sum(n == SUBCUBES_PER_TIMESTEP for n in subcubes.values())))
+            return transform_to_zarr(timestep)
+
+        budgets = []
+
+        class RecordedBudget(write_utils.MemoryBudget):
+            def __init__(self, max_bytes=None):
+                super().__init__(max_bytes)
+                budgets.append(self)
+
+        subcube_bytes = transform_to_zarr(0)[0][0].nbytes
+        with mock.patch.object(dataset, 'transform_to_zarr', stage), \
+                mock.patch.object(write_utils, 'MemoryBudget', RecordedBudget):
+            dataset.distribute_to_filedb(NUM_THREADS=4, pipelined=True, lookahead=lookahead,
+                                         max_staged_bytes=2 * subcube_bytes)
+
+        self.assertEqual([timestep for timestep, _ in staged], list(range(NR_TIMESTEPS)))
+        for timestep, finished in staged:
+            self.assertGreaterEqual(finished, timestep - lookahead)
+        self.assertLessEqual(budgets[0].peak, 2 * subcube_bytes)
+        self.assertEqual(budgets[0].reserved, 0)
+
+        arrays = self.read_groups(dataset)
+        self.assertEqual(sorted(arrays), sorted(self.expected))
+        self.assertEqual(len(arrays), NR_TIMESTEPS * SUBCUBES_PER_TIMESTEP * 4)
+        for key, array in self.expected.items():
+            np.testing.assert_array_equal(arrays[key], array)
+
+    def test_staging_error(self):
+        dataset = self.get_dataset('failing')
+        transform_to_zarr = dataset.transform_to_zarr
+
+        def stage(timestep):
+            if timestep == 1:
+                raise OSError("Source file unreadable")
+            return transform_to_zarr(timestep)
+
+        with mock.patch.object(dataset, 'transform_to_zarr', stage):
+            with self.assertRaisesRegex(OSError, "Source file unreadable"):
+                dataset.distribute_to_filedb(NUM_THREADS=4, pipelined=True, max_staged_bytes=1024 ** 3)
+
+        committed = WriteJournal(dataset.journal_path).load().values()
+        self.assertEqual(sorted(entry['timestep'] for entry in committed), [0] * SUBCUBES_PER_TIMESTEP)
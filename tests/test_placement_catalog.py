@@ -0,0 +1,64 @@
+"""
+Check that the placement catalog in src/utils/catalog_utils.py finds the
+subcube holding a point. Uses a temporary SQLite file laid out like one
+2048^3 NCAR timestep; does not need any data on disk.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.utils import write_utils
+from src.utils.catalog_utils import PlacementCatalog
+
+
+def make_placements(timestep, array_cube_side=2048, subcube_side=512):
+    range_list = write_utils.get_range_list([array_cube_side] * 3, subcube_side)
+    min_codes, max_codes = write_utils.get_range_morton_codes(range_list, array_cube_side)
+
+    placements = []
+    for i, ranges in enumerate(range_list):
+        placements.append(dict(
+            dataset='sabl2048b', write_mode='prod', timestep=timestep, subcube=i + 1,
+            array_cube_side=array_cube_side, morton_start=int(min_codes[i]), morton_end=int(max_codes[i]),
+            z_start=ranges[0][0], z_end=ranges[0][1], y_start=ranges[1][0], y_end=ranges[1][1],
+            x_start=ranges[2][0], x_end=ranges[2][1], disk=f'disk{i % 34}', path=f'group{i + 1}_{timestep}.zarr'))
+
+    return placements
+
+
+class VerifyPlacementCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.catalog = PlacementCatalog(os.path.join(self.tmp_dir.name, 'catalog.sqlite'))
+        self.catalog.record(make_placements(0) + make_placements(1))
+
+    def tearDown(self):
+        self.catalog.close()
+        self.tmp_dir.cleanup()
+
+    def test_locate_point(self):
+        rng = np.random.default_rng(0)
+        for z, y, x in rng.integers(0, 2048, size=(200, 3)):
+            placement = self.catalog.locate_point('sabl2048b', 'prod', 1, int(z), int(y), int(x))
+            self.assertEqual(placement['timestep'], 1)
+            self.assertTrue(placement['z_start'] <= z < placement['z_end'])
+            self.assertTrue(placement['y_start'] <= y < placement['y_end'])
+            self.assertTrue(placement['x_start'] <= x < placement['x_end'])
+
+    def test_locate_points_matches_locate_point(self):
+        points = np.array([[0, 0, 0], [2047, 2047, 2047], [511, 512, 1024], [100, 1500, 900], [2048, 0, 0]])
+        placements, found = self.catalog.locate_points('sabl2048b', 'prod', 0, points)
+
+        for point, idx in zip(points, found):
+            expected = self.catalog.locate_point('sabl2048b', 'prod', 0, *map(int, point))
+            if expected is None:
+                self.assertEqual(idx, -1)
+            else:
+                self.assertEqual(placements[idx]['path'], expected['path'])
+
+    def test_unknown_timestep(self):
+        self.assertIsNone(self.catalog.locate_point('sabl2048b', 'prod', 5, 0, 0, 0))
+        self.assertEqual(len(self.catalog.get_placements('sabl2048b', 'prod', 0)), 64)
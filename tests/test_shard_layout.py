@@ -0,0 +1,131 @@
+"""
+Check the sharded group layout of src/utils/shard_utils.py: a group written
+with layout='sharded' reads back exactly like the directory layout through
+Zarr, xarray and HaloReader, keeps its chunk checksums valid, serves single
+chunks by byte range, converts back to byte-identical chunk files, and
+releases its shard files. Uses small groups in a temporary folder.
+"""
+
+import filecmp
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+
+import numcodecs
+import numpy as np
+import xarray as xr
+import zarr
+from parameterized import parameterized
+
+from src.utils import checksum_utils, shard_utils, write_utils
+from src.utils.halo_utils import HaloReader
+from src.utils.timeseries_utils import TimeSeriesReader
+
+
+def count_open_files() -> int:
+    return len(os.listdir('/proc/self/fd'))
+
+
+class VerifyShardLayout(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        dims = ('nnz', 'nny', 'nnx')
+        self.ds = xr.Dataset({'velocity': (dims + ('xyz',), rng.random((32, 32, 32, 3), dtype=np.float32)),
+                              'energy': (dims + ('extra_dim',), rng.random((32, 32, 32, 1), dtype=np.float32))})
+        self.encoding = {'velocity': dict(chunks=(8, 8, 8, 3), compressor=numcodecs.Blosc('lz4')),
+                         'energy': dict(chunks=(8, 8, 8, 1), compressor=None)}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_write_and_read(self):
+        directory_path = os.path.join(self.folder, 'directory.zarr')
+        sharded_path = os.path.join(self.folder, 'sharded.zarr')
+        write_utils.write_zarr_group(self.ds, directory_path, self.encoding, staged=True, checksums=True)
+        write_utils.write_zarr_group(self.ds, sharded_path, self.encoding, staged=True, checksums=True,
+                                     layout='sharded')
+
+        self.assertTrue(shard_utils.is_sharded_group(sharded_path))
+        nr_files = sum(len(files) for _, _, files in os.walk(sharded_path))
+        self.assertLess(nr_files, 15)
+        self.assertGreater(sum(len(files) for _, _, files in os.walk(directory_path)), 2 * 64)
+        self.assertEqual(checksum_utils.verify_group(sharded_path), [])
+
+        group = zarr.open_group(shard_utils.get_store(sharded_path), mode='r')
+        for name in ('velocity', 'energy'):
+            np.testing.assert_array_equal(group[name][:], self.ds[name].values)
+        xr.testing.assert_identical(xr.open_zarr(shard_utils.get_store(sharded_path)).load(),
+                                    xr.open_zarr(directory_path).load())
+
+        # Byte-range access to one chunk
+        store = shard_utils.ShardedStore(sharded_path)
+        path, offset, nbytes = store.get_chunk_range('velocity/1.2.3.0')
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read(nbytes)
+        with open(os.path.join(directory_path, 'velocity', '1.2.3.0'), 'rb') as f:
+            self.assertEqual(chunk, f.read())
+        store.close()
+
+        placement = dict(path=sharded_path, disk='disk0', z_start=0, z_end=32, y_start=0, y_end=32, x_start=0,
+                         x_end=32)
+        np.testing.assert_array_equal(HaloReader([placement]).read_region((3, 5, 7), (20, 8, 9)),
+                                      self.ds['velocity'].values[3:23, 5:13, 7:16])
+
+    @parameterized.expand([('.',), ('/',)])
+    def test_round_trip(self, separator):
+        source = os.path.join(self.folder, 'source.zarr')
+        group = zarr.open_group(source, mode='w')
+        group.array('velocity', self.ds['velocity'].values, chunks=(8, 8, 8, 3), dimension_separator=separator)
+        shard_utils.shard_group(source, os.path.join(self.folder, 'sharded.zarr'), shards_per_array=3)
+
+        index = shard_utils.ShardedStore(os.path.join(self.folder, 'sharded.zarr'))
+        self.assertEqual(len(index.shards), 3)
+        self.assertEqual(len(index.chunks), 64)
+        np.testing.assert_array_equal(zarr.open_group(index, mode='r')['velocity'][:], self.ds['velocity'].values)
+        index.close()
+
+        shard_utils.unshard_group(os.path.join(self.folder, 'sharded.zarr'), os.path.join(self.folder, 'back.zarr'))
+        back = os.path.join(self.folder, 'back.zarr')
+        files = [os.path.relpath(os.path.join(root, name), source) for root, _, names in os.walk(source)
+                 for name in names]
+        self.assertEqual(sorted(files), sorted(os.path.relpath(os.path.join(root, name), back)
+                                               for root, _, names in os.walk(back) for name in names))
+        _, mismatches, errors = filecmp.cmpfiles(source, back, files, shallow=False)
+        self.assertEqual(mismatches + errors, [])
+        self.assertEqual(checksum_utils.compute_checksums(source),
+                         checksum_utils.compute_checksums(os.path.join(self.folder, 'sharded.zarr')))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "Needs /proc to count open files")
+    def test_releases_files(self):
+        path = os.path.join(self.folder, 'sharded.zarr')
+        write_utils.write_zarr_group(self.ds, path, self.encoding, staged=True, layout='sharded')
+        placement = dict(path=path, disk='disk0', z_start=0, z_end=32, y_start=0, y_end=32, x_start=0, x_end=32)
+        gc.collect()
+        open_files = count_open_files()
+
+        for _ in range(50):  # Dropped without close()
+            self.assertEqual(zarr.open_group(shard_utils.get_store(path), mode='r')['energy'][0, 0, 0, 0],
+                             self.ds['energy'].values[0, 0, 0, 0])
+        gc.collect()
+        self.assertEqual(count_open_files(), open_files)
+
+        with shard_utils.get_store(path) as store:
+            zarr.open_group(store, mode='r')['velocity'][:]
+            self.assertGreater(count_open_files(), open_files)
+        self.assertEqual(count_open_files(), open_files)
+
+        reader = HaloReader([placement])
+        reader.read_region((0, 0, 0), (32, 32, 32))
+        reader.close()
+        self.assertEqual(count_open_files(), open_files)
+
+        # Only the most recently used timestep stays open
+        with TimeSeriesReader(lambda timestep: [placement], max_open_timesteps=1) as series:
+            for timestep in range(5):
+                series.read_points([(1, 2, 3)], [timestep])
+            self.assertEqual(count_open_files(), open_files + 1)
+        self.assertEqual(count_open_files(), open_files)
@@ -0,0 +1,74 @@
+"""
+Check that the slab-streaming ingest in src/utils/slab_utils.py writes the
+same Zarr groups as the dask path of NCAR_Dataset.transform_to_zarr(),
+including for CF-encoded variables (packed, scaled, with missing values).
+Uses a small synthetic NetCDF file; does not need any data on disk.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import xarray as xr
+import zarr
+from parameterized import parameterized
+
+from src.dataset import NCAR_Dataset
+from src.utils import slab_utils
+
+
+class VerifySlabIngest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        data = {v: (('nnz', 'nny', 'nnx'), rng.standard_normal((32, 32, 32), dtype=np.float32)) for v in 'uvwetp'}
+        xr.Dataset(data).to_netcdf(os.path.join(self.tmp_dir.name, 'jhd.000.nc'))
+
+        self.dataset = NCAR_Dataset('sabl2048b', [self.tmp_dir.name], 4, 16, 'prod', 0, 0,
+                                    catalog_path=os.path.join(self.tmp_dir.name, 'catalog.sqlite'))
+        self.dataset.original_array_length = 32
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @parameterized.expand([
+        (1024 ** 3,),  # Whole group depth per slab
+        (1,),  # Smallest slabs, one at a time
+    ])
+    def test_matches_dask_path(self, max_bytes):
+        self.check_matches_dask_path(max_bytes)
+
+    def test_cf_encoded_source(self):
+        path = self.dataset._get_source_file(0)
+        ds = xr.load_dataset(path)
+        ds['e'].values[0, 0, :4] = np.nan
+        ds['t'].values[1, 2, :3] = -1.0
+        encoding = {'e': dict(dtype='int16', scale_factor=0.001, add_offset=1.0, _FillValue=-32768),
+                    't': dict(missing_value=-1.0, _FillValue=None),
+                    'p': dict(dtype='uint8', scale_factor=0.05, add_offset=-6.0, _FillValue=255)}
+        ds.to_netcdf(path, encoding=encoding)
+
+        self.check_matches_dask_path(1024 ** 3)
+
+    def check_matches_dask_path(self, max_bytes):
+        cubes, range_list = self.dataset.transform_to_zarr(0)
+        groups = []
+        for i, cube in enumerate(cubes):
+            path = os.path.join(self.tmp_dir.name, f'group{i}.zarr')
+            cube.to_zarr(path, mode='w', encoding=self.dataset.encoding, compute=False)
+            groups.append(dict(ranges={dim: tuple(r) for dim, r in zip(self.dataset.split_dims, range_list[i])},
+                               path=path, disk=f'disk{i % 3}'))
+
+        done = []
+        sources = [(self.dataset._get_source_file(0), self.dataset.source_variables, cubes[0]['energy'].dims[:3],
+                    groups)]
+        stats = slab_utils.stream_slabs_to_groups(sources, 16, 4, num_threads=4, max_bytes=max_bytes,
+                                                  on_group_done=lambda group, error: done.append(error))
+
+        self.assertEqual(stats['errors'], [])
+        self.assertEqual(done, [None] * len(groups))
+        for cube, group in zip(cubes, groups):
+            written = zarr.open_group(group['path'], mode='r')
+            for name in cube.data_vars:
+                np.testing.assert_array_equal(written[name][:], cube[name].values)
@@ -0,0 +1,63 @@
+"""
+Check that the single-pass verifier in src/utils/verify_utils.py accepts
+correctly written Zarr groups and reports corrupted chunks with their
+coordinates, both when comparing everything and when sampling. Uses a small
+synthetic NetCDF file; does not need any data on disk.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import xarray as xr
+import zarr
+from parameterized import parameterized
+
+from src.dataset import NCAR_Dataset
+from src.utils import write_utils
+
+
+class VerifySourceVerifier(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        data = {v: (('nnz', 'nny', 'nnx'), rng.standard_normal((32, 32, 32), dtype=np.float32)) for v in 'uvwetp'}
+        xr.Dataset(data).to_netcdf(os.path.join(self.tmp_dir.name, 'jhd.000.nc'))
+
+        self.dataset = NCAR_Dataset('sabl2048b', [self.tmp_dir.name], 4, 16, 'prod', 0, 0,
+                                    catalog_path=os.path.join(self.tmp_dir.name, 'catalog.sqlite'))
+        self.dataset.original_array_length = 32
+
+        # Write every subcube to a catalog-recorded path inside the temporary folder
+        cubes, range_list = self.dataset.transform_to_zarr(0)
+        placements = self.dataset.get_subcube_placements(0, range_list)
+        with self.dataset.get_catalog() as catalog:
+            for i, (cube, placement) in enumerate(zip(cubes, placements)):
+                placement.update(path=os.path.join(self.tmp_dir.name, f'group{i}.zarr'), disk=f'disk{i % 3}')
+                write_utils.write_zarr_group(cube, placement['path'], self.dataset.encoding)
+                catalog.record(placement)
+        self.placements = placements
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @parameterized.expand([(1.0,), (0.1,)])
+    def test_correct_data(self, sample_fraction):
+        report = self.dataset.verify_against_source(NUM_THREADS=4, sample_fraction=sample_fraction,
+                                                    max_slab_bytes=1)
+        self.assertEqual(report.mismatches, [])
+        self.assertEqual(report.errors, [])
+        expected_chunks = 8 * 4 * 64 if sample_fraction == 1 else 8 * 4 * 7
+        self.assertEqual(report.chunks_checked, expected_chunks)
+
+    def test_reports_chunk(self):
+        placement = self.placements[5]
+        zarr.open_group(placement['path'], mode='r+')['velocity'][9, 2, 13, 1] = 99
+
+        report = self.dataset.verify_against_source(NUM_THREADS=4)
+        self.assertEqual(len(report.mismatches), 1)
+        mismatch = report.mismatches[0]
+        self.assertEqual((mismatch['path'], mismatch['variable'], mismatch['chunk']),
+                         (placement['path'], 'velocity', (2, 0, 3)))
+        self.assertEqual(mismatch['start'], (placement['z_start'] + 8, placement['y_start'], placement['x_start'] + 12))
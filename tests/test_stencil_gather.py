@@ -0,0 +1,57 @@
+"""
+Check that the batched stencil gather in src/utils/stencil_utils.py returns
+the same neighborhoods as slicing one point at a time, including stencils
+that straddle chunk faces and partial edge chunks, and that it reads every
+chunk at most once. Uses small in-memory Zarr arrays.
+"""
+
+import unittest
+from collections import Counter
+
+import numpy as np
+import zarr
+from parameterized import parameterized
+
+from src.utils import stencil_utils
+
+
+class CountingStore(dict):
+    """In-memory Zarr store counting the reads of every chunk"""
+
+    def __init__(self):
+        super().__init__()
+        self.reads = Counter()
+
+    def __getitem__(self, key):
+        self.reads[key] += 1
+        return super().__getitem__(key)
+
+
+class VerifyStencilGather(unittest.TestCase):
+    @parameterized.expand([
+        ((40, 40, 40, 3), (16, 16, 16, 3), 8),  # Velocity-like, partial edge chunks
+        ((40, 40, 40, 1), (16, 16, 16, 1), 4),  # Scalar, smaller stencil
+        ((32, 32, 32), (8, 8, 8), 8),  # Stencil as large as a chunk
+    ])
+    def test_matches_slicing(self, shape, chunks, side):
+        store = CountingStore()
+        array = zarr.open_array(store, mode='w', shape=shape, chunks=chunks, dtype='f4')
+        array[:] = np.random.default_rng(0).random(shape, dtype=np.float32)
+        store.reads.clear()
+
+        half = side // 2
+        indices = np.random.default_rng(1).integers(half, shape[0] - half + 1, size=(500, 3))
+        result = stencil_utils.gather_stencils(array, indices, side=side)
+        chunk_reads = [count for key, count in store.reads.items() if not key.startswith('.')]
+        self.assertEqual(max(chunk_reads), 1)
+
+        self.assertEqual(result.shape, (500, side, side, side) + shape[3:])
+        data = array[:]
+        for n, (z, y, x) in enumerate(indices):
+            np.testing.assert_array_equal(result[n], data[z - half:z + half, y - half:y + half, x - half:x + half])
+
+    def test_out_of_bounds(self):
+        array = zarr.zeros((32, 32, 32, 3), chunks=(16, 16, 16, 3), dtype='f4')
+        with self.assertRaises(ValueError):
+            stencil_utils.gather_stencils(array, [[3, 10, 10]])
+        self.assertEqual(stencil_utils.gather_stencils(array, np.zeros((0, 3), dtype=int)).shape, (0, 8, 8, 8, 3))
@@ -0,0 +1,125 @@
+"""
+Check that the time-series reader in src/utils/timeseries_utils.py returns
+regions and point histories over many timesteps exactly like slicing every
+timestep, that it reuses the groups it opened, and that the time-chunked
+companion layout serves the same results, with one set of companions per
+timestep range written. Uses 8 small Zarr groups per timestep in a temporary
+folder, each subcube on its own pretend disk.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import zarr
+
+from src.dataset import NCAR_Dataset
+from src.utils import timeseries_utils
+from src.utils.timeseries_utils import TimeSeriesReader
+
+GROUP_LENGTH = 16
+TIMESTEPS = [0, 1, 2, 3]
+
+
+class VerifyTimeSeriesReader(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = np.random.default_rng(0).random((len(TIMESTEPS),) + (2 * GROUP_LENGTH,) * 3 + (3,),
+                                                    dtype=np.float32)
+
+        self.placements = {}
+        for t, timestep in enumerate(TIMESTEPS):
+            for i, position in enumerate(np.ndindex(2, 2, 2)):
+                starts = [p * GROUP_LENGTH for p in position]
+                path = os.path.join(self.folder, f'disk{i}', f'group{i + 1:02d}_{timestep:03d}.zarr')
+                group = zarr.open_group(path, mode='w')
+                group.array('velocity', self.data[(t,) + tuple(slice(s, s + GROUP_LENGTH) for s in starts)],
+                            chunks=(8, 8, 8, 3))
+                self.placements.setdefault(timestep, []).append(dict(
+                    path=path, disk=f'disk{i}', subcube=i + 1, z_start=starts[0], z_end=starts[0] + GROUP_LENGTH,
+                    y_start=starts[1], y_end=starts[1] + GROUP_LENGTH, x_start=starts[2],
+                    x_end=starts[2] + GROUP_LENGTH))
+
+        self.opened = []
+
+        def get_placements(timestep):
+            self.opened.append(timestep)
+            return self.placements[timestep]
+
+        self.reader = TimeSeriesReader(get_placements, max_reads_per_disk=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_region_and_points(self):
+        region = self.reader.read_region((5, 10, 12), (20, 8, 6), [3, 0, 2])
+        np.testing.assert_array_equal(region, self.data[[3, 0, 2], 5:25, 10:18, 12:18])
+
+        points = np.random.default_rng(1).integers(0, 2 * GROUP_LENGTH, size=(200, 3))
+        values = self.reader.read_points(points, TIMESTEPS)
+        self.assertEqual(values.shape, (len(TIMESTEPS), 200, 3))
+        np.testing.assert_array_equal(values, self.data[(slice(None),) + tuple(points.T)])
+
+        # Every timestep was resolved once, and its groups stay open for later queries
+        self.assertEqual(sorted(self.opened), TIMESTEPS)
+        self.assertIs(self.reader.get_reader(3), self.reader.get_reader(3))
+        self.assertEqual(sorted(self.opened), TIMESTEPS)
+
+    def test_time_chunked(self):
+        companions = []
+        for i, placement in enumerate(self.placements[TIMESTEPS[0]]):
+            path = os.path.join(self.folder, f'disk{i}', f'group{i + 1:02d}_time.zarr')
+            timeseries_utils.write_time_chunked_group([self.placements[t][i]['path'] for t in TIMESTEPS],
+                                                      TIMESTEPS, path, chunk_length=4)
+            companions.append(dict(placement, path=path))
+
+        array = zarr.open_group(companions[0]['path'], mode='r')['velocity']
+        self.assertEqual(array.shape, (GROUP_LENGTH,) * 3 + (len(TIMESTEPS), 3))
+        self.assertEqual(array.chunks, (4, 4, 4, len(TIMESTEPS), 3))
+
+        reader = TimeSeriesReader(self.placements.get, time_chunked_placements=[companions])
+        np.testing.assert_array_equal(reader.read_region((5, 10, 12), (20, 8, 6), [3, 0, 2]),
+                                      self.data[[3, 0, 2], 5:25, 10:18, 12:18])
+        points = np.random.default_rng(2).integers(0, 2 * GROUP_LENGTH, size=(50, 3))
+        np.testing.assert_array_equal(reader.read_points(points, [1, 2]), self.data[(slice(1, 3),) + tuple(points.T)])
+        self.assertEqual(len(reader._readers), 0)  # The timestep groups were never opened
+
+        # Timesteps missing from the companion layout are read from the timestep groups
+        self.placements[4] = self.placements[0]
+        np.testing.assert_array_equal(reader.read_points(points, [4]), self.data[(slice(0, 1),) + tuple(points.T)])
+
+    def test_time_chunked_ranges(self):
+        """Jobs writing 0-1 and 2-3 each leave companions of their own range, and neither replaces the other"""
+        dataset = NCAR_Dataset('sabl2048b', [], 8, GROUP_LENGTH, 'prod', 0, 3,
+                               catalog_path=os.path.join(self.folder, 'catalog.sqlite'))
+        with mock.patch.object(dataset, 'get_placements', self.placements.get):
+            for timesteps in ([0, 1], [2, 3]):
+                for i, placement in enumerate(self.placements[0]):
+                    timeseries_utils.write_time_chunked_group(
+                        [self.placements[t][i]['path'] for t in timesteps], timesteps,
+                        dataset.get_time_chunked_path(placement, timesteps[0], timesteps[-1]), chunk_length=4)
+            # A range only one subcube has a companion of, e.g. from a job that was killed, is ignored
+            timeseries_utils.write_time_chunked_group(
+                [self.placements[t][0]['path'] for t in TIMESTEPS], TIMESTEPS,
+                dataset.get_time_chunked_path(self.placements[0][0], 0, 3), chunk_length=4)
+
+            sets = dataset.get_time_chunked_placements()
+            self.assertEqual([os.path.basename(placements[0]['path']) for placements in sets],
+                             ['sabl2048b01_time_000-001.zarr', 'sabl2048b01_time_002-003.zarr'])
+
+            reader = dataset.get_timeseries_reader()
+        self.assertEqual(len(reader.time_chunked), 2)
+        np.testing.assert_array_equal(reader.read_region((5, 10, 12), (20, 8, 6), [3, 2]),
+                                      self.data[[3, 2], 5:25, 10:18, 12:18])
+        np.testing.assert_array_equal(reader.read_region((5, 10, 12), (20, 8, 6), [1]),
+                                      self.data[[1], 5:25, 10:18, 12:18])
+        self.assertEqual(len(reader._readers), 0)  # Both served by a companion set
+
+        # Spanning both ranges, so read from the timestep groups
+        np.testing.assert_array_equal(reader.read_region((5, 10, 12), (20, 8, 6), [1, 2]),
+                                      self.data[[1, 2], 5:25, 10:18, 12:18])
+        self.assertEqual(sorted(reader._readers), [1, 2])
+        reader.close()
@@ -0,0 +1,87 @@
+"""
+Check the blockwise velocity merge of src/utils/write_utils.py: it builds the
+same velocity as merge_velocities(), chunk for chunk, and writes
+byte-identical Zarr groups. Writer threads inside write_utils.shared_dask_pool()
+never run more merge tasks at once than the pool has threads. Uses a small
+lazy u, v, w, e dataset and a temporary folder.
+"""
+
+import filecmp
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+import xarray as xr
+from parameterized import parameterized
+
+from src.utils import write_utils
+
+CHUNK_LENGTH = 8
+
+
+class VerifyVelocityMerge(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        dims = ('nnz', 'nny', 'nnx', 'extra_dim')
+        # Not a multiple of the chunk length, so edge chunks are smaller
+        ds = xr.Dataset({name: (dims, rng.random((20, 20, 20, 1), dtype=np.float32)) for name in 'uvwe'})
+        self.ds = ds.chunk({'nnz': CHUNK_LENGTH, 'nny': CHUNK_LENGTH, 'nnx': CHUNK_LENGTH})
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_identical_to_dask_merge(self):
+        expected = write_utils.merge_velocities(self.ds, CHUNK_LENGTH)
+        merged = write_utils.merge_velocities_blockwise(self.ds, CHUNK_LENGTH)
+
+        self.assertEqual(merged['velocity'].data.chunks, expected['velocity'].data.chunks)
+        xr.testing.assert_identical(merged.load(), expected.load())
+
+        encoding = {'velocity': dict(chunks=(CHUNK_LENGTH,) * 3 + (3,), compressor=None),
+                    'e': dict(chunks=(CHUNK_LENGTH,) * 3 + (1,), compressor=None)}
+        paths = [os.path.join(self.folder, name) for name in ('dask.zarr', 'blockwise.zarr')]
+        for merge, path in zip((expected, merged), paths):
+            merge.to_zarr(path, encoding=encoding)
+        files = sorted(os.listdir(os.path.join(paths[0], 'velocity')))
+        self.assertEqual(files, sorted(os.listdir(os.path.join(paths[1], 'velocity'))))
+        _, mismatches, errors = filecmp.cmpfiles(os.path.join(paths[0], 'velocity'),
+                                                 os.path.join(paths[1], 'velocity'), files, shallow=False)
+        self.assertEqual(mismatches + errors, [])
+
+    @parameterized.expand([(1,), (2,)])
+    def test_shared_pool(self, num_threads):
+        lock = threading.Lock()
+        running = []  # Nr. of tasks running at once, after each one started or finished
+
+        def record(chunk):
+            with lock:
+                running.append(running[-1] + 1 if running else 1)
+            time.sleep(0.01)  # Long enough for other threads' tasks to start meanwhile
+            with lock:
+                running.append(running[-1] - 1)
+            return chunk
+
+        merged = write_utils.merge_velocities_blockwise(self.ds, CHUNK_LENGTH)
+        velocity = merged['velocity'].data.map_blocks(record, dtype=merged['velocity'].dtype)
+        expected = np.concatenate([self.ds[name].values for name in 'uvw'], axis=3)
+        results = []
+
+        def write():  # Like a writer thread computing its subcube
+            results.append(velocity.compute())
+
+        with write_utils.shared_dask_pool(num_threads):
+            writers = [threading.Thread(target=write) for _ in range(4)]
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join()
+
+        self.assertEqual(len(results), 4)
+        for result in results:
+            np.testing.assert_array_equal(result, expected)
+        self.assertEqual(max(running), num_threads)
@@ -0,0 +1,193 @@
+"""
+Check the shared-storage work pool in src/utils/coordinator_utils.py: items
+are handed out exactly once across threads and processes, failed items go
+back to the pool until max_attempts, and leases of workers that stopped
+renewing them are broken. A worker whose lease was broken while it wrote a
+subcube must not commit it over the group of the worker that broke the lease.
+Uses a temporary folder as the shared storage.
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+import xarray as xr
+import zarr
+
+from src.dataset import NCAR_Dataset
+from src.utils import coordinator_utils, shard_utils, write_utils
+from src.utils.coordinator_utils import WorkPool
+from src.utils.journal_utils import WriteJournal
+
+
+def process_items(pool_path, output_path, worker_id):
+    """Worker of test_processes: records every item it processes in its own file"""
+    pool = WorkPool(pool_path)
+
+    def handler(item):
+        with open(os.path.join(output_path, f"{item['id']}.{worker_id}"), 'w'):
+            pass
+
+    threads = [threading.Thread(target=coordinator_utils.run_worker, args=(pool, f'{worker_id}-{i}', handler))
+               for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+class VerifyWorkPool(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.items = [dict(id=f'{timestep:04d}_{subcube:03d}', timestep=timestep, subcube=subcube)
+                      for timestep in range(3) for subcube in range(1, 9)]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_processes(self):
+        pool_path, output_path = os.path.join(self.folder, 'pool'), os.path.join(self.folder, 'out')
+        os.makedirs(output_path)
+        WorkPool(pool_path).initialize(self.items)
+
+        processes = [multiprocessing.Process(target=process_items, args=(pool_path, output_path, f'worker{i}'))
+                     for i in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        processed = sorted(name.split('.')[0] for name in os.listdir(output_path))
+        self.assertEqual(processed, sorted(item['id'] for item in self.items))
+        status = WorkPool(pool_path).status()
+        self.assertEqual((status['done'], status['running'], status['pending']), (len(self.items), 0, 0))
+        self.assertEqual(sum(worker['done'] for worker in status['workers']), len(self.items))
+
+    def test_initialize_once(self):
+        pool = WorkPool(self.folder)
+        pool.initialize(self.items)
+        self.assertEqual(WorkPool(self.folder).initialize(self.items[:2]), self.items)
+
+    def test_failures_return_to_pool(self):
+        pool = WorkPool(self.folder, max_attempts=2)
+        pool.initialize(self.items)
+        attempts = []
+
+        def handler(item):
+            attempts.append(item['id'])
+            if item['id'] == '0001_002' or (item['id'] == '0002_003' and attempts.count(item['id']) == 1):
+                raise OSError("Disk full")
+
+        counts = coordinator_utils.run_worker(pool, 'worker', handler)
+        self.assertEqual(attempts.count('0001_002'), 2)  # Given up after max_attempts
+        self.assertEqual(attempts.count('0002_003'), 2)  # Succeeded on the second attempt
+        self.assertEqual(counts, dict(done=len(self.items) - 1, failed=3))
+        status = pool.status()
+        self.assertEqual((status['done'], status['failed'], status['pending']), (len(self.items) - 1, 1, 0))
+
+    def test_abandoned_lease(self):
+        pool = WorkPool(self.folder, lease_seconds=60)
+        pool.initialize(self.items[:1])
+        self.assertEqual(pool.claim('dead worker'), self.items[0])
+        self.assertIsNone(pool.claim('other worker'))  # The lease is fresh
+
+        lease_path = os.path.join(self.folder, 'leases', self.items[0]['id'])
+        with open(lease_path) as f:
+            lease = json.load(f)
+        with open(lease_path, 'w') as f:
+            json.dump(dict(lease, renewed_at=time.time() - 120), f)
+        status = pool.status()
+        self.assertEqual((status['running'], status['pending']), (0, 1))  # Claimable again
+
+        self.assertEqual(pool.claim('other worker'), self.items[0])
+        self.assertFalse(pool.renew(self.items[0]['id'], 'dead worker'))
+        self.assertTrue(pool.renew(self.items[0]['id'], 'other worker'))
+        pool.complete(self.items[0]['id'], 'other worker')
+        self.assertIsNone(pool.claim('third worker'))
+
+    def test_racing_breakers(self):
+        pool = WorkPool(self.folder, lease_seconds=60)
+        pool.initialize(self.items[:1])
+        item_id = self.items[0]['id']
+        lease_path = os.path.join(self.folder, 'leases', item_id)
+        with open(lease_path, 'w') as f:
+            json.dump(dict(worker='dead worker', claimed_at=0, renewed_at=time.time() - 120), f)
+
+        # B reads the abandoned lease, then A breaks it and claims the item before B goes on
+        read_json = coordinator_utils._read_json
+        claims = {}
+
+        def delayed_read(path):
+            lease = read_json(path)
+            if path == lease_path and not claims:
+                claims['A'] = None
+                claims['A'] = WorkPool(self.folder, lease_seconds=60)._try_lease(item_id, 'A')
+            return lease
+
+        with mock.patch.object(coordinator_utils, '_read_json', delayed_read):
+            claims['B'] = pool._try_lease(item_id, 'B')
+
+        self.assertEqual(claims, {'A': True, 'B': False})
+        with open(lease_path) as f:
+            self.assertEqual(json.load(f)['worker'], 'A')
+        self.assertTrue(pool.renew(item_id, 'A'))
+        self.assertFalse(pool.renew(item_id, 'B'))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'leases'))), [item_id])  # No lock left
+
+
+class VerifyLeasedWrites(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.pool = WorkPool(os.path.join(self.folder, 'pool'), lease_seconds=60)
+        self.path = os.path.join(self.folder, 'sabl2048b01_000.zarr')
+        self.item = dict(id='0000_001', timestep=0, index=0, placement=dict(
+            timestep=0, subcube=1, path=self.path, disk=self.folder))
+        self.pool.initialize([self.item])
+        self.dataset = NCAR_Dataset('sabl2048b', [], 4, 8, 'prod', 0, 0,
+                                    catalog_path=os.path.join(self.folder, 'catalog.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def get_handler(self, worker_id, value):
+        cube = xr.Dataset({name: (('nnz', 'nny', 'nnx', 'extra_dim'), np.full((8, 8, 8, 1), value, np.float32))
+                           for name in ('pressure', 'temperature', 'energy')})
+        cube['velocity'] = (('nnz', 'nny', 'nnx', 'velocity component (xyz)'), np.full((8, 8, 8, 3), value, np.float32))
+        journal = WriteJournal(self.pool.get_journal_path(worker_id))
+        write_options = dict(writer='xarray', sync_policy='none', checksums=False, layout='directory')
+
+        return lambda item: self.dataset._write_leased_subcube(self.pool, worker_id, item, cube, journal, False,
+                                                               write_options)
+
+    def test_broken_lease(self):
+        convert_in_place = shard_utils.convert_in_place
+        counts = {}
+
+        def break_lease(path, layout):
+            """A has staged the group but not committed it yet when its lease expires and B writes the group"""
+            convert_in_place(path, layout)
+            if path == write_utils.get_staging_path(self.path, 'A') and 'B' not in counts:
+                lease_path = os.path.join(self.pool.path, 'leases', self.item['id'])
+                with open(lease_path) as f:
+                    lease = json.load(f)
+                with open(lease_path, 'w') as f:
+                    json.dump(dict(lease, renewed_at=time.time() - 120), f)
+                counts['B'] = coordinator_utils.run_worker(self.pool, 'B', self.get_handler('B', 2))
+
+        with mock.patch.object(shard_utils, 'convert_in_place', break_lease):
+            counts['A'] = coordinator_utils.run_worker(self.pool, 'A', self.get_handler('A', 1))
+
+        self.assertEqual(counts, dict(A=dict(done=0, failed=0), B=dict(done=1, failed=0)))
+        self.assertTrue(self.pool.is_finished())
+        np.testing.assert_array_equal(zarr.open_group(self.path, mode='r')['energy'][:], 2)
+        self.assertEqual(os.listdir(self.folder).count('sabl2048b01_000.zarr'), 1)
+        self.assertEqual([name for name in os.listdir(self.folder) if name.endswith('.partial')], [])
+        self.assertEqual(WriteJournal(self.pool.get_journal_path('A')).load(), {})
+        self.assertEqual(list(WriteJournal(self.pool.get_journal_path('B')).load()), [self.path])
@@ -0,0 +1,141 @@
+"""
+Check resumable distribution: the write journal of src/utils/journal_utils.py
+survives a truncated last line and detects groups that changed on disk,
+write_utils.commit_staged_group() replaces groups without leaving anything
+behind, and a write killed between staging and commit is finished by a run
+with resume=True. Uses a small synthetic NetCDF file and temporary FileDB
+folders.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import xarray as xr
+import zarr
+
+from src.dataset import NCAR_Dataset
+from src.utils import write_utils
+from src.utils.catalog_utils import get_directory_checksum, get_directory_size
+from src.utils.journal_utils import WriteJournal
+
+
+class VerifyWriteJournal(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal = WriteJournal(os.path.join(self.folder, 'journal.jsonl'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_group(self, path, value):
+        group = zarr.open_group(path, mode='w')
+        group.array('energy', np.full((4, 4, 4, 1), value, dtype=np.float32), chunks=(2, 2, 2, 1))
+
+    def test_truncated_last_line(self):
+        self.journal.record(0, 1, '/a.zarr', 10)
+        self.journal.record(0, 2, '/b.zarr', 20)
+        self.journal.record(0, 1, '/a.zarr', 30)  # Rewritten, later entries win
+        with open(self.journal.path, 'a') as f:
+            f.write('{"timestep": 0, "subcube": 3, "path": "/c.z')  # Killed mid-append
+
+        entries = self.journal.load()
+        self.assertEqual(sorted(entries), ['/a.zarr', '/b.zarr'])
+        self.assertEqual(entries['/a.zarr']['byte_size'], 30)
+
+    def test_is_committed(self):
+        path = os.path.join(self.folder, 'group.zarr')
+        self.write_group(path, 1)
+        self.journal.record(0, 1, path, get_directory_size(path))
+        entry = self.journal.load()[path]
+
+        self.assertTrue(WriteJournal.is_committed(entry, path))
+        self.assertFalse(WriteJournal.is_committed(None, path))
+        self.assertFalse(WriteJournal.is_committed(dict(entry, byte_size=entry['byte_size'] + 1), path))
+        os.remove(os.path.join(path, '.zgroup'))
+        self.assertFalse(WriteJournal.is_committed(entry, path))
+
+    def test_is_committed_checksum(self):
+        path = os.path.join(self.folder, 'group.zarr')
+        self.write_group(path, 1)
+        self.journal.record(0, 1, path, get_directory_size(path), get_directory_checksum(path))
+        entry = self.journal.load()[path]
+        self.assertTrue(WriteJournal.is_committed(entry, path))
+
+        self.write_group(path, 2)  # Same size, different contents
+        self.assertEqual(get_directory_size(path), entry['byte_size'])
+        self.assertFalse(WriteJournal.is_committed(entry, path))
+        self.assertTrue(WriteJournal.is_committed({k: v for k, v in entry.items() if k != 'checksum'}, path))
+
+    def test_commit_replaces_group(self):
+        path = os.path.join(self.folder, 'group.zarr')
+        self.write_group(path, 1)
+        self.write_group(write_utils.get_staging_path(path), 2)
+
+        write_utils.commit_staged_group(write_utils.get_staging_path(path), path)
+
+        self.assertEqual(os.listdir(self.folder), ['group.zarr'])  # No .partial or .old left
+        np.testing.assert_array_equal(zarr.open_group(path, mode='r')['energy'][:], 2)
+
+
+class VerifyResume(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        source = os.path.join(self.folder, 'source')
+        os.makedirs(source)
+        data = {v: (('nnz', 'nny', 'nnx'), rng.standard_normal((32, 32, 32), dtype=np.float32)) for v in 'uvwetp'}
+        xr.Dataset(data).to_netcdf(os.path.join(source, 'jhd.000.nc'))
+
+        self.disks = [os.path.join(self.folder, f'disk{i}') + '/' for i in range(8)]
+        for disk in self.disks:
+            os.makedirs(disk)
+        patcher = mock.patch.object(write_utils, 'list_fileDB_folders', side_effect=lambda: list(self.disks))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.dataset = NCAR_Dataset('sabl2048b', [source], 4, 16, 'prod', 0, 0,
+                                    catalog_path=os.path.join(self.folder, 'catalog.sqlite'))
+        self.dataset.original_array_length = 32
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_resume_after_kill(self):
+        commit = write_utils.commit_staged_group
+        killed = []
+
+        def commit_or_die(staging_path, dest_groupname, sync=False):
+            if not killed:  # The first group is staged completely, then the job dies
+                killed.append(dest_groupname.rstrip('/'))
+                raise SystemError("Killed")
+            commit(staging_path, dest_groupname, sync)
+
+        with mock.patch.object(write_utils, 'commit_staged_group', commit_or_die):
+            self.dataset.distribute_to_filedb(NUM_THREADS=2)
+        self.assertTrue(os.path.exists(write_utils.get_staging_path(killed[0])))
+        self.assertFalse(os.path.exists(killed[0]))
+        self.assertNotIn(killed[0], WriteJournal(self.dataset.journal_path).load())
+
+        write_zarr_group = write_utils.write_zarr_group
+        written = []
+
+        def record_write(chunk, dest_groupname, *args, **kwargs):
+            written.append(dest_groupname.rstrip('/'))
+            write_zarr_group(chunk, dest_groupname, *args, **kwargs)
+
+        with mock.patch.object(write_utils, 'write_zarr_group', record_write):
+            self.dataset.distribute_to_filedb(NUM_THREADS=2, resume=True)
+        self.assertEqual(written, killed)  # Only the group that was not committed
+
+        cubes, range_list = self.dataset.transform_to_zarr(0)
+        placements = self.dataset.get_subcube_placements(0, range_list)
+        committed = WriteJournal(self.dataset.journal_path).load()
+        for cube, placement in zip(cubes, placements):
+            self.assertTrue(WriteJournal.is_committed(committed.get(placement['path']), placement['path']))
+            self.assertFalse(os.path.exists(write_utils.get_staging_path(placement['path'])))
+            group = zarr.open_group(placement['path'], mode='r')
+            np.testing.assert_array_equal(group['velocity'][:], cube['velocity'].values)
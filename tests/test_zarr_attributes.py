@@ -13,6 +13,7 @@ from parameterized import parameterized
 import os
 
 from src.dataset import NCAR_Dataset
+from src.utils import codec_utils
 
 
 config = {}
@@ -49,8 +50,8 @@ class VerifyNCARZarrAttributes(unittest.TestCase):
     # Cannot have setUp or setupClass because they don't work with Parameterized
     @parameterized.expand(generate_attribute_tests)
     def test_individual_timestep(self, dataset, timestep):
-        _, range_list = dataset.transform_to_zarr(timestep)
-        destination_paths, _ = dataset.get_zarr_array_destinations(timestep, range_list)
+        # From the placement catalog, so the original NetCDF is not opened
+        destination_paths = dataset.get_zarr_paths(timestep)
 
         for zarr_512_path in destination_paths:
             with self.subTest(timestep=timestep):
@@ -68,8 +69,14 @@ class VerifyNCARZarrAttributes(unittest.TestCase):
         Verify that the cube dimensions are as expected. Should be (512, 512, 512, 3) for velocity, (512, 512, 512, 1)
          otherwise
         """
+        # Groups written with a halo also hold the outer cells of their neighbors, see write_utils.get_halo_attrs()
+        if zarr_512.attrs.get('halo', 0):
+            side = tuple(end - start for start, end in zip(zarr_512.attrs['storage_start'],
+                                                           zarr_512.attrs['storage_end']))
+        else:
+            side = (512, 512, 512)
         for var in zarr_512.array_keys():
-            expected_shape = (512, 512, 512, 3) if var == "velocity" else (512, 512, 512, 1)
+            expected_shape = side + (3,) if var == "velocity" else side + (1,)
             self.assertEqual(zarr_512[var].shape, expected_shape)
 
         if config['general_settings']['verbose']:
@@ -84,8 +91,11 @@ class VerifyNCARZarrAttributes(unittest.TestCase):
             print("Chunk sizes = (64, 64, 64, x),  for all variables in ", zarr_512_path)
 
     def verify_zarr_compression(self, zarr_512, zarr_512_path):
+        expected_codecs = codec_utils.get_variable_codecs(config['write_settings'], zarr_512.array_keys())
         for var in zarr_512.array_keys():
-            self.assertIsNone(zarr_512[var].compressor)  # TODO get from config.yaml
+            compressor, filters = expected_codecs[var]
+            self.assertEqual(zarr_512[var].compressor, compressor)
+            self.assertEqual(zarr_512[var].filters, filters)
 
         if config['general_settings']['verbose']:
-            print("Compression is None for all variables in ", zarr_512_path)
+            print("Compressors and filters match config.yaml for all variables in ", zarr_512_path)
@@ -0,0 +1,75 @@
+"""
+Check the written NCAR data against the per-chunk checksums stored in
+each Zarr group when it was written (write_settings.chunk_checksums).
+Only reads the written groups, never the original NetCDF, so it works
+for prod and back copies alike. Groups are verified in parallel, one
+reader per FileDB disk, before the first test runs.
+Tests in the range [start_timestep, end_timestep].
+"""
+
+import unittest
+import yaml
+import os
+from parameterized import parameterized
+
+from src.dataset import NCAR_Dataset
+from src.utils import checksum_utils, write_utils
+
+
+config = {}
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file)
+dataset_name = os.environ.get('DATASET')
+start_timestep = int(os.environ.get('START_TIMESTEP', -1))
+end_timestep = int(os.environ.get('END_TIMESTEP', -1))
+write_mode = str(os.environ.get('WRITE_MODE', 'prod'))
+
+verification = None  # (mismatches by group path, {group path: exception}), filled by the first test
+
+
+def generate_checksum_tests():
+    global config, dataset_name, start_timestep, end_timestep, write_mode
+    if write_mode != 'prod' and write_mode != 'back':
+        raise ValueError("WRITE_MODE must be either 'prod' or 'back'")
+
+    dataset_config = config['datasets'][dataset_name]
+    write_config = config['write_settings']
+    if start_timestep == -1 or end_timestep == -1:
+        start_timestep = dataset_config['start_timestep']
+        end_timestep = dataset_config['end_timestep']
+
+    dataset = NCAR_Dataset(
+        name=dataset_name,
+        location_paths=dataset_config['location_paths'],
+        desired_zarr_chunk_size=write_config['desired_zarr_chunk_length'],
+        desired_zarr_array_length=write_config['desired_zarr_array_length'],
+        write_mode=write_mode,
+        start_timestep=start_timestep,
+        end_timestep=end_timestep
+    )
+
+    # From the placement catalog, so the original NetCDF is not opened
+    return [(timestep, dataset.get_zarr_paths(timestep)) for timestep in range(start_timestep, end_timestep + 1)]
+
+
+def verify_all_groups():
+    """Verify every group of every tested timestep at once, so all FileDB disks are read in parallel"""
+    global verification
+    if verification is None:
+        paths = [path for _, timestep_paths in generate_checksum_tests() for path in timestep_paths]
+        groups = [(path, write_utils.get_filedb_folder(path) or os.path.dirname(path)) for path in paths]
+        mismatches, errors = checksum_utils.verify_groups(groups)
+        verification = mismatches, {path: error for path, error in errors}
+
+    return verification
+
+
+class VerifyZarrChecksums(unittest.TestCase):
+    @parameterized.expand(generate_checksum_tests)
+    def test_timestep_checksums(self, timestep, destination_paths):
+        mismatches, errors = verify_all_groups()
+
+        for path in destination_paths:
+            with self.subTest(timestep=timestep, path=path):
+                self.assertNotIn(path, errors, f"Could not verify {path}: {errors.get(path)}")
+                self.assertEqual(mismatches[path], [], f"Chunk checksum mismatches in {path}")